@@ -1,115 +1,278 @@
-from flask import Flask, jsonify, request
-from db import Session, Owner, Property, OwnerProperty
+from flask import Flask, Response, jsonify, request, stream_with_context
+from db import Session, Owner, OwnerPortfolio, PropertyReadModel
+from response_cache import current_data_version, versioned
+from snapshot import PROPERTY_SNAPSHOT, snapshots
+from formats import columns, encode, negotiate_format
+from export import EXPORT_MIMETYPES, export_query, export_stream, export_filename
+from comparables import comparables_indexes, comparables_query, comparable_rows_statement, serialize_comparables
+from queries import (
+    PROPERTY_IMAGE, property_query, properties_page, column_fields, project_columns, serialize_property_summary,
+    clusters_statement, serialize_cluster, stats_statements, serialize_stats,
+    property_detail_statement, serialize_property_detail,
+    owners_page, serialize_owner_summary, empty_portfolio, owner_properties_statement, serialize_owner_detail,
+    household_statement, serialize_household,
+    search_statements, search_results,
+)
 from flask_cors import CORS
 
 app = Flask(__name__)
 
 
+CORS_ORIGINS = ["http://localhost:5173", "https://wealth-map-1.onrender.com"]
+
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": ["http://localhost:5173", "https://wealth-map-1.onrender.com"]}})
+CORS(app, resources={r"/*": {"origins": CORS_ORIGINS}})
+
+STREAM_CHUNK_SIZE = 1000
+
+def _page_rows(session, page):
+    """Rows of a queries.Page; None if its ?after= cursor doesn't exist."""
+    cursor = None
+    if page.after:
+        cursor = session.execute(page.cursor_statement()).first()
+        if cursor is None:
+            return None
+    return page.rows_statement(cursor)
+
+def _wants_ndjson() -> bool:
+    return request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+def _snapshot():
+    """The in-process snapshot for the current data version, if enabled and loaded."""
+    return snapshots.get(current_data_version()) if PROPERTY_SNAPSHOT else None
+
+def _ndjson_lines(session, statement):
+    try:
+        # yield_per streams from a server-side cursor
+        for row in session.execute(statement.execution_options(yield_per=STREAM_CHUNK_SIZE)).scalars():
+            yield app.json.dumps(serialize_property_summary(row)) + "\n"
+    finally:
+        session.close()
+
+def _snapshot_ndjson_lines(snapshot, indices):
+    for start in range(0, len(indices), STREAM_CHUNK_SIZE):
+        for row in snapshot.summaries(indices[start:start + STREAM_CHUNK_SIZE]):
+            yield app.json.dumps(serialize_property_summary(row)) + "\n"
 
 @app.route("/properties", methods=["GET"])
+@versioned
 def get_properties():
+    try:
+        query = property_query(request.args)
+        page = properties_page(query)
+        format = negotiate_format(request.args, request.accept_mimetypes)
+        fields = column_fields(request.args) if format != "json" else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    snapshot = _snapshot()
+    if snapshot is not None:
+        return _snapshot_properties(snapshot, query, format, fields)
+
     session = Session()
+    streaming = False
     try:
-        # Query all properties from the database
-        properties = session.query(Property).all()
-        # Return the data as JSON
-        return jsonify([
-            {
-                "id": prop.id,
-                "address": prop.site_address,
-                "city": prop.city,
-                "state": prop.state,
-                "zip_code": prop.zip_code,
-                "value": max(prop.avm_value or 0, prop.market_total_value or 0, prop.sale_amount or 0, prop.assessed_total_value or 0),
-                "size": prop.size,
-                "images": ["https://images.pexels.com/photos/1029599/pexels-photo-1029599.jpeg"],
-                "coordinates": {
-                    "lat": prop.latitude,
-                    "lng": prop.longitude,
-                },
-                                "owners": [
-                    {
-                        "id": owner.id,
-                        "name": owner.full_name,
-                        "estimatedNetWorth": owner.estimated_net_worth,
-                        "confidenceLevel": owner.confidence_level,
-                    }
-                    for owner in session.query(Owner)
-                    .join(OwnerProperty, Owner.id == OwnerProperty.owner_id)
-                    .filter(OwnerProperty.property_id == prop.id)
-                ]
-            }
-            for prop in properties
-        ])
+        statement = _page_rows(session, page)
+        if statement is None:
+            return jsonify({"error": "Unknown cursor"}), 400
+
+        if format != "json":
+            rows = session.execute(project_columns(statement, fields)).all()
+            body, mimetype = encode(format, columns(rows, fields, image=PROPERTY_IMAGE))
+            response = Response(body, mimetype=mimetype)
+        elif _wants_ndjson():
+            streaming = True
+            return Response(stream_with_context(_ndjson_lines(session, statement)), mimetype="application/x-ndjson")
+        else:
+            rows = session.execute(statement).scalars().all()
+            response = jsonify([serialize_property_summary(row) for row in rows])
+
+        if page.limit is not None and len(rows) == page.limit:
+            response.headers["X-Next-Cursor"] = rows[-1].property_id if format == "json" else rows[-1].cursor
+        return response
+    finally:
+        # A streamed response closes the session once the generator is exhausted
+        if not streaming:
+            session.close()
+
+def _snapshot_properties(snapshot, query, format, fields):
+    """get_properties served from the in-process snapshot; same bodies and headers."""
+    indices = snapshot.select(query)
+    if indices is None:
+        return jsonify({"error": "Unknown cursor"}), 400
+
+    if format != "json":
+        rows = snapshot.project(indices, fields)
+        body, mimetype = encode(format, columns(rows, fields, image=PROPERTY_IMAGE))
+        response = Response(body, mimetype=mimetype)
+    elif _wants_ndjson():
+        return Response(_snapshot_ndjson_lines(snapshot, indices), mimetype="application/x-ndjson")
+    else:
+        rows = snapshot.summaries(indices)
+        response = jsonify([serialize_property_summary(row) for row in rows])
+
+    if query.limit is not None and len(rows) == query.limit:
+        response.headers["X-Next-Cursor"] = rows[-1].property_id if format == "json" else rows[-1].cursor
+    return response
+
+@app.route("/properties/clusters", methods=["GET"])
+@versioned
+def get_property_clusters():
+    try:
+        statement = clusters_statement(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    session = Session()
+    try:
+        cells = session.execute(statement).scalars().all()
+        return jsonify([serialize_cluster(cell) for cell in cells])
+    finally:
+        session.close()
+
+@app.route("/stats", methods=["GET"])
+@versioned
+def get_stats():
+    try:
+        rollup_statement, histogram_statement = stats_statements(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    session = Session()
+    try:
+        rollups = session.execute(rollup_statement).scalars().all()
+        histograms = session.execute(histogram_statement).scalars().all()
+        return jsonify(serialize_stats(rollups, histograms))
     finally:
         session.close()
 
 @app.route("/properties/<property_id>", methods=["GET"])
+@versioned
 def get_property_by_id(property_id):
+    snapshot = _snapshot()
+    if snapshot is not None:
+        property = snapshot.detail(property_id)
+        if not property:
+            return jsonify({"error": "Property not found"}), 404
+        return jsonify(serialize_property_detail(property))
+
     session = Session()
     try:
         # Query the property by ID
-        property = session.query(Property).filter(Property.id == property_id).first()
+        property = session.execute(property_detail_statement(property_id)).scalars().first()
         if not property:
             return jsonify({"error": "Property not found"}), 404
 
-        # Query the owners associated with the property
-        owners = session.query(Owner).join(OwnerProperty, Owner.id == OwnerProperty.owner_id).filter(OwnerProperty.property_id == property_id).all()
-
-        # Serialize the property details
-        property_data = {
-            "id": property.id,
-            "attom_id": property.attom_id,
-            "site_address": property.site_address,
-            "address_line1": property.address_line1,
-            "address_line2": property.address_line2,
-            "city": property.city,
-            "state": property.state,
-            "zip_code": property.zip_code,
-            "propertytype": property.propertytype,
-            "year_built": property.year_built,
-            "size": property.size,
-            "latitude": property.latitude,
-            "longitude": property.longitude,
-            "sale_amount": property.sale_amount,
-            "sale_date": property.sale_date,
-            "sale_type": property.sale_type,
-            "avm_value": property.avm_value,
-            "avm_low": property.avm_low,
-            "avm_high": property.avm_high,
-            "avm_score": property.avm_score,
-            "avm_last_updated": property.avm_last_updated,
-            "assessed_total_value": max(property.assessed_total_value or 0, property.market_total_value or 0, property.sale_amount or 0, property.avm_value or 0),
-            "market_total_value": property.market_total_value,
-            "tax_amount": property.tax_amount,
-            "tax_year": property.tax_year,
-            "created_at": property.created_at,
-        }
-
-        # Serialize the owner details
-        owner_data = [
-            {
-                "id": owner.id,
-                "full_name": owner.full_name,
-                "mailing_address": owner.mailing_address,
-                "type": owner.type,
-                "estimated_net_worth": owner.estimated_net_worth,
-                "confidence_level": owner.confidence_level,
-                "created_at": owner.created_at,
-                "last_updated": owner.last_updated,
-            }
-            for owner in owners
-        ]
-
-        # Combine property and owner data
-        response_data = {
-            "property": property_data,
-            "owners": owner_data,
-        }
-
-        return jsonify(response_data)
+        return jsonify(serialize_property_detail(property))
+    finally:
+        session.close()
+
+@app.route("/properties/<property_id>/comparables", methods=["GET"])
+@versioned
+def get_property_comparables(property_id):
+    try:
+        query = comparables_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    index = comparables_indexes.get(current_data_version(), wait=True)
+    if index is None:
+        return jsonify({"error": "Comparables index unavailable"}), 503
+
+    session = Session()
+    try:
+        target = session.get(PropertyReadModel, property_id)
+        if not target:
+            return jsonify({"error": "Property not found"}), 404
+        if target.latitude is None or target.longitude is None:
+            return jsonify({"error": "Property has no coordinates"}), 400
+
+        matches = index.nearest(target, query)
+        rows = session.execute(comparable_rows_statement(matches)).scalars().all() if matches else []
+        return jsonify(serialize_comparables(matches, rows))
+    finally:
+        session.close()
+
+@app.route("/owners", methods=["GET"])
+@versioned
+def get_owners():
+    try:
+        page = owners_page(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    session = Session()
+    try:
+        statement = _page_rows(session, page)
+        if statement is None:
+            return jsonify({"error": "Unknown cursor"}), 400
+
+        rows = session.execute(statement).all()
+        response = jsonify([serialize_owner_summary(owner, portfolio) for owner, portfolio in rows])
+        if len(rows) == page.limit:
+            response.headers["X-Next-Cursor"] = rows[-1][0].id
+        return response
+    finally:
+        session.close()
+
+@app.route("/owners/<owner_id>", methods=["GET"])
+@versioned
+def get_owner_by_id(owner_id):
+    session = Session()
+    try:
+        owner = session.get(Owner, owner_id)
+        if not owner:
+            return jsonify({"error": "Owner not found"}), 404
+        portfolio = session.get(OwnerPortfolio, owner_id) or empty_portfolio()
+        properties = session.execute(owner_properties_statement(owner_id)).scalars().all()
+
+        return jsonify(serialize_owner_detail(owner, portfolio, properties))
+    finally:
+        session.close()
+
+@app.route("/export", methods=["GET"])
+def export():
+    # Not @versioned: the body is streamed, never held in (or cached from) memory
+    try:
+        query = export_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return Response(
+        stream_with_context(export_stream(query)),
+        mimetype=EXPORT_MIMETYPES[query.format],
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(query)}"'},
+    )
+
+@app.route("/households/<household_id>", methods=["GET"])
+@versioned
+def get_household(household_id):
+    session = Session()
+    try:
+        rows = session.execute(household_statement(household_id)).all()
+        if not rows:
+            return jsonify({"error": "Household not found"}), 404
+
+        return jsonify(serialize_household(household_id, rows))
+    finally:
+        session.close()
+
+@app.route("/search", methods=["GET"])
+@versioned
+def search():
+    try:
+        statements = search_statements(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if statements is None:
+        return jsonify([])
+    owner_statement, property_statement, limit = statements
+
+    session = Session()
+    try:
+        owners = session.execute(owner_statement).all()
+        properties = session.execute(property_statement).all()
+        return jsonify(search_results(owners, properties, limit))
     finally:
         session.close()
 
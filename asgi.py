@@ -0,0 +1,355 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from functools import wraps
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import Accept, MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+from db import DATABASE_URL, DataVersion, Owner, OwnerPortfolio, PropertyReadModel
+from app import app as flask_app, CORS_ORIGINS, STREAM_CHUNK_SIZE
+from response_cache import DATA_VERSION_TTL, CachedResponse, make_etag, response_cache
+from snapshot import PROPERTY_SNAPSHOT, snapshots
+from export import EXPORT_MIMETYPES, export_query, export_stream, export_filename
+from comparables import comparables_indexes, comparables_query, comparable_rows_statement, serialize_comparables
+from formats import MIN_COMPRESS_BYTES, columns, compress, encode, negotiate_encoding, negotiate_format
+from queries import (
+    PROPERTY_IMAGE, property_query, properties_page, column_fields, project_columns, serialize_property_summary,
+    clusters_statement, serialize_cluster, stats_statements, serialize_stats,
+    property_detail_statement, serialize_property_detail,
+    owners_page, serialize_owner_summary, empty_portfolio, owner_properties_statement, serialize_owner_detail,
+    household_statement, serialize_household,
+    search_statements, search_results,
+)
+
+# ASGI serving mode: the routes of app.py on an event loop with an async driver, so slow
+# queries wait on the pool instead of pinning a worker. Run with e.g.
+#   uvicorn asgi:app --workers 2
+# Responses (bodies, status codes, cursors, ETags, compression) match the Flask app.
+
+ASGI_DB_POOL_SIZE = int(os.getenv("ASGI_DB_POOL_SIZE", 20))
+ASGI_DB_MAX_OVERFLOW = int(os.getenv("ASGI_DB_MAX_OVERFLOW", 0))
+# Seconds a request waits for a free connection before failing
+ASGI_DB_POOL_TIMEOUT = float(os.getenv("ASGI_DB_POOL_TIMEOUT", 30))
+
+def _async_url(url: str):
+    url = make_url(url).set(drivername="postgresql+asyncpg")
+    if "sslmode" in url.query:
+        # asyncpg spells libpq's sslmode as ssl
+        url = url.difference_update_query(["sslmode"]).update_query_dict({"ssl": url.query["sslmode"]})
+    return url
+
+async_engine = create_async_engine(
+    _async_url(DATABASE_URL),
+    pool_size=ASGI_DB_POOL_SIZE,
+    max_overflow=ASGI_DB_MAX_OVERFLOW,
+    pool_timeout=ASGI_DB_POOL_TIMEOUT,
+)
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+def _json(payload, status: int = 200) -> Response:
+    # Encoded by the Flask app's JSON provider, so bodies are byte-for-byte what jsonify returns
+    return Response(flask_app.json.response(payload).get_data(), status_code=status, media_type="application/json")
+
+def _accept_mimetypes(request) -> MIMEAccept:
+    return parse_accept_header(request.headers.get("accept"), MIMEAccept)
+
+def _wants_ndjson(request) -> bool:
+    return _accept_mimetypes(request).best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+
+_version = {"value": None, "checked_at": 0.0}
+
+async def current_data_version() -> int:
+    now = time.monotonic()
+    if _version["value"] is not None and now - _version["checked_at"] < DATA_VERSION_TTL:
+        return _version["value"]
+
+    async with AsyncSession() as session:
+        row = await session.get(DataVersion, "default")
+    _version["value"], _version["checked_at"] = (row.version if row else 0), now
+    return _version["value"]
+
+def _to_entry(response: Response) -> CachedResponse:
+    headers = [(name, value) for name, value in response.headers.items() if name not in ("content-type", "content-length")]
+    return CachedResponse(response.body, response.status_code, response.media_type, headers)
+
+async def _compressed(entry: CachedResponse, encoding: str) -> CachedResponse:
+    # Compressing a large body is CPU-bound; keep it off the event loop
+    body = await asyncio.to_thread(compress, entry.body, encoding)
+    return entry._replace(body=body, headers=entry.headers + [("content-encoding", encoding)])
+
+def versioned(endpoint):
+    """response_cache.versioned for Starlette endpoints: same key, ETag, compression and headers."""
+    @wraps(endpoint)
+    async def wrapper(request):
+        if _wants_ndjson(request):
+            return await endpoint(request)
+
+        args = request.query_params
+        format = negotiate_format(args, _accept_mimetypes(request))
+        key = (request.url.path, tuple(sorted(args.multi_items())), format, await current_data_version())
+        encoding = negotiate_encoding(parse_accept_header(request.headers.get("accept-encoding"), Accept))
+        etag = make_etag(key + (encoding,))
+        vary = {"Vary": "Accept, Accept-Encoding"}
+        if etag in parse_etags(request.headers.get("if-none-match")):
+            return Response(status_code=304, headers={"ETag": f'"{etag}"', **vary})
+
+        async def compute():
+            return _to_entry(await endpoint(request))
+
+        entry = await response_cache.get_or_compute_async(key, compute)
+        if encoding and entry.status == 200 and len(entry.body) >= MIN_COMPRESS_BYTES:
+            entry = await response_cache.get_or_compute_async(key + (encoding,), lambda: _compressed(entry, encoding))
+        headers = {**dict(entry.headers), **vary}
+        if entry.status == 200:
+            headers.update({"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+        return Response(entry.body, status_code=entry.status, media_type=entry.mimetype, headers=headers)
+
+    return wrapper
+
+async def _page_rows(session, page):
+    """Async twin of app._page_rows."""
+    cursor = None
+    if page.after:
+        cursor = (await session.execute(page.cursor_statement())).first()
+        if cursor is None:
+            return None
+    return page.rows_statement(cursor)
+
+async def _ndjson_lines(session, statement):
+    try:
+        # yield_per streams from a server-side cursor
+        rows = await session.stream_scalars(statement.execution_options(yield_per=STREAM_CHUNK_SIZE))
+        async for row in rows:
+            yield flask_app.json.dumps(serialize_property_summary(row)) + "\n"
+    finally:
+        await session.close()
+
+async def _snapshot():
+    """The in-process snapshot for the current data version, if enabled and loaded."""
+    return snapshots.get(await current_data_version()) if PROPERTY_SNAPSHOT else None
+
+async def _snapshot_ndjson_lines(snapshot, indices):
+    for start in range(0, len(indices), STREAM_CHUNK_SIZE):
+        for row in snapshot.summaries(indices[start:start + STREAM_CHUNK_SIZE]):
+            yield flask_app.json.dumps(serialize_property_summary(row)) + "\n"
+
+def _snapshot_properties(request, snapshot, query, format, fields):
+    """get_properties served from the in-process snapshot; same bodies and headers."""
+    indices = snapshot.select(query)
+    if indices is None:
+        return _json({"error": "Unknown cursor"}, 400)
+
+    if format != "json":
+        rows = snapshot.project(indices, fields)
+        body, mimetype = encode(format, columns(rows, fields, image=PROPERTY_IMAGE))
+        response = Response(body, media_type=mimetype)
+    elif _wants_ndjson(request):
+        return StreamingResponse(_snapshot_ndjson_lines(snapshot, indices), media_type="application/x-ndjson")
+    else:
+        rows = snapshot.summaries(indices)
+        response = _json([serialize_property_summary(row) for row in rows])
+
+    if query.limit is not None and len(rows) == query.limit:
+        response.headers["X-Next-Cursor"] = rows[-1].property_id if format == "json" else rows[-1].cursor
+    return response
+
+@versioned
+async def get_properties(request):
+    args = request.query_params
+    try:
+        query = property_query(args)
+        page = properties_page(query)
+        format = negotiate_format(args, _accept_mimetypes(request))
+        fields = column_fields(args) if format != "json" else None
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+
+    snapshot = await _snapshot()
+    if snapshot is not None:
+        return _snapshot_properties(request, snapshot, query, format, fields)
+
+    session = AsyncSession()
+    streaming = False
+    try:
+        statement = await _page_rows(session, page)
+        if statement is None:
+            return _json({"error": "Unknown cursor"}, 400)
+
+        if format != "json":
+            rows = (await session.execute(project_columns(statement, fields))).all()
+            body, mimetype = encode(format, columns(rows, fields, image=PROPERTY_IMAGE))
+            response = Response(body, media_type=mimetype)
+        elif _wants_ndjson(request):
+            streaming = True
+            return StreamingResponse(_ndjson_lines(session, statement), media_type="application/x-ndjson")
+        else:
+            rows = (await session.execute(statement)).scalars().all()
+            response = _json([serialize_property_summary(row) for row in rows])
+
+        if page.limit is not None and len(rows) == page.limit:
+            response.headers["X-Next-Cursor"] = rows[-1].property_id if format == "json" else rows[-1].cursor
+        return response
+    finally:
+        # A streamed response closes the session once the generator is exhausted
+        if not streaming:
+            await session.close()
+
+@versioned
+async def get_property_clusters(request):
+    try:
+        statement = clusters_statement(request.query_params)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+
+    async with AsyncSession() as session:
+        cells = (await session.execute(statement)).scalars().all()
+        return _json([serialize_cluster(cell) for cell in cells])
+
+@versioned
+async def get_stats(request):
+    try:
+        rollup_statement, histogram_statement = stats_statements(request.query_params)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+
+    async with AsyncSession() as session:
+        rollups = (await session.execute(rollup_statement)).scalars().all()
+        histograms = (await session.execute(histogram_statement)).scalars().all()
+        return _json(serialize_stats(rollups, histograms))
+
+@versioned
+async def get_property_by_id(request):
+    snapshot = await _snapshot()
+    if snapshot is not None:
+        property = snapshot.detail(request.path_params["property_id"])
+        if not property:
+            return _json({"error": "Property not found"}, 404)
+        return _json(serialize_property_detail(property))
+
+    async with AsyncSession() as session:
+        property = (await session.execute(property_detail_statement(request.path_params["property_id"]))).scalars().first()
+        if not property:
+            return _json({"error": "Property not found"}, 404)
+
+        return _json(serialize_property_detail(property))
+
+@versioned
+async def get_property_comparables(request):
+    try:
+        query = comparables_query(request.query_params)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+
+    # Building the index is a blocking DB read; wait for it off the event loop
+    index = await asyncio.to_thread(comparables_indexes.get, await current_data_version(), True)
+    if index is None:
+        return _json({"error": "Comparables index unavailable"}, 503)
+
+    async with AsyncSession() as session:
+        target = await session.get(PropertyReadModel, request.path_params["property_id"])
+        if not target:
+            return _json({"error": "Property not found"}, 404)
+        if target.latitude is None or target.longitude is None:
+            return _json({"error": "Property has no coordinates"}, 400)
+
+        matches = index.nearest(target, query)
+        rows = (await session.execute(comparable_rows_statement(matches))).scalars().all() if matches else []
+        return _json(serialize_comparables(matches, rows))
+
+@versioned
+async def get_owners(request):
+    try:
+        page = owners_page(request.query_params)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+
+    async with AsyncSession() as session:
+        statement = await _page_rows(session, page)
+        if statement is None:
+            return _json({"error": "Unknown cursor"}, 400)
+
+        rows = (await session.execute(statement)).all()
+        response = _json([serialize_owner_summary(owner, portfolio) for owner, portfolio in rows])
+        if len(rows) == page.limit:
+            response.headers["X-Next-Cursor"] = rows[-1][0].id
+        return response
+
+@versioned
+async def get_owner_by_id(request):
+    owner_id = request.path_params["owner_id"]
+    async with AsyncSession() as session:
+        owner = await session.get(Owner, owner_id)
+        if not owner:
+            return _json({"error": "Owner not found"}, 404)
+        portfolio = await session.get(OwnerPortfolio, owner_id) or empty_portfolio()
+        properties = (await session.execute(owner_properties_statement(owner_id))).scalars().all()
+
+        return _json(serialize_owner_detail(owner, portfolio, properties))
+
+@versioned
+async def get_household(request):
+    household_id = request.path_params["household_id"]
+    async with AsyncSession() as session:
+        rows = (await session.execute(household_statement(household_id))).all()
+        if not rows:
+            return _json({"error": "Household not found"}, 404)
+
+        return _json(serialize_household(household_id, rows))
+
+async def export(request):
+    try:
+        query = export_query(request.query_params)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+
+    # A sync iterator: Starlette runs it in its threadpool, off the event loop
+    return StreamingResponse(
+        export_stream(query),
+        media_type=EXPORT_MIMETYPES[query.format],
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(query)}"'},
+    )
+
+@versioned
+async def search(request):
+    try:
+        statements = search_statements(request.query_params)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+    if statements is None:
+        return _json([])
+    owner_statement, property_statement, limit = statements
+
+    async with AsyncSession() as session:
+        owners = (await session.execute(owner_statement)).all()
+        properties = (await session.execute(property_statement)).all()
+        return _json(search_results(owners, properties, limit))
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await async_engine.dispose()
+
+app = Starlette(
+    routes=[
+        Route("/properties", get_properties),
+        Route("/properties/clusters", get_property_clusters),
+        Route("/stats", get_stats),
+        Route("/properties/{property_id}", get_property_by_id),
+        Route("/properties/{property_id}/comparables", get_property_comparables),
+        Route("/owners", get_owners),
+        Route("/owners/{owner_id}", get_owner_by_id),
+        Route("/households/{household_id}", get_household),
+        Route("/export", export),
+        Route("/search", search),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
@@ -0,0 +1,57 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+import tempfile
+from typing import Dict, Optional
+
+# Raw ATTOM payloads, one gzip file per (endpoint, params), so ETL re-runs don't spend quota.
+# Set ATTOM_CACHE_DIR="" to disable.
+ATTOM_CACHE_DIR = os.getenv("ATTOM_CACHE_DIR", ".attom_cache")
+
+# Seconds a cached payload stays fresh; replay mode ignores these
+ENDPOINT_TTLS = {
+    "property/address": 24 * 3600,
+    "property/detailowner": 7 * 24 * 3600,
+    "allevents/detail": 7 * 24 * 3600,
+}
+
+
+def cache_key(endpoint: str, params: Dict) -> str:
+    canonical = json.dumps({"endpoint": endpoint, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def _path(endpoint: str, key: str) -> str:
+    return os.path.join(ATTOM_CACHE_DIR, endpoint.replace("/", "_"), key[:2], f"{key}.json.gz")
+
+def load(endpoint: str, params: Dict, max_age: Optional[float] = None) -> Optional[Dict]:
+    """Cached payload, or None if missing or older than max_age seconds (None = any age)."""
+    if not ATTOM_CACHE_DIR:
+        return None
+    path = _path(endpoint, cache_key(endpoint, params))
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if max_age is not None and time.time() - entry["fetched_at"] > max_age:
+        return None
+    return entry["body"]
+
+def store(endpoint: str, params: Dict, body: Dict):
+    if not ATTOM_CACHE_DIR:
+        return
+    path = _path(endpoint, cache_key(endpoint, params))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temp file and rename so concurrent workers never read a partial entry
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as f:
+            json.dump({"endpoint": endpoint, "params": params, "fetched_at": time.time(), "body": body}, f, default=str)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -1,8 +1,15 @@
 import os
 import time
+import random
+import threading
 import requests
-from typing import List, Dict, Optional
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import List, Dict, Optional, Tuple
 from dotenv import load_dotenv
+from rate_limiter import TokenBucket
+import attom_cache
 
 load_dotenv()
 
@@ -14,59 +21,157 @@ HEADERS = {
     "apikey": ATTOM_API_KEY
 }
 
-def get_properties(postalcode: str, propertytype: str = "ALL", pagesize: int = 100) -> List[Dict]:
-    all_properties = []
-    page = 1
-    while True:
-        url = f"{BASE_URL}/property/address"
-        params = {
-            "postalcode": postalcode,
-            "propertytype": propertytype,
-            "page": page,
-            "pagesize": pagesize
+# Requests per second allowed by our ATTOM plan, shared by every thread and worker process
+ATTOM_RATE_LIMIT = float(os.getenv("ATTOM_RATE_LIMIT", 5))
+ATTOM_WORKERS = int(os.getenv("ATTOM_WORKERS", 8))
+ATTOM_CONNECT_TIMEOUT = float(os.getenv("ATTOM_CONNECT_TIMEOUT", 5))
+ATTOM_READ_TIMEOUT = float(os.getenv("ATTOM_READ_TIMEOUT", 30))
+# Retries for 5xx responses and connection errors; 429s are paced by the rate limiter instead
+ATTOM_MAX_RETRIES = int(os.getenv("ATTOM_MAX_RETRIES", 4))
+RETRY_BACKOFF = 0.5
+MAX_RATE_LIMITED_RETRIES = 5
+# Replay mode serves every call from the on-disk cache and never touches the network
+ATTOM_REPLAY = os.getenv("ATTOM_REPLAY", "").lower() in ("1", "true", "yes")
+
+rate_limiter = TokenBucket("attom", ATTOM_RATE_LIMIT)
+
+# One keep-alive pool for the whole process; requests decompresses gzip bodies transparently
+http = requests.Session()
+http.headers.update(HEADERS)
+http.headers["Accept-Encoding"] = "gzip, deflate"
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=ATTOM_WORKERS * 2))
+
+_stats = defaultdict(lambda: {
+    "calls": 0, "cache_hits": 0, "retries": 0, "failures": 0, "latency_total": 0.0, "latency_max": 0.0
+})
+_stats_lock = threading.Lock()
+
+def _record(endpoint: str, latency: Optional[float] = None, retry: bool = False, failure: bool = False, cache_hit: bool = False):
+    with _stats_lock:
+        stats = _stats[endpoint]
+        if latency is not None:
+            stats["calls"] += 1
+            stats["latency_total"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+        stats["retries"] += retry
+        stats["failures"] += failure
+        stats["cache_hits"] += cache_hit
+
+def set_replay_mode(enabled: bool = True):
+    global ATTOM_REPLAY
+    ATTOM_REPLAY = enabled
+
+def get_request_stats() -> Dict[str, Dict]:
+    with _stats_lock:
+        return {
+            endpoint: {**stats, "latency_avg": stats["latency_total"] / stats["calls"] if stats["calls"] else 0.0}
+            for endpoint, stats in _stats.items()
         }
-        response = requests.get(url, headers=HEADERS, params=params)
-        if response.status_code != 200:
-            print(f"Failed to fetch properties: {response.text}")
-            break
 
-        data = response.json()
-        props = data.get("property", [])
-        if not props:
-            break
+def _get(endpoint: str, params: dict) -> Optional[requests.Response]:
+    url = f"{BASE_URL}/{endpoint}"
+    attempts = rate_limited = 0
+    while True:
+        rate_limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = http.get(url, params=params, timeout=(ATTOM_CONNECT_TIMEOUT, ATTOM_READ_TIMEOUT))
+            error = None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            response, error = None, e
+        _record(endpoint, latency=time.monotonic() - started)
+
+        if response is not None and response.status_code == 429 and rate_limited < MAX_RATE_LIMITED_RETRIES:
+            rate_limited += 1
+            _record(endpoint, retry=True)
+            retry_after = response.headers.get("Retry-After")
+            rate_limiter.penalize(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            continue
+
+        if (response is None or response.status_code >= 500) and attempts < ATTOM_MAX_RETRIES:
+            attempts += 1
+            _record(endpoint, retry=True)
+            time.sleep(RETRY_BACKOFF * 2 ** (attempts - 1) * random.uniform(0.5, 1.5))
+            continue
+
+        if response is None:
+            _record(endpoint, failure=True)
+            print(f"ATTOM {endpoint} failed after {attempts} retries: {error}")
+        elif response.status_code != 200:
+            _record(endpoint, failure=True)
+        return response
+
+def _get_json(endpoint: str, params: dict, fresh: bool = False) -> Optional[Dict]:
+    """The endpoint's JSON body; with fresh, always from ATTOM (except in replay mode), never the cache."""
+    if ATTOM_REPLAY:
+        body = attom_cache.load(endpoint, params)
+        if body is None:
+            print(f"Replay miss for {endpoint} {params}")
+        else:
+            _record(endpoint, cache_hit=True)
+        return body
+
+    body = None if fresh else attom_cache.load(endpoint, params, max_age=attom_cache.ENDPOINT_TTLS.get(endpoint))
+    if body is not None:
+        _record(endpoint, cache_hit=True)
+        return body
+
+    response = _get(endpoint, params)
+    if response is None:
+        return None
+    if response.status_code != 200:
+        print(f"ATTOM {endpoint} fetch failed: {response.status_code} → {response.text}")
+        return None
 
-        all_properties.extend(props)
-        total = data["status"]["total"]
-        if len(all_properties) >= total:
-            break
+    body = response.json()
+    attom_cache.store(endpoint, params, body)
+    return body
+
+def get_properties_page(postalcode: str, propertytype: str = "ALL", page: int = 1, pagesize: int = 100) -> Tuple[Optional[List[Dict]], int]:
+    """One listing page and the total result count; (None, 0) if the page couldn't be fetched."""
+    params = {
+        "postalcode": postalcode,
+        "propertytype": propertytype,
+        "page": page,
+        "pagesize": pagesize
+    }
+    data = _get_json("property/address", params)
+    if data is None:
+        return None, 0
 
-        page += 1
-        time.sleep(0.5)
+    return data.get("property", []), data.get("status", {}).get("total", 0)
+
+def get_properties(postalcode: str, propertytype: str = "ALL", pagesize: int = 100) -> List[Dict]:
+    all_properties, total = get_properties_page(postalcode, propertytype, 1, pagesize)
+    if not all_properties or len(all_properties) >= total:
+        return all_properties or []
+
+    # The first page tells us how many pages there are; fetch the rest concurrently
+    last_page = -(-total // pagesize)
+    with ThreadPoolExecutor(max_workers=ATTOM_WORKERS) as pool:
+        pages = pool.map(
+            lambda page: get_properties_page(postalcode, propertytype, page, pagesize)[0] or [],
+            range(2, last_page + 1),
+        )
+        for props in pages:
+            all_properties.extend(props)
 
     return all_properties
 
-def get_owner_details(attom_id: int) -> Optional[Dict]:
-    url = f"{BASE_URL}/property/detailowner"
+def get_owner_details(attom_id: int, fresh: bool = False) -> Optional[Dict]:
     params = {"attomid": attom_id}
-    response = requests.get(url, headers=HEADERS, params=params)
-
-    if response.status_code != 200:
-        print(f"Owner data fetch failed: {response.status_code} → {response.text}")
+    data = _get_json("property/detailowner", params, fresh)
+    if data is None:
         return None
 
-    data = response.json()
     return data.get("property", [{}])[0]
 
-def get_property_financial_details(attom_id: int) -> Optional[Dict]:
-    url = f"{BASE_URL}/allevents/detail"
+def get_property_financial_details(attom_id: int, fresh: bool = False) -> Optional[Dict]:
     params = {"id": attom_id}
-    response = requests.get(url, headers=HEADERS, params=params)
-
-    if response.status_code != 200:
-        print(f"Financial data fetch failed: {response.status_code} → {response.text}")
+    data = _get_json("allevents/detail", params, fresh)
+    if data is None:
         return None
 
-    data = response.json()
     prop = data.get("property", [{}])[0]
     addr = prop.get("address", {})
     avm = prop.get("avm", {}).get("amount", {})
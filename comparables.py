@@ -0,0 +1,244 @@
+import math
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+from sqlalchemy import Select, select
+from db import Session, PropertyReadModel
+from queries import arg, serialize_property_summary
+from snapshot import CategoryColumn, SnapshotHolder, StringColumn
+
+# /properties/<id>/comparables: the k properties nearest to one property, from a grid index
+# over lat/lng. Properties are sorted by grid cell, so a cell's members are one
+# searchsorted away. The search visits rings of cells outwards from the property and
+# stops as soon as no farther ring can beat the k-th best, so a query touches the
+# neighbourhood rather than the table. The index is rebuilt per data version.
+
+EARTH_RADIUS_KM = 6371.0088
+CELL_DEG = 0.05  # ~5.5 km north-south
+GRID_ROWS = int(180 / CELL_DEG)
+GRID_COLS = int(360 / CELL_DEG)
+
+DEFAULT_COMPARABLES = 10
+MAX_COMPARABLES = 100
+DEFAULT_RADIUS_KM = 5.0
+MAX_RADIUS_KM = 50.0
+
+# ?weighted=true multiplies each distance by 1 + these penalties, so dissimilar
+# properties need to be that much closer to rank as comparables
+SIZE_WEIGHT = 1.0  # per e-fold difference in size
+YEAR_BUILT_WEIGHT = 0.25  # per decade apart
+PROPERTYTYPE_WEIGHT = 1.0  # different propertytype
+MISSING_FEATURE_PENALTY = 0.5  # size or year_built unknown on either side
+
+
+class Comparable(NamedTuple):
+    property_id: str
+    distance_km: float
+    score: Optional[float]
+
+
+class ComparablesQuery(NamedTuple):
+    k: int
+    radius_km: float
+    weighted: bool
+
+
+def comparables_query(args) -> ComparablesQuery:
+    k = arg(args, "k", int, DEFAULT_COMPARABLES)
+    if not 1 <= k <= MAX_COMPARABLES:
+        raise ValueError(f"k must be between 1 and {MAX_COMPARABLES}")
+    radius_km = arg(args, "radius_km", float, DEFAULT_RADIUS_KM)
+    if not 0 < radius_km <= MAX_RADIUS_KM:
+        raise ValueError(f"radius_km must be greater than 0 and at most {MAX_RADIUS_KM:g}")
+    return ComparablesQuery(k, radius_km, args.get("weighted", "").lower() in ("1", "true", "yes"))
+
+def _cell(lat, lng):
+    row = np.clip(np.floor((np.asarray(lat) + 90) / CELL_DEG), 0, GRID_ROWS - 1).astype(np.int64)
+    col = np.floor((np.asarray(lng) + 180) / CELL_DEG).astype(np.int64) % GRID_COLS
+    return row, col
+
+def _search_extent(lat: float, radius_km: float) -> Tuple[int, Optional[int]]:
+    """How many rows and columns of cells away anything within radius_km of latitude lat can be.
+
+    Columns are None when the radius reaches all the way around, over or near a pole.
+    """
+    reach = math.degrees(radius_km / EARTH_RADIUS_KM)
+    rows = math.ceil(reach / CELL_DEG)
+    # Longitude differences are widest at the most poleward latitude within reach
+    poleward = abs(lat) + reach
+    if poleward >= 90.0:
+        return rows, None
+    spread = math.sin(math.radians(reach) / 2) / math.cos(math.radians(poleward))
+    if spread >= 1.0:
+        return rows, None
+    cols = math.ceil(math.degrees(2 * math.asin(spread)) / CELL_DEG)
+    return rows, cols if 2 * cols + 1 < GRID_COLS else None
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(value) for value in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class ComparablesIndex:
+    def __init__(self, version: int, property_ids: StringColumn, latitude: np.ndarray, longitude: np.ndarray,
+                 size: np.ndarray, year_built: np.ndarray, propertytype: CategoryColumn):
+        self.version = version
+        # All sorted by grid cell; size and year_built are NaN where unknown
+        self.property_ids = property_ids
+        self.latitude, self.longitude = latitude, longitude
+        self.size, self.year_built = size, year_built
+        self.propertytype = propertytype
+        row, col = _cell(latitude, longitude)
+        self.cells = row * GRID_COLS + col
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def _ring(self, row: int, col: int, r: int, rows: int) -> np.ndarray:
+        """Row indices of the properties in the cells r steps (Chebyshev) from (row, col), at most rows rows away."""
+        if r == 0:
+            cells = [(row, col)]
+        else:
+            side = min(r - 1, rows)
+            cells = [(row + dr, col + dc) for dr in (-r, r) if r <= rows for dc in range(-r, r + 1)]
+            cells += [(row + dr, col + dc) for dc in (-r, r) for dr in range(-side, side + 1)]
+        keys = np.array([ring_row * GRID_COLS + ring_col % GRID_COLS for ring_row, ring_col in cells if 0 <= ring_row < GRID_ROWS])
+        if not len(keys):
+            return np.empty(0, dtype=np.int64)
+        starts = np.searchsorted(self.cells, keys, "left")
+        ends = np.searchsorted(self.cells, keys, "right")
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    def _band(self, row: int, rows: int) -> np.ndarray:
+        """Row indices of the properties in every cell at most rows rows from row, all the way around."""
+        low = max(row - rows, 0) * GRID_COLS
+        high = (min(row + rows, GRID_ROWS - 1) + 1) * GRID_COLS
+        return np.arange(np.searchsorted(self.cells, low, "left"), np.searchsorted(self.cells, high, "left"))
+
+    def _ring_distance_km(self, lat: float, r: int) -> float:
+        """Lower bound on the distance from a point at latitude lat to anything r rings of cells away."""
+        if r <= 1:
+            return 0.0
+        gap = math.radians((r - 1) * CELL_DEG)
+        # Farther east/west the gap is narrowest at the most poleward latitude the ring reaches
+        poleward = min(abs(lat) + (r + 1) * CELL_DEG, 90.0)
+        across = 2 * math.asin(min(1.0, math.cos(math.radians(poleward)) * math.sin(gap / 2)))
+        return EARTH_RADIUS_KM * min(gap, across)
+
+    def _penalties(self, candidates: np.ndarray, size, year_built, propertytype) -> np.ndarray:
+        penalty = np.ones(len(candidates))
+        sizes = self.size[candidates]
+        if size and size > 0:
+            known = sizes > 0
+            penalty[known] += SIZE_WEIGHT * np.abs(np.log(sizes[known] / size))
+            penalty[~known] += MISSING_FEATURE_PENALTY
+        else:
+            penalty += MISSING_FEATURE_PENALTY
+
+        years = self.year_built[candidates]
+        if year_built is not None:
+            known = ~np.isnan(years)
+            penalty[known] += YEAR_BUILT_WEIGHT * np.abs(years[known] - year_built) / 10
+            penalty[~known] += MISSING_FEATURE_PENALTY
+        else:
+            penalty += MISSING_FEATURE_PENALTY
+
+        same_type = self.propertytype.equals(propertytype)[candidates] if propertytype else np.zeros(len(candidates), dtype=bool)
+        penalty[~same_type] += PROPERTYTYPE_WEIGHT
+        return penalty
+
+    def nearest(self, target, query: ComparablesQuery) -> List[Comparable]:
+        """The query.k properties nearest to target (a PropertyReadModel row), target excluded."""
+        lat, lng = target.latitude, target.longitude
+        row, col = (int(value) for value in _cell(lat, lng))
+        # One extra in case the target itself (or a duplicate of it) is among the nearest
+        wanted = query.k + 1
+
+        # Rings stop at the radius north/south and east/west; where the radius wraps around
+        # a pole the whole band of rows is one step instead of thousands of rings
+        rows, cols = _search_extent(lat, query.radius_km)
+        last = max(rows, cols) if cols is not None else 0
+
+        found, distances, scores = [], [], []
+        r = 0
+        while r <= last and self._ring_distance_km(lat, r) <= query.radius_km:
+            candidates = self._ring(row, col, r, rows) if cols is not None else self._band(row, rows)
+            if len(candidates):
+                distance = haversine_km(lat, lng, self.latitude[candidates], self.longitude[candidates])
+                within = distance <= query.radius_km
+                candidates, distance = candidates[within], distance[within]
+                score = distance
+                if query.weighted:
+                    # Penalties are >= 1, so a score is never below its distance and the ring bound still holds
+                    score = distance * self._penalties(candidates, target.size, target.year_built, target.propertytype)
+                found.append(candidates)
+                distances.append(distance)
+                scores.append(score)
+
+            r += 1
+            if sum(len(batch) for batch in found) >= wanted:
+                kth = np.partition(np.concatenate(scores), wanted - 1)[wanted - 1]
+                if self._ring_distance_km(lat, r) > kth:
+                    break
+
+        if not found:
+            return []
+        found, distances, scores = np.concatenate(found), np.concatenate(distances), np.concatenate(scores)
+        best = np.lexsort((found, distances, scores))[:wanted]
+        ids = self.property_ids.take(found[best].tolist())
+        matches = [
+            Comparable(property_id, float(distances[i]), float(scores[i]) if query.weighted else None)
+            for property_id, i in zip(ids, best.tolist())
+            if property_id != target.property_id
+        ]
+        return matches[:query.k]
+
+
+def build_comparables_index(session, version: int) -> ComparablesIndex:
+    rows = session.execute(
+        select(
+            PropertyReadModel.property_id, PropertyReadModel.latitude, PropertyReadModel.longitude,
+            PropertyReadModel.size, PropertyReadModel.year_built, PropertyReadModel.propertytype,
+        ).where(PropertyReadModel.latitude.isnot(None), PropertyReadModel.longitude.isnot(None))
+    ).all()
+    latitude = np.array([row.latitude for row in rows], dtype=np.float64)
+    longitude = np.array([row.longitude for row in rows], dtype=np.float64)
+    cell_row, cell_col = _cell(latitude, longitude)
+    order = np.argsort(cell_row * GRID_COLS + cell_col, kind="stable")
+
+    rows = [rows[i] for i in order.tolist()]
+    return ComparablesIndex(
+        version,
+        StringColumn.build([row.property_id for row in rows]),
+        latitude[order],
+        longitude[order],
+        np.array([row.size if row.size is not None else np.nan for row in rows], dtype=np.float64),
+        np.array([row.year_built if row.year_built is not None else np.nan for row in rows], dtype=np.float64),
+        CategoryColumn.build([row.propertytype for row in rows]),
+    )
+
+def load_comparables_index(version: int) -> ComparablesIndex:
+    session = Session()
+    try:
+        return build_comparables_index(session, version)
+    finally:
+        session.close()
+
+comparables_indexes = SnapshotHolder(load_comparables_index, "comparables index")
+
+def comparable_rows_statement(matches: List[Comparable]) -> Select:
+    return select(PropertyReadModel).where(PropertyReadModel.property_id.in_([match.property_id for match in matches]))
+
+def serialize_comparables(matches: List[Comparable], rows) -> list:
+    """Property summaries in match order, with their distance (and score, when weighted)."""
+    rows = {row.property_id: row for row in rows}
+    results = []
+    for match in matches:
+        if match.property_id not in rows:
+            continue  # Removed since the index was built
+        result = serialize_property_summary(rows[match.property_id])
+        result["distance_km"] = round(match.distance_km, 3)
+        if match.score is not None:
+            result["score"] = round(match.score, 3)
+        results.append(result)
+    return results
@@ -2,11 +2,12 @@ import os
 from dotenv import load_dotenv
 from sqlalchemy import (
     create_engine, Column, String, Integer, BigInteger, Float,
-    ForeignKey, UniqueConstraint, TIMESTAMP, func
+    ForeignKey, UniqueConstraint, Index, TIMESTAMP, func, text, inspect
 )
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
 
 
 load_dotenv()
@@ -36,10 +37,28 @@ class Owner(Base):
     last_updated = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     estimated_net_worth = Column(Float, nullable=True)
     confidence_level = Column(String, nullable=True)  # high, medium, low
+    portfolio_fingerprint = Column(String, nullable=True)  # Inputs of the last estimate; see wealth_estimator
+    rules_triggered = Column(ARRAY(String), nullable=True)  # Rule class names behind the last estimate
+    # Owners linked by a shared mailing address or a co-owned property; see households
+    address_key = Column(String, index=True)  # Normalized mailing_address
+    household_id = Column(String, index=True)  # Smallest owner id in the household
+    household_size = Column(Integer, nullable=False, default=1, server_default="1")
 
+    properties = relationship(
+        "Property", secondary="owner_property", back_populates="owners", viewonly=True
+    )
 
     __table_args__ = (
         UniqueConstraint("full_name", "mailing_address", name="uq_owner"),
+        # Leaderboard: read backwards for the top of the ranking, id breaks ties for the cursor
+        Index("ix_owners_net_worth", "estimated_net_worth", "id"),
+        Index("ix_owners_confidence_net_worth", "confidence_level", "estimated_net_worth", "id"),
+        # Trigram indexes for /search; needs the pg_trgm extension, see create_tables
+        Index("ix_owners_full_name_trgm", "full_name", postgresql_using="gin", postgresql_ops={"full_name": "gin_trgm_ops"}),
+        Index(
+            "ix_owners_mailing_address_trgm", "mailing_address",
+            postgresql_using="gin", postgresql_ops={"mailing_address": "gin_trgm_ops"},
+        ),
     )
 
 class Property(Base):
@@ -62,6 +81,7 @@ class Property(Base):
     # Coordinates (optional, for mapping or future spatial indexing)
     latitude = Column(Float)
     longitude = Column(Float)
+    tile_key = Column(String, index=True)  # Quadkey at tiles.TILE_ZOOM, for viewport queries
 
     # Sales
     sale_amount = Column(Float)
@@ -84,16 +104,214 @@ class Property(Base):
 
     created_at = Column(TIMESTAMP, server_default=func.now())
 
+    # Ordered so /properties/<id> lists owners the same way every time (and as the snapshot does)
+    owners = relationship(
+        "Owner", secondary="owner_property", back_populates="properties", viewonly=True, order_by="Owner.id"
+    )
+
+    __table_args__ = (
+        Index(
+            "ix_properties_site_address_trgm", "site_address",
+            postgresql_using="gin", postgresql_ops={"site_address": "gin_trgm_ops"},
+        ),
+    )
+
 class OwnerProperty(Base):
     __tablename__ = "owner_property"
 
     owner_id = Column(String, ForeignKey("owners.id"), primary_key=True)
     property_id = Column(String, ForeignKey("properties.id"), primary_key=True)
 
+    # Writes go through OwnerProperty rows; Owner.properties / Property.owners are read-only views
+    owner = relationship("Owner")
+    property = relationship("Property")
+
+class TileAggregate(Base):
+    """Per-tile pin counts and value totals at every zoom up to tiles.TILE_ZOOM."""
+    __tablename__ = "tile_aggregates"
+
+    zoom = Column(Integer, primary_key=True)
+    tile_key = Column(String, primary_key=True)
+    property_count = Column(Integer, nullable=False, default=0)
+    latitude_sum = Column(Float, nullable=False, default=0)
+    longitude_sum = Column(Float, nullable=False, default=0)
+    value_sum = Column(Float, nullable=False, default=0)
+    value_max = Column(Float)
+
+class StatsRollup(Base):
+    """Totals per ZIP, state and propertytype for /stats, kept current by the ETL (see stats_rollups)."""
+    __tablename__ = "stats_rollups"
+
+    dimension = Column(String, primary_key=True)  # zip, state or propertytype
+    group_key = Column(String, primary_key=True)
+    property_count = Column(Integer, nullable=False, default=0)
+    value_sum = Column(Float, nullable=False, default=0)
+    owner_count = Column(Integer, nullable=False, default=0)
+    net_worth_count = Column(Integer, nullable=False, default=0)  # Owners with an estimate
+    net_worth_sum = Column(Float, nullable=False, default=0)
+
+class StatsHistogram(Base):
+    """Log-bucketed counts of property values and owner net worths per stats_rollups group.
+
+    Histograms merge by adding counts, so updates are deltas and percentiles never scan the base tables.
+    """
+    __tablename__ = "stats_histograms"
+
+    dimension = Column(String, primary_key=True)
+    group_key = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)  # value or net_worth
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class OwnerStats(Base):
+    """The groups and net worth each owner is currently counted under in stats_rollups."""
+    __tablename__ = "owner_stats"
+
+    owner_id = Column(String, ForeignKey("owners.id"), primary_key=True)
+    zip_codes = Column(ARRAY(String), nullable=False, server_default="{}")
+    states = Column(ARRAY(String), nullable=False, server_default="{}")
+    propertytypes = Column(ARRAY(String), nullable=False, server_default="{}")
+    net_worth = Column(Float)
+
+class PropertyReadModel(Base):
+    """Denormalized /properties row: display value and owner summaries precomputed by the ETL."""
+    __tablename__ = "property_read_model"
+
+    property_id = Column(String, ForeignKey("properties.id"), primary_key=True)
+    site_address = Column(String)
+    city = Column(String)
+    state = Column(String)
+    zip_code = Column(String)
+    propertytype = Column(String)
+    year_built = Column(Integer)
+    size = Column(Float)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    tile_key = Column(String, index=True)
+    display_value = Column(Float)
+    owners = Column(JSONB, nullable=False, server_default="[]")  # [{id, name, estimatedNetWorth, confidenceLevel}]
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    # Sorted /properties queries: an equality filter plus a (sort column, id) range is one index scan,
+    # read forwards or backwards for asc/desc, and property_id breaks ties for the keyset cursor
+    __table_args__ = (
+        Index("ix_prm_value", "display_value", "property_id"),
+        Index("ix_prm_state_value", "state", "display_value", "property_id"),
+        Index("ix_prm_zip_value", "zip_code", "display_value", "property_id"),
+        Index("ix_prm_type_value", "propertytype", "display_value", "property_id"),
+        Index("ix_prm_size", "size", "property_id"),
+        Index("ix_prm_year_built", "year_built", "property_id"),
+    )
+
+class OwnerPortfolio(Base):
+    """Per-owner property totals, precomputed by the ETL for the /owners endpoints."""
+    __tablename__ = "owner_portfolios"
+
+    owner_id = Column(String, ForeignKey("owners.id"), primary_key=True)
+    property_count = Column(Integer, nullable=False, default=0)
+    total_value = Column(Float, nullable=False, default=0)
+    states = Column(ARRAY(String), nullable=False, server_default="{}")
+    zip_codes = Column(ARRAY(String), nullable=False, server_default="{}")
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # "Owns anything in 90210" is an array containment test
+        Index("ix_owner_portfolios_states", "states", postgresql_using="gin"),
+        Index("ix_owner_portfolios_zip_codes", "zip_codes", postgresql_using="gin"),
+        Index("ix_owner_portfolios_total_value", "total_value", "owner_id"),
+        Index("ix_owner_portfolios_property_count", "property_count", "owner_id"),
+    )
+
+class EtlJob(Base):
+    """One unit of ETL work: a listing page of a ZIP/type, or a single attom_id.
+
+    page/attom_id are 0 when not applicable so the unique constraint dedupes jobs.
+    """
+    __tablename__ = "etl_jobs"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    kind = Column(String, nullable=False)  # page, property
+    zipcode = Column(String, nullable=False)
+    propertytype = Column(String, nullable=False)
+    page = Column(Integer, nullable=False, default=0)
+    attom_id = Column(BigInteger, nullable=False, default=0)
+    listing_modified = Column(String)  # vintage.lastModified from the listing page, for property jobs
+    state = Column(String, nullable=False, default="pending")  # pending, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_expires_at = Column(TIMESTAMP)
+    worker = Column(String)
+    last_error = Column(String)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("kind", "zipcode", "propertytype", "page", "attom_id", name="uq_etl_job"),
+        Index("ix_etl_jobs_claim", "state", "id"),
+    )
+
+class PropertySync(Base):
+    """What the ETL last fetched for a property, so refreshes can skip unchanged ones; see delta_sync."""
+    __tablename__ = "property_sync"
+
+    attom_id = Column(BigInteger, primary_key=True)
+    listing_modified = Column(String)  # vintage.lastModified of the listing entry
+    owner_hash = Column(String)  # Hashes of the normalized detailowner / allevents payloads
+    financial_hash = Column(String)
+    owner_fetched_at = Column(TIMESTAMP)
+    financial_fetched_at = Column(TIMESTAMP)
+    avm_last_updated = Column(TIMESTAMP)
+    sale_date = Column(String)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+class DataVersion(Base):
+    """Counter bumped by the ETL whenever it publishes new data; read caches key on it."""
+    __tablename__ = "data_version"
+
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+def get_data_version(session, name: str = "default") -> int:
+    row = session.get(DataVersion, name)
+    return row.version if row else 0
+
+def bump_data_version(session, name: str = "default") -> int:
+    stmt = insert(DataVersion).values(name=name, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DataVersion.name],
+        set_={"version": DataVersion.version + 1, "updated_at": func.now()},
+    ).returning(DataVersion.version)
+    return session.execute(stmt).scalar()
+
 # ─────────────────────────────────────
 # Schema Init
 # ─────────────────────────────────────
 
 def create_tables():
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
     Base.metadata.create_all(engine)
     print("Tables created successfully.")
+
+def migrate_tables():
+    """Bring a database made by an older create_tables up to the current schema; safe to re-run.
+
+    create_all only creates missing tables, so columns and indexes added to existing tables
+    (properties.tile_key, the owners estimate and household columns, ...) are added here.
+    New columns start empty; run_etl's migrate command backfills them.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        existing = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not existing.has_table(table.name):
+                continue
+            columns = {column["name"] for column in existing.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        Base.metadata.create_all(conn)
+    print("Tables migrated successfully.")
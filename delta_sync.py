@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from db import PropertySync
+
+# Delta sync: a refresh re-fetches a property only when its listing entry changed or what we
+# hold is older than these windows. Owner records change far less often than AVMs and sales.
+SYNC_OWNER_MAX_AGE_DAYS = float(os.getenv("SYNC_OWNER_MAX_AGE_DAYS", 30))
+SYNC_FINANCIAL_MAX_AGE_DAYS = float(os.getenv("SYNC_FINANCIAL_MAX_AGE_DAYS", 7))
+
+
+def payload_hash(data) -> str:
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+def listing_modified(listing_entry: dict) -> Optional[str]:
+    return listing_entry.get("vintage", {}).get("lastModified")
+
+def load_syncs(session, attom_ids: Iterable[int]) -> Dict[int, PropertySync]:
+    return {
+        sync.attom_id: sync
+        for sync in session.query(PropertySync).filter(PropertySync.attom_id.in_(list(attom_ids)))
+    }
+
+def plan_fetches(syncs: Dict[int, PropertySync], listing: Dict[int, Optional[str]], now: datetime = None) -> Dict[int, bool]:
+    """The attom_ids that need fetching, each mapped to whether its owner details are needed too.
+
+    Fresh, unchanged properties are left out. The financial details are fetched for every
+    planned id, since they carry the property row itself.
+    """
+    now = now or datetime.utcnow()
+    owner_max_age = timedelta(days=SYNC_OWNER_MAX_AGE_DAYS)
+    financial_max_age = timedelta(days=SYNC_FINANCIAL_MAX_AGE_DAYS)
+
+    plans = {}
+    for attom_id, modified in listing.items():
+        sync = syncs.get(attom_id)
+        if sync is None or (modified and modified != sync.listing_modified):
+            plans[attom_id] = True
+            continue
+        owner_stale = sync.owner_fetched_at is None or now - sync.owner_fetched_at > owner_max_age
+        financial_stale = sync.financial_fetched_at is None or now - sync.financial_fetched_at > financial_max_age
+        if owner_stale or financial_stale:
+            plans[attom_id] = owner_stale
+    return plans
+
+def unchanged(record: dict, sync: Optional[PropertySync]) -> bool:
+    """True if a fetched record hashes the same as what was last written."""
+    return (
+        sync is not None
+        and record["financial_hash"] == sync.financial_hash
+        and record["owner_hash"] in (None, sync.owner_hash)
+    )
+
+def mark_synced(session, records: List[dict]):
+    """Record what was fetched for each record, in the caller's transaction."""
+    if not records:
+        return
+    now = datetime.utcnow()
+    rows = {}
+    for record in records:
+        prop = record["property"]
+        rows[prop["attom_id"]] = {
+            "attom_id": prop["attom_id"],
+            "listing_modified": record.get("listing_modified"),
+            "owner_hash": record.get("owner_hash"),
+            "financial_hash": record.get("financial_hash"),
+            # Left NULL when the owner details weren't fetched, so the stored values are kept
+            "owner_fetched_at": now if record.get("owner_hash") else None,
+            "financial_fetched_at": now,
+            "avm_last_updated": prop.get("avm_last_updated"),
+            "sale_date": prop.get("sale_date"),
+        }
+
+    stmt = insert(PropertySync).values([rows[attom_id] for attom_id in sorted(rows)])
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PropertySync.attom_id],
+        set_={
+            "listing_modified": func.coalesce(excluded.listing_modified, PropertySync.listing_modified),
+            "owner_hash": func.coalesce(excluded.owner_hash, PropertySync.owner_hash),
+            "financial_hash": excluded.financial_hash,
+            "owner_fetched_at": func.coalesce(excluded.owner_fetched_at, PropertySync.owner_fetched_at),
+            "financial_fetched_at": excluded.financial_fetched_at,
+            "avm_last_updated": excluded.avm_last_updated,
+            "sale_date": excluded.sale_date,
+            "updated_at": func.now(),
+        },
+    )
+    session.execute(stmt)
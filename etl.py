@@ -1,10 +1,20 @@
 import uuid
 from datetime import datetime
-from db import Session, Owner, Property, OwnerProperty
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from db import Session, Owner, Property, OwnerProperty, bump_data_version
 from attom_client import get_owner_details, get_property_financial_details
 from dotenv import load_dotenv
 from wealth_estimator import compute_owner_wealth
-from typing import List
+from wealth_batch import run_batch_estimation
+from tiles import quadkey
+from tile_aggregates import property_contribution, apply_tile_deltas, rollup_low_zooms
+from read_model import refresh_properties, refresh_owners, refresh_portfolios
+from stats_rollups import property_stats, update_stats, refresh_owner_stats
+from households import merge_households
+from delta_sync import payload_hash, load_syncs, plan_fetches, unchanged, mark_synced
+from typing import Dict, List, Optional, Tuple
 
 def normalize_name(name: str) -> str:
     return name.strip().upper() if name else None
@@ -12,147 +22,307 @@ def normalize_name(name: str) -> str:
 def normalize_address(addr: str) -> str:
     return addr.strip().upper() if addr else None
 
-def insert_or_get_owner(session, full_name: str, mailing_address: str) -> str:
-    full_name = normalize_name(full_name)
-    mailing_address = normalize_address(mailing_address)
-
-    owner = session.query(Owner).filter_by(
-        full_name=full_name,
-        mailing_address=mailing_address
-    ).first()
-
-    if owner:
-        return owner.id
-
-    owner_id = str(uuid.uuid4())
-    owner = Owner(id=owner_id, full_name=full_name, mailing_address=mailing_address)
-    session.add(owner)
-    session.commit()
-    return owner_id
-
-def insert_or_update_property(session, data: dict, propertytype) -> str:
-    attom_id = data.get("attom_id")
-    property_obj = session.query(Property).filter_by(attom_id=attom_id).first()
-
-    if not property_obj:
-        property_id = str(uuid.uuid4())
-        property_obj = Property(id=property_id, attom_id=attom_id)
-        session.add(property_obj)
-    else:
-        property_id = property_obj.id
-
-    # Basic Details
-    property_obj.site_address = data.get("site_address")
-    property_obj.address_line1 = data.get("address_line1")
-    property_obj.address_line2 = data.get("address_line2")
-    property_obj.city = data.get("city")
-    property_obj.state = data.get("state")
-    property_obj.zip_code = data.get("zip_code")
-    property_obj.latitude = data.get("latitude")
-    property_obj.longitude = data.get("longitude")
-    property_obj.propertytype = propertytype
-    property_obj.size = data.get("size")
-    property_obj.year_built = data.get("year_built")
-
-    # Sale
-    property_obj.sale_amount = data.get("sale_amount")
-    property_obj.sale_date = data.get("sale_date")
-    property_obj.sale_type = data.get("sale_type")
-    property_obj.sale_date = data.get("sale_date")
-
-    # AVM
-    property_obj.avm_value = data.get("avm_value")
-    property_obj.avm_low = data.get("avm_low")
-    property_obj.avm_high = data.get("avm_high")
-    property_obj.avm_score = data.get("avm_score")
+# Columns written from an allevents/detail payload; everything except the id
+PROPERTY_FIELDS = [
+    "site_address", "address_line1", "address_line2", "city", "state", "zip_code",
+    "latitude", "longitude", "size", "year_built",
+    "sale_amount", "sale_date", "sale_type",
+    "avm_value", "avm_low", "avm_high", "avm_score",
+    "assessed_total_value", "market_total_value", "tax_amount", "tax_year",
+]
+
+def property_row(data: dict, propertytype) -> dict:
+    row = {field: data.get(field) for field in PROPERTY_FIELDS}
+    row["attom_id"] = data.get("attom_id")
+    row["propertytype"] = propertytype
+    row["tile_key"] = quadkey(row["latitude"], row["longitude"])
+
+    row["avm_last_updated"] = None
     if data.get("avm_last_updated"):
         try:
-            property_obj.avm_last_updated = datetime.strptime(data["avm_last_updated"], "%Y-%m-%d")
+            row["avm_last_updated"] = datetime.strptime(data["avm_last_updated"], "%Y-%m-%d")
         except Exception:
             pass
+    return row
 
-    # Assessment
-    property_obj.assessed_total_value = data.get("assessed_total_value")
-    property_obj.market_total_value = data.get("market_total_value")
-    property_obj.tax_amount = data.get("tax_amount")
-    property_obj.tax_year = data.get("tax_year")
-
-    session.commit()
-    return property_id
-
-def link_owner_to_property(session, owner_id: str, property_id: str):
-    link = session.query(OwnerProperty).filter_by(owner_id=owner_id, property_id=property_id).first()
-    if not link:
-        session.add(OwnerProperty(owner_id=owner_id, property_id=property_id))
-        session.commit()
-
-def process_attom_id(attom_id: int, propertytype) -> List[str]:
-    session = Session()
-    updated_owners = set()
+def fetch_attom_payloads(attom_id: int, fetch_owners: bool = True, fresh: bool = False) -> Optional[Tuple[dict, dict]]:
+    """The raw owner and financial payloads for one property; None if either is missing.
 
-    try:
-        owner_data = get_owner_details(attom_id)
+    fresh bypasses the payload cache, for properties delta sync knows have changed or gone stale.
+    """
+    owner_data = {}
+    if fetch_owners:
+        owner_data = get_owner_details(attom_id, fresh)
         if not owner_data:
             print(f"Skipping attom_id={attom_id}: no owner data")
-            return []
-
-        financial_data = get_property_financial_details(attom_id)
-        if not financial_data:
-            print(f"Skipping attom_id={attom_id}: no financial data")
-            return []
+            return None
 
-        property_id = insert_or_update_property(session, financial_data, propertytype)
+    financial_data = get_property_financial_details(attom_id, fresh)
+    if not financial_data:
+        print(f"Skipping attom_id={attom_id}: no financial data")
+        return None
 
-        owner_block = owner_data.get("owner", {})
-        mailing_address = normalize_address(owner_block.get("mailingaddressoneline"))
+    return owner_data, financial_data
 
-        if not mailing_address:
-            print(f"Skipping attom_id={attom_id}: missing mailing address")
-            return []
+def build_record(attom_id: int, propertytype, owner_data: dict, financial_data: dict, fetch_owners: bool = True) -> dict:
+    """Normalize fetched payloads into what the write path needs for one property."""
+    owner_block = owner_data.get("owner", {})
+    mailing_address = normalize_address(owner_block.get("mailingaddressoneline"))
 
+    owners = []
+    if fetch_owners and not mailing_address:
+        # The property is still stored, just without owners
+        print(f"Skipping owners for attom_id={attom_id}: missing mailing address")
+    elif fetch_owners:
         # Loop through all keys that start with "owner" and have a fullname
         for key, value in owner_block.items():
             if key.startswith("owner") and isinstance(value, dict):
                 full_name = normalize_name(value.get("fullname"))
-                if full_name:
-                    owner_id = insert_or_get_owner(session, full_name, mailing_address)
-                    link_owner_to_property(session, owner_id, property_id)
-                    updated_owners.add(owner_id)
+                if full_name and full_name not in owners:
+                    owners.append(full_name)
+
+    return {
+        "property": property_row(financial_data, propertytype),
+        "mailing_address": mailing_address,
+        "owners": owners,
+        "owner_hash": payload_hash(owner_data) if fetch_owners else None,
+        "financial_hash": payload_hash(financial_data),
+    }
+
+def fetch_attom_record(attom_id: int, propertytype, fetch_owners: bool = True, fresh: bool = False) -> Optional[dict]:
+    """Fetch and normalize everything the write path needs for one property.
+
+    Without fetch_owners only the financial details are fetched; the record then has no
+    owners and the property's existing owner links are left as they are.
+    """
+    payloads = fetch_attom_payloads(attom_id, fetch_owners, fresh)
+    if not payloads:
+        return None
+    return build_record(attom_id, propertytype, *payloads, fetch_owners=fetch_owners)
+
+def fetch_changed(session, targets: Dict[int, Tuple[str, Optional[str]]], pool: ThreadPoolExecutor) -> Dict[int, Optional[dict]]:
+    """Delta fetch for {attom_id: (propertytype, listing lastModified)}.
+
+    Returns the records to write, or None where a fetch failed. Properties that are still
+    fresh are not fetched at all, and those that come back unchanged are only marked as
+    synced; neither appears in the result.
+    """
+    syncs = load_syncs(session, targets)
+    plans = plan_fetches(syncs, {attom_id: modified for attom_id, (_, modified) in targets.items()})
+    planned = sorted(plans)
+
+    def fetch(attom_id):
+        try:
+            # Planned because the listing changed or our copy is stale, so the payload cache
+            # (which may predate the change) must not answer for it
+            return fetch_attom_record(attom_id, targets[attom_id][0], fetch_owners=plans[attom_id], fresh=True)
+        except Exception as e:
+            print(f"Error fetching attom_id={attom_id}: {e}")
+            return None
+
+    results, same = {}, []
+    for attom_id, record in zip(planned, pool.map(fetch, planned)):
+        if record:
+            record["listing_modified"] = targets[attom_id][1]
+        if record and unchanged(record, syncs.get(attom_id)):
+            same.append(record)
+        else:
+            results[attom_id] = record
+
+    mark_synced(session, same)
+    session.commit()
+    if len(results) < len(targets):
+        print(f"Delta sync: {len(targets) - len(planned)} fresh, {len(same)} unchanged of {len(targets)} properties")
+    return results
+
+def write_batch(session, records: List[dict]) -> Tuple[Dict[int, List[str]], Dict[str, int]]:
+    """Upsert properties, owners and links for a batch of records in a single transaction.
+
+    Returns the owner ids linked to each attom_id, and the dirty owners: everyone
+    linked to a property that is new, changed or gained an owner, or whose household
+    grew, mapped to their household size.
+    """
+    if not records:
+        return {}, {}
+
+    # Later records for the same property win; sorted keys keep lock order stable across workers
+    by_attom_id = {record["property"]["attom_id"]: record for record in records}
+    attom_ids = sorted(by_attom_id)
+
+    # The old tile and stats contributions read here are subtracted as deltas below, so the rows
+    # are locked until commit; placeholder rows for new properties give concurrent writers of
+    # the same property a row to queue on instead of both counting it as new
+    inserted = set(session.execute(
+        insert(Property)
+        .values([{"id": str(uuid.uuid4()), "attom_id": attom_id} for attom_id in attom_ids])
+        .on_conflict_do_nothing(index_elements=[Property.attom_id])
+        .returning(Property.attom_id)
+    ).scalars())
+    existing = {
+        p.attom_id: p
+        for p in session.query(Property).filter(Property.attom_id.in_(attom_ids)).order_by(Property.attom_id).with_for_update()
+        if p.attom_id not in inserted
+    }
+    old_contributions = {attom_id: property_contribution(p) for attom_id, p in existing.items()}
+    old_stats = {attom_id: property_stats(p) for attom_id, p in existing.items()}
+    changed = [
+        attom_id for attom_id in attom_ids
+        if attom_id not in existing or any(
+            getattr(existing[attom_id], column) != value
+            for column, value in by_attom_id[attom_id]["property"].items()
+        )
+    ]
+    session.expunge_all()
+
+    rows = [{"id": str(uuid.uuid4()), **by_attom_id[attom_id]["property"]} for attom_id in attom_ids]
+    stmt = insert(Property).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Property.attom_id],
+        set_={column: stmt.excluded[column] for column in rows[0] if column not in ("id", "attom_id")},
+    ).returning(Property.attom_id, Property.id)
+    property_ids = dict(session.execute(stmt).all())
+
+    owner_keys = sorted({
+        (full_name, record["mailing_address"])
+        for record in by_attom_id.values()
+        for full_name in record["owners"]
+    })
+    owner_ids = {}
+    if owner_keys:
+        session.execute(
+            insert(Owner).values([
+                {"id": str(uuid.uuid4()), "full_name": full_name, "mailing_address": mailing_address}
+                for full_name, mailing_address in owner_keys
+            ]).on_conflict_do_nothing(constraint="uq_owner")
+        )
+        # Read back rather than RETURNING from a no-op DO UPDATE: that would lock existing owners
+        # in name order, and merge_households updates owners in id order later in this transaction
+        owner_ids = {
+            (full_name, mailing_address): owner_id
+            for owner_id, full_name, mailing_address in session.query(Owner.id, Owner.full_name, Owner.mailing_address)
+            .filter(tuple_(Owner.full_name, Owner.mailing_address).in_(owner_keys))
+        }
+
+    linked = {
+        attom_id: [owner_ids[(full_name, by_attom_id[attom_id]["mailing_address"])] for full_name in by_attom_id[attom_id]["owners"]]
+        for attom_id in attom_ids
+    }
+    links = sorted({(owner_id, property_ids[attom_id]) for attom_id, ids in linked.items() for owner_id in ids})
+    affected = {property_ids[attom_id] for attom_id in changed}
+    if links:
+        new_links = session.execute(
+            insert(OwnerProperty)
+            .values([{"owner_id": owner_id, "property_id": property_id} for owner_id, property_id in links])
+            .on_conflict_do_nothing()
+            .returning(OwnerProperty.property_id)
+        )
+        affected.update(property_id for property_id, in new_links)
+
+    dirty = {}
+    if affected:
+        owners = [owner_id for owner_id, in session.query(OwnerProperty.owner_id).filter(OwnerProperty.property_id.in_(affected))]
+        # Also returns the owners whose household grew, whose estimates are split more ways now
+        dirty = merge_households(session, owners)
+
+    removed, added = [], []
+    removed_stats, added_stats = [], []
+    for row in rows:
+        prop = Property(**row)
+        old = old_contributions.get(row["attom_id"])
+        new = property_contribution(prop)
+        if old != new:
+            removed += [old] if old else []
+            added += [new] if new else []
+        old = old_stats.get(row["attom_id"])
+        new = property_stats(prop)
+        if old != new:
+            removed_stats += [old] if old else []
+            added_stats.append(new)
+    apply_tile_deltas(session, removed, added)
+    refresh_properties(session, affected)
+    refresh_portfolios(session, dirty)
+    update_stats(session, removed_stats, added_stats, dirty)
+    mark_synced(session, list(by_attom_id.values()))
 
-        session.close()  # Close this session early to avoid locking issues
+    session.commit()
+    return linked, dirty
 
-        owners_len = len(updated_owners)
+def recompute_wealth(dirty: Dict[str, int]):
+    # One transaction for the estimates and what is derived from them: the stored fingerprint
+    # makes later runs skip an owner, so it must never commit without the refreshes
+    session = Session()
+    try:
+        # compute_owner_wealth also skips owners whose portfolio fingerprint is unchanged;
+        # sorted so concurrent writers lock owners in the same order
+        updated = [
+            owner_id for owner_id in sorted(dirty)
+            if compute_owner_wealth(owner_id, dirty[owner_id], session=session)
+        ]
+        if updated:
+            refresh_owners(session, updated)
+            refresh_owner_stats(session, updated)
+        session.commit()
+    finally:
+        session.close()
 
-        # Compute wealth
-        for oid in updated_owners:
-            result = compute_owner_wealth(oid, owners_len)
+def process_attom_id(attom_id: int, propertytype) -> List[str]:
+    session = Session()
+    try:
+        record = fetch_attom_record(attom_id, propertytype)
+        if not record:
+            return []
+
+        linked, dirty = write_batch(session, [record])
+        session.close()  # Close this session early to avoid locking issues
 
-        return list(updated_owners)
+        recompute_wealth(dirty)
+        return linked.get(attom_id, [])
 
     except Exception as e:
         print(f"Error processing attom_id={attom_id}: {e}")
         return []
 
     finally:
-        if session:
-            session.close()
+        session.close()
+
+def run_batch_wealth_estimation(force: bool = False):
+    run_batch_estimation(force=force)
+    print("Wealth estimation completed.")
+    publish_data_version()
 
-def run_batch_wealth_estimation():
+def backfill_tile_keys(batch_size: int = 1000):
     session = Session()
     try:
-        owners = session.query(Owner).all()
-        print(f"🧮 Found {len(owners)} owners. Estimating wealth...")
-
-        for owner in owners:
-            # Count how many owners share this mailing address
-            mailing_group_size = session.query(Owner).filter_by(mailing_address=owner.mailing_address).count()
-            result = compute_owner_wealth(owner.id, owner_length=mailing_group_size)
-
-        
-        print("Wealth estimation completed.")
+        updated = 0
+        while True:
+            properties = (
+                session.query(Property)
+                .filter(Property.tile_key.is_(None), Property.latitude.isnot(None), Property.longitude.isnot(None))
+                .limit(batch_size)
+                .all()
+            )
+            if not properties:
+                break
+            for prop in properties:
+                prop.tile_key = quadkey(prop.latitude, prop.longitude)
+            session.commit()
+            updated += len(properties)
+
+        print(f"Backfilled tile keys for {updated} properties.")
+        publish_data_version()
 
     finally:
         session.close()
 
-
-
+def publish_data_version():
+    """Tell API workers that cached responses built from older data are stale."""
+    session = Session()
+    try:
+        # The coarse map tiles the ETL leaves to publication; see tile_aggregates
+        rollup_low_zooms(session)
+        session.commit()
+        version = bump_data_version(session)
+        session.commit()
+        print(f"Published data version {version}.")
+    finally:
+        session.close()
@@ -0,0 +1,214 @@
+import csv
+import io
+import os
+from typing import Dict, Iterator, NamedTuple, Optional
+from sqlalchemy import Select, select, text
+from db import Session, Owner, OwnerProperty, Property
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet exports are offered only when pyarrow is installed
+    pa = pq = None
+
+# Bulk export of every owner-property pair, for analysts who would otherwise page through
+# /properties. Rows come off a server-side cursor EXPORT_CHUNK_SIZE at a time and go
+# straight out as CSV or Parquet, so memory stays flat however many rows there are, and
+# the export holds one DB connection rather than a gunicorn worker's worth of ORM objects.
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 10000))
+
+EXPORT_COLUMNS = {
+    "owner_id": Owner.id,
+    "owner_name": Owner.full_name,
+    "owner_type": Owner.type,
+    "mailing_address": Owner.mailing_address,
+    "estimated_net_worth": Owner.estimated_net_worth,
+    "confidence_level": Owner.confidence_level,
+    "property_id": Property.id,
+    "attom_id": Property.attom_id,
+    "site_address": Property.site_address,
+    "city": Property.city,
+    "state": Property.state,
+    "zip_code": Property.zip_code,
+    "propertytype": Property.propertytype,
+    "year_built": Property.year_built,
+    "size": Property.size,
+    "latitude": Property.latitude,
+    "longitude": Property.longitude,
+    "avm_value": Property.avm_value,
+    "assessed_total_value": Property.assessed_total_value,
+    "market_total_value": Property.market_total_value,
+    "sale_amount": Property.sale_amount,
+    "sale_date": Property.sale_date,
+}
+STATE_INDEX = list(EXPORT_COLUMNS).index("state")
+# Partition directory for properties without a state
+UNKNOWN_STATE = "unknown"
+
+EXPORT_MIMETYPES = {"csv": "text/csv"}
+if pq:
+    EXPORT_MIMETYPES["parquet"] = "application/vnd.apache.parquet"
+
+
+class ExportQuery(NamedTuple):
+    format: str
+    state: Optional[str]
+
+
+def export_query(args) -> ExportQuery:
+    format = args.get("format", "csv")
+    if format not in EXPORT_MIMETYPES:
+        raise ValueError(f"format must be one of: {', '.join(EXPORT_MIMETYPES)}")
+    return ExportQuery(format, args.get("state") or None)
+
+def export_statement(state: Optional[str] = None) -> Select:
+    statement = (
+        select(*EXPORT_COLUMNS.values())
+        .select_from(OwnerProperty)
+        .join(Owner, Owner.id == OwnerProperty.owner_id)
+        .join(Property, Property.id == OwnerProperty.property_id)
+    )
+    if state:
+        statement = statement.where(Property.state == state)
+    return statement
+
+def _chunks(session, statement: Select, chunk_size: int) -> Iterator[list]:
+    # Postgres plans cursors for the first 10% of rows by default (nested loops over
+    # indexes); an export reads them all, which hash joins do faster
+    session.execute(text("SET LOCAL cursor_tuple_fraction = 1"))
+    # yield_per streams from a server-side cursor
+    yield from session.execute(statement.execution_options(yield_per=chunk_size)).partitions()
+
+
+def _arrow_schema():
+    types = {str: pa.string(), int: pa.int64(), float: pa.float64()}
+    return pa.schema([(name, types[column.type.python_type]) for name, column in EXPORT_COLUMNS.items()])
+
+def _arrow_table(rows: list, schema):
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    return pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+
+
+class _CsvWriter:
+    def __init__(self, file):
+        self.file = file
+        self.writer = csv.writer(file)
+        self.writer.writerow(EXPORT_COLUMNS)
+
+    def write(self, rows: list):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetWriter:
+    """One row group per write, so a chunk of rows is never held twice."""
+
+    def __init__(self, sink):
+        self.schema = _arrow_schema()
+        self.writer = pq.ParquetWriter(sink, self.schema, compression="zstd")
+
+    def write(self, rows: list):
+        self.writer.write_table(_arrow_table(rows, self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class _StreamSink:
+    """A write-only file for ParquetWriter whose bytes are drained between chunks."""
+
+    def __init__(self):
+        self.closed = False
+        self._buffer = io.BytesIO()
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._position += len(data)
+        return self._buffer.write(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+def export_stream(query: ExportQuery, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    """The body of an export download, produced chunk by chunk from its own session."""
+    session = Session()
+    try:
+        if query.format == "parquet":
+            sink = _StreamSink()
+            writer = _ParquetWriter(sink)
+            for rows in _chunks(session, export_statement(query.state), chunk_size):
+                writer.write(rows)
+                yield sink.drain()
+            writer.close()
+            yield sink.drain()
+        else:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_COLUMNS)
+            for rows in _chunks(session, export_statement(query.state), chunk_size):
+                writer.writerows(rows)
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue().encode()
+    finally:
+        session.close()
+
+def export_filename(query: ExportQuery) -> str:
+    return f"owners_properties{'_' + query.state if query.state else ''}.{query.format}"
+
+
+def export_files(out_dir: str, format: str = "csv", state: Optional[str] = None,
+                 chunk_size: int = EXPORT_CHUNK_SIZE) -> Dict[str, int]:
+    """Write the export under out_dir as one file per state (out_dir/state=CA/part-0.csv).
+
+    Rows are buffered per state and written chunk_size at a time, so memory is bounded by
+    the number of states, not rows. Returns the row count per state.
+    """
+    if format not in EXPORT_MIMETYPES:
+        raise ValueError(f"format must be one of: {', '.join(EXPORT_MIMETYPES)}")
+
+    writers, buffers, counts = {}, {}, {}
+
+    def flush(partition: str):
+        if partition not in writers:
+            directory = os.path.join(out_dir, f"state={partition}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"part-0.{format}")
+            writers[partition] = _ParquetWriter(path) if format == "parquet" else _CsvWriter(open(path, "w", newline=""))
+        rows = buffers.pop(partition)
+        writers[partition].write(rows)
+        counts[partition] = counts.get(partition, 0) + len(rows)
+
+    session = Session()
+    try:
+        for rows in _chunks(session, export_statement(state), chunk_size):
+            for row in rows:
+                buffers.setdefault(row[STATE_INDEX] or UNKNOWN_STATE, []).append(row)
+            for partition in [partition for partition, buffered in buffers.items() if len(buffered) >= chunk_size]:
+                flush(partition)
+        for partition in list(buffers):
+            flush(partition)
+    finally:
+        session.close()
+        for writer in writers.values():
+            writer.close()
+
+    print(f"Exported {sum(counts.values())} rows in {len(counts)} state partitions to {out_dir}")
+    return counts
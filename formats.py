@@ -0,0 +1,63 @@
+import gzip
+import json
+from typing import Dict, List, Optional
+
+try:
+    import msgpack
+except ImportError:  # MessagePack responses are offered only when msgpack is installed
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # Likewise for brotli compression; gzip is always available
+    brotli = None
+
+JSON_MIMETYPE = "application/json"
+COLUMNS_MIMETYPE = "application/vnd.wealthmap.columns+json"
+MSGPACK_MIMETYPE = "application/x-msgpack"
+
+FORMAT_MIMETYPES = {"json": JSON_MIMETYPE, "columns": COLUMNS_MIMETYPE}
+if msgpack:
+    FORMAT_MIMETYPES["msgpack"] = MSGPACK_MIMETYPE
+
+# Bodies smaller than this aren't worth a compression pass
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 6
+
+
+def negotiate_format(args, accept_mimetypes) -> str:
+    """?format= if given, else the best match for the Accept header; "json" by default.
+
+    accept_mimetypes/accept_encodings are werkzeug Accept objects, e.g. request.accept_mimetypes.
+    """
+    requested = args.get("format")
+    if requested in FORMAT_MIMETYPES:
+        return requested
+    best = accept_mimetypes.best_match(list(FORMAT_MIMETYPES.values()), default=JSON_MIMETYPE)
+    return next(name for name, mimetype in FORMAT_MIMETYPES.items() if mimetype == best)
+
+def negotiate_encoding(accept_encodings) -> Optional[str]:
+    offered = ["br", "gzip"] if brotli else ["gzip"]
+    return accept_encodings.best_match(offered)
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # mtime=0 keeps the bytes identical across workers, as the shared strong ETag promises
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+def columns(rows, fields: List[str], **extra) -> Dict:
+    """Parallel arrays, one per field: key names appear once instead of once per record."""
+    rows = list(rows)
+    return {
+        **extra,
+        "count": len(rows),
+        "columns": {field: [getattr(row, field) for row in rows] for field in fields},
+    }
+
+def encode(format: str, payload) -> tuple:
+    """(body, mimetype) of a columnar payload in the "columns" or "msgpack" format."""
+    if format == "msgpack":
+        return msgpack.packb(payload), MSGPACK_MIMETYPE
+    return json.dumps(payload, separators=(",", ":"), sort_keys=True).encode(), COLUMNS_MIMETYPE
@@ -0,0 +1,188 @@
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import Integer, String, column, or_, select, update, values
+from db import Session, Owner, OwnerProperty, bump_data_version
+
+# Households: owners linked by a shared mailing address (after normalization) or a
+# co-owned property, transitively. Wealth estimates split an owner's portfolio across its
+# household. assign_households regroups everyone in one union-find pass; between those
+# runs, merge_households folds the ETL's new owners and links in. It only ever merges:
+# an owner who moved or sold out of a household stays in it until the next full pass.
+
+# A mailing address shared by more owners than this is a registered agent or management
+# company, not a household, and links nobody
+MAX_ADDRESS_OWNERS = int(os.getenv("HOUSEHOLD_MAX_ADDRESS_OWNERS", 50))
+WRITE_CHUNK_SIZE = 10000
+
+# USPS abbreviations, so "12 Oak Avenue, Apt. 4" and "12 OAK AVE #4" match
+ADDRESS_ABBREVIATIONS = {
+    "STREET": "ST", "AVENUE": "AVE", "ROAD": "RD", "DRIVE": "DR", "BOULEVARD": "BLVD", "LANE": "LN",
+    "COURT": "CT", "PLACE": "PL", "TERRACE": "TER", "CIRCLE": "CIR", "HIGHWAY": "HWY", "PARKWAY": "PKWY",
+    "NORTH": "N", "SOUTH": "S", "EAST": "E", "WEST": "W",
+    "NORTHEAST": "NE", "NORTHWEST": "NW", "SOUTHEAST": "SE", "SOUTHWEST": "SW",
+    "APARTMENT": "#", "APT": "#", "UNIT": "#", "SUITE": "#", "STE": "#",
+}
+
+
+def normalize_address(address: Optional[str]) -> Optional[str]:
+    """Uppercased, punctuation-free, abbreviated form of a mailing address; None if blank."""
+    text = re.sub(r"[^A-Z0-9#]+", " ", (address or "").upper()).replace("#", " # ")
+    text = re.sub(r"\bP O BOX\b|\bPOST OFFICE BOX\b", "PO BOX", " ".join(text.split()))
+    return " ".join(ADDRESS_ABBREVIATIONS.get(token, token) for token in text.split()) or None
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1; path halving plus union by size keeps each operation near O(1)."""
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, a: int, b: int):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def link(self, members: List[int]):
+        for member in members[1:]:
+            self.union(members[0], member)
+
+
+def _link_addresses(sets: UnionFind, members: Iterable[Tuple[Optional[str], int]]):
+    """Union the members, (address key, index) pairs, that share an address key."""
+    by_address = {}
+    for key, i in members:
+        if key:
+            by_address.setdefault(key, []).append(i)
+    for group in by_address.values():
+        if len(group) <= MAX_ADDRESS_OWNERS:
+            sets.link(group)
+
+def _write_households(session, rows: List[tuple]):
+    """rows: (owner id, address key, household id, household size)."""
+    for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+        # UPDATE ... FROM (VALUES ...), as in wealth_batch.write_estimates
+        batch = values(
+            column("id", String), column("address_key", String),
+            column("household_id", String), column("household_size", Integer),
+            name="households",
+        ).data(rows[start:start + WRITE_CHUNK_SIZE])
+        session.execute(
+            update(Owner)
+            .where(Owner.id == batch.c.id)
+            .values(address_key=batch.c.address_key, household_id=batch.c.household_id, household_size=batch.c.household_size)
+        )
+
+
+def assign_households(session) -> int:
+    """Regroup every owner in one pass over owners and owner_property; returns owners whose household changed."""
+    owners = session.execute(
+        select(Owner.id, Owner.mailing_address, Owner.address_key, Owner.household_id, Owner.household_size)
+        .order_by(Owner.id)
+    ).all()
+    position = {owner.id: i for i, owner in enumerate(owners)}
+    keys = [normalize_address(owner.mailing_address) for owner in owners]
+
+    sets = UnionFind(len(owners))
+    _link_addresses(sets, zip(keys, range(len(owners))))
+    first_owner = {}
+    for owner_id, property_id in session.execute(select(OwnerProperty.owner_id, OwnerProperty.property_id)):
+        sets.union(first_owner.setdefault(property_id, position[owner_id]), position[owner_id])
+
+    # Owners are in id order, so the first member seen has the household's smallest id
+    household_ids = {}
+    rows = []
+    for i, owner in enumerate(owners):
+        root = sets.find(i)
+        household = (household_ids.setdefault(root, owner.id), sets.size[root])
+        if (keys[i], *household) != (owner.address_key, owner.household_id, owner.household_size):
+            rows.append((owner.id, keys[i], *household))
+    _write_households(session, rows)
+    return len(rows)
+
+def merge_households(session, owner_ids: Iterable[str]) -> Dict[str, int]:
+    """Fold these owners' addresses and property links into the stored households.
+
+    Returns the household size of each of these owners and of everyone whose household grew.
+    """
+    owner_ids = set(owner_ids)
+    if not owner_ids:
+        return {}
+    properties = select(OwnerProperty.property_id).where(OwnerProperty.owner_id.in_(owner_ids))
+    keys = {
+        owner.id: owner.address_key or normalize_address(owner.mailing_address)
+        for owner in session.execute(
+            select(Owner.id, Owner.mailing_address, Owner.address_key).where(Owner.id.in_(owner_ids))
+        )
+    }
+    # Everyone these owners could join: the same address, or co-owners of their properties
+    neighbours = session.execute(
+        select(Owner.id, Owner.address_key, Owner.household_id).where(or_(
+            Owner.id.in_(owner_ids),
+            Owner.address_key.in_({key for key in keys.values() if key}),
+            Owner.id.in_(select(OwnerProperty.owner_id).where(OwnerProperty.property_id.in_(properties))),
+        ))
+    ).all()
+    co_owners = session.execute(
+        select(OwnerProperty.property_id, OwnerProperty.owner_id).where(OwnerProperty.property_id.in_(properties))
+    ).all()
+
+    # Union-find over the households involved, each named by its household id; an owner
+    # without a household yet stands for itself
+    household_of = {owner.id: owner.household_id or owner.id for owner in neighbours}
+    nodes = sorted(set(household_of.values()))
+    index = {node: i for i, node in enumerate(nodes)}
+    sets = UnionFind(len(nodes))
+    _link_addresses(sets, (
+        (keys.get(owner.id, owner.address_key), index[household_of[owner.id]]) for owner in neighbours
+    ))
+    by_property = {}
+    for property_id, owner_id in co_owners:
+        by_property.setdefault(property_id, []).append(index[household_of[owner_id]])
+    for members in by_property.values():
+        sets.link(members)
+
+    # Every member of those households, including the ones no link above touched
+    members = session.execute(
+        select(Owner.id, Owner.address_key, Owner.household_id, Owner.household_size)
+        .where(or_(Owner.household_id.in_(nodes), Owner.id.in_(nodes)))
+    ).all()
+    households = {}
+    for member in members:
+        node = member.household_id if member.household_id in index else member.id
+        households.setdefault(sets.find(index[node]), []).append(member)
+
+    sizes, rows = {}, []
+    for group in households.values():
+        household = (min(member.id for member in group), len(group))
+        for member in group:
+            key = keys.get(member.id, member.address_key)
+            if (key, *household) != (member.address_key, member.household_id, member.household_size):
+                rows.append((member.id, key, *household))
+            if member.id in owner_ids or member.household_size != household[1]:
+                sizes[member.id] = household[1]
+    # Sorted so concurrent writers lock owners in the same order
+    _write_households(session, sorted(rows))
+    return sizes
+
+def rebuild_households():
+    session = Session()
+    try:
+        changed = assign_households(session)
+        bump_data_version(session)
+        session.commit()
+        print(f"Households rebuilt; {changed} owners regrouped.")
+    finally:
+        session.close()
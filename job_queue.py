@@ -0,0 +1,270 @@
+import os
+import time
+import socket
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from sqlalchemy import and_, case, func, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from db import Session, EtlJob, Owner, OwnerProperty, Property, engine
+from attom_client import get_properties_page, ATTOM_WORKERS
+from etl import fetch_changed, write_batch, recompute_wealth, publish_data_version
+from delta_sync import listing_modified, load_syncs, plan_fetches
+
+PAGE_SIZE = 100
+CLAIM_BATCH_SIZE = 100
+LEASE_SECONDS = int(os.getenv("ETL_LEASE_SECONDS", 300))
+# Leases are extended this often while a batch runs, so a slow batch (all workers share one
+# ATTOM rate limit) is never re-claimed by another worker mid-run
+LEASE_RENEW_SECONDS = LEASE_SECONDS / 3
+MAX_ATTEMPTS = int(os.getenv("ETL_MAX_ATTEMPTS", 5))
+IDLE_POLL_SECONDS = 2.0
+
+
+def enqueue_zip(zipcode: str, propertytype: str, refresh: bool = False):
+    """Queue the first listing page; each page job queues its properties and the next page.
+
+    refresh re-runs the ZIP's finished listing pages, which re-queue the properties that
+    delta sync finds stale or changed.
+    """
+    session = Session()
+    try:
+        if refresh:
+            session.query(EtlJob).filter(
+                EtlJob.kind == "page", EtlJob.zipcode == zipcode, EtlJob.propertytype == propertytype,
+                EtlJob.state.in_(["done", "failed"]),
+            ).update({"state": "pending", "attempts": 0}, synchronize_session=False)
+        _enqueue(session, [{"kind": "page", "zipcode": zipcode, "propertytype": propertytype, "page": 1}])
+        session.commit()
+    finally:
+        session.close()
+
+def _enqueue(session, jobs: List[dict], rerun: bool = False):
+    if not jobs:
+        return
+    stmt = insert(EtlJob).values(jobs)
+    if rerun:
+        # Finished jobs run again; pending and running ones already will
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_etl_job",
+            set_={"state": "pending", "attempts": 0, "listing_modified": stmt.excluded.listing_modified},
+            where=EtlJob.state.in_(["done", "failed"]),
+        )
+    else:
+        # Already-known jobs keep their state, so re-enqueueing a ZIP resumes it rather than restarting
+        stmt = stmt.on_conflict_do_nothing(constraint="uq_etl_job")
+    session.execute(stmt)
+
+def claim(session, worker: str, limit: int = CLAIM_BATCH_SIZE) -> List[EtlJob]:
+    """Lease up to `limit` runnable jobs; SKIP LOCKED lets concurrent workers claim disjoint sets."""
+    now = datetime.utcnow()
+    jobs = session.execute(
+        select(EtlJob)
+        .where(
+            EtlJob.attempts < MAX_ATTEMPTS,
+            or_(
+                EtlJob.state == "pending",
+                and_(EtlJob.state == "running", EtlJob.lease_expires_at < now),  # worker died mid-job
+            ),
+        )
+        .order_by(EtlJob.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        # _finish updates rows in bulk, so jobs this session claimed before are stale in memory
+        .execution_options(populate_existing=True)
+    ).scalars().all()
+
+    for job in jobs:
+        job.state = "running"
+        job.worker = worker
+        job.attempts += 1
+        job.lease_expires_at = now + timedelta(seconds=LEASE_SECONDS)
+    session.commit()
+    return jobs
+
+def _owned(jobs: List[EtlJob]):
+    """Filter for the jobs' rows that are still running under the lease this worker took."""
+    return and_(tuple_(EtlJob.id, EtlJob.worker).in_([(job.id, job.worker) for job in jobs]), EtlJob.state == "running")
+
+def _finish(session, jobs: List[EtlJob], error: str = None):
+    # A job whose lease expired and was re-claimed now belongs to the other worker; leave it be
+    if jobs:
+        if error is None:
+            changes = {"state": "done"}
+        else:
+            changes = {"state": case((EtlJob.attempts < MAX_ATTEMPTS, "pending"), else_="failed"), "last_error": error}
+        session.execute(
+            update(EtlJob).where(_owned(jobs)).values(lease_expires_at=None, **changes)
+            .execution_options(synchronize_session=False)
+        )
+    session.commit()
+
+
+class _LeaseRenewal:
+    """Extends the leases on a claimed batch every LEASE_RENEW_SECONDS until the batch is done."""
+
+    def __init__(self, jobs: List[EtlJob]):
+        self.jobs = jobs
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(LEASE_RENEW_SECONDS):
+            session = Session()
+            try:
+                session.execute(
+                    update(EtlJob).where(_owned(self.jobs))
+                    .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS))
+                )
+                session.commit()
+            except Exception as e:
+                print(f"Lease renewal failed: {e}")
+            finally:
+                session.close()
+
+def _run_page_job(session, job: EtlJob):
+    properties, total = get_properties_page(job.zipcode, job.propertytype, job.page, PAGE_SIZE)
+    if properties is None:
+        _finish(session, [job], error="listing page fetch failed")
+        return
+
+    listing = {
+        p["identifier"]["attomId"]: listing_modified(p)
+        for p in properties if p.get("identifier", {}).get("attomId")
+    }
+    # Only properties delta sync finds stale or changed are (re)queued
+    stale = plan_fetches(load_syncs(session, listing), listing)
+    property_jobs = [
+        {"kind": "property", "zipcode": job.zipcode, "propertytype": job.propertytype, "attom_id": attom_id,
+         "listing_modified": listing[attom_id]}
+        for attom_id in sorted(stale)
+    ]
+    next_page = []
+    if job.page * PAGE_SIZE < total:
+        next_page.append({"kind": "page", "zipcode": job.zipcode, "propertytype": job.propertytype, "page": job.page + 1})
+
+    # Queueing the follow-ups and completing the page commit together: the checkpoint
+    _enqueue(session, property_jobs, rerun=True)
+    _enqueue(session, next_page)
+    _finish(session, [job])
+
+def _run_property_jobs(session, jobs: List[EtlJob], pool: ThreadPoolExecutor):
+    records = fetch_changed(session, {job.attom_id: (job.propertytype, job.listing_modified) for job in jobs}, pool)
+    fetched = [(job, records[job.attom_id]) for job in jobs if records.get(job.attom_id)]
+    missing = [job for job in jobs if job.attom_id in records and not records[job.attom_id]]
+    # Fresh or unchanged properties: nothing to write
+    synced = [job for job in jobs if job.attom_id not in records]
+
+    write_session = Session()
+    try:
+        linked, dirty = write_batch(write_session, [record for _, record in fetched])
+    except Exception as e:
+        write_session.rollback()
+        _finish(session, jobs, error=f"write failed: {e}")
+        return
+    finally:
+        write_session.close()
+
+    # An earlier attempt may have written these properties and died before re-estimating
+    # their owners; delta sync now finds them unchanged, so their owners are checked here
+    retried = [job.attom_id for job in jobs if job.attempts > 1]
+    if retried:
+        dirty = {**_linked_owners(session, retried), **dirty}
+    # Before finishing: a job must not be done while its owners' estimates are outstanding
+    recompute_wealth(dirty)
+    _finish(session, [job for job, _ in fetched] + synced)
+    _finish(session, missing, error="no owner or financial data")
+
+def _linked_owners(session, attom_ids: List[int]) -> Dict[str, int]:
+    """The owners of these properties, mapped to their household size."""
+    rows = session.execute(
+        select(Owner.id, Owner.household_size)
+        .join(OwnerProperty, OwnerProperty.owner_id == Owner.id)
+        .join(Property, Property.id == OwnerProperty.property_id)
+        .where(Property.attom_id.in_(attom_ids))
+    ).all()
+    return dict(rows)
+
+def work(worker: str = None, exit_when_idle: bool = True):
+    """Claim and run jobs until the queue is drained (or forever, with exit_when_idle=False)."""
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    # Claimed jobs stay readable after each checkpoint commit without a reload per row
+    session = Session(expire_on_commit=False)
+    try:
+        with ThreadPoolExecutor(max_workers=ATTOM_WORKERS) as pool:
+            while True:
+                jobs = claim(session, worker)
+                if not jobs:
+                    if exit_when_idle and not _has_open_jobs(session):
+                        break
+                    time.sleep(IDLE_POLL_SECONDS)
+                    continue
+
+                with _LeaseRenewal(jobs):
+                    for job in [job for job in jobs if job.kind == "page"]:
+                        try:
+                            _run_page_job(session, job)
+                        except Exception as e:
+                            session.rollback()
+                            _finish(session, [job], error=str(e))
+
+                    property_jobs = [job for job in jobs if job.kind == "property"]
+                    if property_jobs:
+                        try:
+                            _run_property_jobs(session, property_jobs, pool)
+                            print(f"[{worker}] finished {len(property_jobs)} property jobs")
+                        except Exception as e:
+                            # Jobs already finished stay finished; the rest go back to the queue
+                            session.rollback()
+                            _finish(session, property_jobs, error=str(e))
+    finally:
+        session.close()
+
+def _has_open_jobs(session) -> bool:
+    return session.query(EtlJob.id).filter(
+        EtlJob.state.in_(["pending", "running"]), EtlJob.attempts < MAX_ATTEMPTS
+    ).first() is not None
+
+def _worker_main(index: int):
+    # Connections inherited from the parent process must not be shared with it
+    engine.dispose(close=False)
+    work(f"{socket.gethostname()}:{os.getpid()}:{index}")
+
+def run_workers(processes: int = 4):
+    workers = [multiprocessing.Process(target=_worker_main, args=(i,)) for i in range(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    publish_data_version()
+
+def job_counts() -> dict:
+    session = Session()
+    try:
+        return {
+            (kind, state): count
+            for kind, state, count in session.query(EtlJob.kind, EtlJob.state, func.count()).group_by(EtlJob.kind, EtlJob.state)
+        }
+    finally:
+        session.close()
+
+def requeue_failed():
+    session = Session()
+    try:
+        updated = session.query(EtlJob).filter(
+            or_(EtlJob.state == "failed", EtlJob.attempts >= MAX_ATTEMPTS), EtlJob.state != "done"
+        ).update({"state": "pending", "attempts": 0}, synchronize_session=False)
+        session.commit()
+        print(f"Requeued {updated} failed jobs.")
+    finally:
+        session.close()
@@ -0,0 +1,255 @@
+import os
+import time
+import queue
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from db import Session, PropertySync
+from attom_client import get_properties_page, ATTOM_WORKERS
+from etl import fetch_attom_payloads, build_record, write_batch, recompute_wealth
+from delta_sync import listing_modified, load_syncs, plan_fetches, unchanged, mark_synced
+
+# The ETL as a pipeline of stages joined by bounded queues:
+#   list -> fetch -> transform -> write -> wealth
+# A full queue blocks the stage feeding it (backpressure), so a slow stage throttles the
+# ones upstream instead of piling up work in memory, while ATTOM calls and DB writes overlap.
+# Each stage's worker count is configurable; the stats printed at the end of a run show
+# which stage is the bottleneck (busy most of the time while the others wait on it).
+
+PIPELINE_WORKERS = {
+    "list": int(os.getenv("ETL_LIST_WORKERS", 2)),
+    "fetch": int(os.getenv("ETL_FETCH_WORKERS", ATTOM_WORKERS)),
+    "transform": int(os.getenv("ETL_TRANSFORM_WORKERS", 1)),
+    "write": int(os.getenv("ETL_WRITE_WORKERS", 1)),
+    "wealth": int(os.getenv("ETL_WEALTH_WORKERS", 2)),
+}
+# Items each stage's input queue holds before the stage feeding it blocks
+PIPELINE_QUEUE_SIZE = int(os.getenv("ETL_QUEUE_SIZE", 500))
+LISTING_PAGE_SIZE = 100
+
+_DONE = object()
+
+
+class Stage:
+    """One step of a Pipeline: process(item, emit) run by `workers` threads.
+
+    With batch_size, process receives lists of up to batch_size items instead; the last
+    partial batch is flushed when the input runs out.
+    """
+
+    def __init__(self, name: str, process: Callable, workers: int = 1, batch_size: Optional[int] = None):
+        self.name = name
+        self.process = process
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.inbox = None
+        self.outbox = None
+        self._lock = threading.Lock()
+        self._running = self.workers
+        self.stats = Counter()
+
+    def _count(self, **amounts):
+        with self._lock:
+            self.stats.update(amounts)
+
+    def _emit(self, item):
+        if self.outbox is None:
+            return
+        started = time.monotonic()
+        self.outbox.inbox.put(item)
+        self._count(emitted=1, blocked=time.monotonic() - started)
+
+    def _run(self, batch: list):
+        started = time.monotonic()
+        try:
+            self.process(batch if self.batch_size else batch[0], self._emit)
+        except Exception as e:
+            print(f"Error in {self.name} stage: {e}")
+            self._count(errors=len(batch))
+        self._count(items=len(batch), busy=time.monotonic() - started)
+
+    def _work(self):
+        batch = []
+        while True:
+            started = time.monotonic()
+            depth = self.inbox.qsize()
+            item = self.inbox.get()
+            self._count(starved=time.monotonic() - started, depth_samples=1, depth_total=depth)
+            with self._lock:
+                self.stats["depth_max"] = max(self.stats["depth_max"], depth)
+
+            if item is _DONE:
+                break
+            batch.append(item)
+            if not self.batch_size or len(batch) >= self.batch_size:
+                self._run(batch)
+                batch = []
+
+        if batch:
+            self._run(batch)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        # The last worker out tells every worker of the next stage that the input is done
+        if last and self.outbox is not None:
+            for _ in range(self.outbox.workers):
+                self.outbox.inbox.put(_DONE)
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        for stage, following in zip(stages, stages[1:] + [None]):
+            stage.inbox = queue.Queue(maxsize=queue_size)
+            stage.outbox = following
+        self.queue_size = queue_size
+        self.elapsed = 0.0
+
+    def run(self, items: Iterable) -> "Pipeline":
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=stage._work, name=f"{stage.name}-{index}", daemon=True)
+            for stage in self.stages
+            for index in range(stage.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        first = self.stages[0]
+        for item in items:
+            first.inbox.put(item)
+        for _ in range(first.workers):
+            first.inbox.put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.monotonic() - started
+        return self
+
+    def report(self):
+        elapsed = self.elapsed or 1e-9
+        print(f"Pipeline finished in {elapsed:.1f}s (queue size {self.queue_size})")
+        print(f"{'stage':<10} {'workers':>7} {'items':>7} {'out':>7} {'errors':>6} {'items/s':>8} "
+              f"{'busy':>5} {'idle':>5} {'blocked':>7} {'queue avg/max':>14}")
+        for stage in self.stages:
+            stats = stage.stats
+            capacity = stage.workers * elapsed
+            depth_avg = stats["depth_total"] / stats["depth_samples"] if stats["depth_samples"] else 0
+            print(
+                f"{stage.name:<10} {stage.workers:>7} {stats['items']:>7} {stats['emitted']:>7} {stats['errors']:>6} "
+                f"{stats['items'] / elapsed:>8.1f} {stats['busy'] / capacity:>5.0%} {stats['starved'] / capacity:>5.0%} "
+                f"{stats['blocked'] / capacity:>7.0%} {depth_avg:>7.1f}/{stats['depth_max']:<6}"
+            )
+
+        bottleneck = max(self.stages, key=lambda stage: stage.stats["busy"] / stage.workers)
+        print(f"Busiest stage: {bottleneck.name} ({bottleneck.stats['busy'] / (bottleneck.workers * elapsed):.0%} busy)")
+
+    def stats(self) -> Dict[str, dict]:
+        return {stage.name: {"workers": stage.workers, **stage.stats} for stage in self.stages}
+
+
+class Target(NamedTuple):
+    """A listed property that delta sync says needs fetching."""
+    attom_id: int
+    propertytype: str
+    listing_modified: Optional[str]
+    fetch_owners: bool
+    sync: Optional[PropertySync]
+
+
+def etl_pipeline(batch_size: int = 100, workers: Optional[Dict[str, int]] = None) -> Tuple[Pipeline, Counter]:
+    """The ETL stages, fed (zipcode, propertytype, limit) listing jobs, and their delta sync counts."""
+    workers = {**PIPELINE_WORKERS, **(workers or {})}
+    delta = Counter()
+    delta_lock = threading.Lock()
+
+    def list_zip(job: Tuple[str, str, Optional[int]], emit):
+        zipcode, propertytype, limit = job
+        page, listed = 1, 0
+        while limit is None or listed < limit:
+            properties, total = get_properties_page(zipcode, propertytype, page, LISTING_PAGE_SIZE)
+            if not properties:
+                if properties is None:
+                    print(f"Listing page {page} for {zipcode} [{propertytype}] failed")
+                break
+            if limit is not None:
+                properties = properties[:limit - listed]
+            listed += len(properties)
+
+            listing = {
+                p["identifier"]["attomId"]: listing_modified(p)
+                for p in properties if p.get("identifier", {}).get("attomId")
+            }
+            session = Session()
+            try:
+                syncs = load_syncs(session, listing)
+            finally:
+                session.close()
+            plans = plan_fetches(syncs, listing)
+            with delta_lock:
+                delta.update(listed=len(listing), fresh=len(listing) - len(plans))
+            for attom_id in sorted(plans):
+                emit(Target(attom_id, propertytype, listing[attom_id], plans[attom_id], syncs.get(attom_id)))
+
+            if page * LISTING_PAGE_SIZE >= total:
+                break
+            page += 1
+        print(f"Listed {listed} properties in {zipcode} [{propertytype}]")
+
+    def fetch(target: Target, emit):
+        # Targets are planned by delta sync, so the payload cache must not answer for them
+        payloads = fetch_attom_payloads(target.attom_id, target.fetch_owners, fresh=True)
+        if payloads:
+            emit((target, payloads))
+
+    def transform(fetched: Tuple[Target, Tuple[dict, dict]], emit):
+        target, (owner_data, financial_data) = fetched
+        record = build_record(target.attom_id, target.propertytype, owner_data, financial_data, target.fetch_owners)
+        record["listing_modified"] = target.listing_modified
+        emit((record, unchanged(record, target.sync)))
+
+    def write(batch: List[Tuple[dict, bool]], emit):
+        records = [record for record, same in batch if not same]
+        same = [record for record, same in batch if same]
+        session = Session()
+        try:
+            _, dirty = write_batch(session, records)
+            # Unchanged records are only marked as synced
+            mark_synced(session, same)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        with delta_lock:
+            delta.update(unchanged=len(same))
+        print(f"Wrote batch of {len(records)} properties ({len(same)} unchanged)")
+        if dirty:
+            emit(dirty)
+
+    def wealth(dirty: Dict[str, int], emit):
+        recompute_wealth(dirty)
+
+    pipeline = Pipeline([
+        Stage("list", list_zip, workers["list"]),
+        Stage("fetch", fetch, workers["fetch"]),
+        Stage("transform", transform, workers["transform"]),
+        Stage("write", write, workers["write"], batch_size=batch_size),
+        Stage("wealth", wealth, workers["wealth"]),
+    ])
+    return pipeline, delta
+
+def run_pipeline(jobs: Iterable[Tuple[str, str]], limit: Optional[int] = None, batch_size: int = 100,
+                 workers: Optional[Dict[str, int]] = None) -> Dict[str, dict]:
+    """Run the ETL for (zipcode, propertytype) pairs, at most limit listed properties each.
+
+    Prints per-stage stats and returns them.
+    """
+    pipeline, delta = etl_pipeline(batch_size=batch_size, workers=workers)
+    pipeline.run((zipcode, propertytype, limit) for zipcode, propertytype in jobs)
+
+    print(f"Delta sync: {delta['fresh']} fresh, {delta['unchanged']} unchanged of {delta['listed']} properties")
+    pipeline.report()
+    return pipeline.stats()
@@ -0,0 +1,475 @@
+import math
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy import Select, and_, case, func, or_, select, tuple_
+from sqlalchemy.orm import selectinload
+from db import Owner, Property, OwnerProperty, OwnerPortfolio, PropertyReadModel, TileAggregate, StatsRollup, StatsHistogram
+from tiles import TILE_ZOOM, parse_bbox, bbox_filter, covering_quadkeys, quadkey_range
+from wealth_estimator import estimate_property_value
+from stats_rollups import DIMENSIONS, bucket_bounds, histogram_percentiles
+
+# Statements and serializers behind the API routes, shared by the Flask app (app.py)
+# and the ASGI app (asgi.py). Invalid parameters raise ValueError; routes answer 400.
+
+PROPERTY_IMAGE = "https://images.pexels.com/photos/1029599/pexels-photo-1029599.jpeg"
+
+MAX_PAGE_SIZE = 10000
+DEFAULT_OWNER_PAGE_SIZE = 100
+
+# ?sort= values; each has a (column, property_id) index on property_read_model
+SORT_COLUMNS = {
+    "value": PropertyReadModel.display_value,
+    "size": PropertyReadModel.size,
+    "year_built": PropertyReadModel.year_built,
+}
+
+OWNER_SORT_COLUMNS = {
+    "net_worth": Owner.estimated_net_worth,
+    "total_value": OwnerPortfolio.total_value,
+    "property_count": OwnerPortfolio.property_count,
+}
+# ?confidence= values, as wealth_estimator assigns them
+CONFIDENCE_LEVELS = ["high", "medium", "low"]
+
+# Fields of the columnar formats (?format=columns|msgpack, or by Accept); select them with ?fields=
+COLUMN_FIELDS = {
+    "id": PropertyReadModel.property_id,
+    "address": PropertyReadModel.site_address,
+    "city": PropertyReadModel.city,
+    "state": PropertyReadModel.state,
+    "zip_code": PropertyReadModel.zip_code,
+    "propertytype": PropertyReadModel.propertytype,
+    "year_built": PropertyReadModel.year_built,
+    "value": PropertyReadModel.display_value,
+    "size": PropertyReadModel.size,
+    "lat": PropertyReadModel.latitude,
+    "lng": PropertyReadModel.longitude,
+    "owners": PropertyReadModel.owners,
+}
+
+# Cluster cells are this many zoom levels finer than the map, i.e. 4x4 cells per map tile
+CLUSTER_ZOOM_OFFSET = 2
+
+# Trigram matching needs a few characters to be selective
+MIN_SEARCH_LENGTH = 3
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+
+STATS_PERCENTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def arg(args, name: str, type=str, default=None) -> Any:
+    """args.get(name, default) parsed as type, for any query-string mapping.
+
+    A value that doesn't parse (or a non-finite float) is a ValueError, i.e. a 400, rather
+    than silently dropping the filter it was meant for.
+    """
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        value = type(value)
+        if type is float and not math.isfinite(value):
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be {'an integer' if type is int else 'a number'}") from None
+    return value
+
+def _positive_limit(limit: Optional[int], maximum: int) -> Optional[int]:
+    if limit is not None and limit <= 0:
+        raise ValueError("limit must be positive")
+    return min(limit, maximum) if limit is not None else None
+
+class Page(NamedTuple):
+    """A filtered statement paged by keyset: ordered by keys, the last of them a unique id."""
+    statement: Select
+    keys: List
+    order: str
+    after: Optional[str]
+    limit: Optional[int]
+
+    def cursor_statement(self) -> Select:
+        """The sort keys of the ?after= row; no row means the cursor is unknown."""
+        return self.statement.with_only_columns(*self.keys).where(self.keys[-1] == self.after)
+
+    def rows_statement(self, cursor: Optional[tuple] = None) -> Select:
+        statement = self.statement
+        if cursor is not None:
+            position = tuple_(*self.keys) < tuple(cursor) if self.order == "desc" else tuple_(*self.keys) > tuple(cursor)
+            statement = statement.where(position)
+        statement = statement.order_by(*[key.desc() if self.order == "desc" else key for key in self.keys])
+        if self.limit is not None:
+            statement = statement.limit(self.limit)
+        return statement
+
+class PropertyQuery(NamedTuple):
+    """Validated /properties parameters."""
+    bbox: Optional[tuple]
+    filters: Dict[str, str]  # state, zip_code and propertytype equality filters
+    min_value: Optional[float]
+    max_value: Optional[float]
+    sort: Optional[str]
+    order: str
+    after: Optional[str]
+    limit: Optional[int]
+
+def property_query(args) -> PropertyQuery:
+    bbox = parse_bbox(args["bbox"]) if args.get("bbox") else None
+    filters = {
+        column: args[param]
+        for param, column in (("state", "state"), ("zip", "zip_code"), ("propertytype", "propertytype"))
+        if args.get(param)
+    }
+
+    sort = args.get("sort")
+    if sort is not None and sort not in SORT_COLUMNS:
+        raise ValueError(f"sort must be one of: {', '.join(SORT_COLUMNS)}")
+    # Sorted results default to largest first, i.e. top-K
+    order = args.get("order", "desc" if sort else "asc")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+
+    # Keyset pagination: ?after=<last id of previous page>&limit=
+    limit = _positive_limit(arg(args, "limit", int), MAX_PAGE_SIZE)
+    return PropertyQuery(
+        bbox, filters, arg(args, "min_value", float), arg(args, "max_value", float), sort, order, args.get("after"), limit,
+    )
+
+def properties_page(query: PropertyQuery) -> Page:
+    # A single-table scan: owners and display value are denormalized by the ETL
+    statement = select(PropertyReadModel)
+
+    if query.bbox:
+        statement = statement.where(bbox_filter(
+            PropertyReadModel.tile_key, PropertyReadModel.latitude, PropertyReadModel.longitude, query.bbox
+        ))
+    for column, value in query.filters.items():
+        statement = statement.where(getattr(PropertyReadModel, column) == value)
+    if query.min_value is not None:
+        statement = statement.where(PropertyReadModel.display_value >= query.min_value)
+    if query.max_value is not None:
+        statement = statement.where(PropertyReadModel.display_value <= query.max_value)
+
+    keys = [PropertyReadModel.property_id]
+    if query.sort:
+        # Properties with no value for the sort field are left out of sorted results
+        keys.insert(0, SORT_COLUMNS[query.sort])
+        statement = statement.where(SORT_COLUMNS[query.sort].isnot(None))
+
+    return Page(statement, keys, query.order, query.after, query.limit)
+
+def column_fields(args) -> List[str]:
+    fields = args.get("fields", ",".join(COLUMN_FIELDS)).split(",")
+    unknown = [field for field in fields if field not in COLUMN_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return fields
+
+def project_columns(statement: Select, fields: List[str]) -> Select:
+    # Only the projected columns are read; the cursor always needs the id
+    return statement.with_only_columns(
+        *[COLUMN_FIELDS[field].label(field) for field in fields], PropertyReadModel.property_id.label("cursor")
+    )
+
+def serialize_property_summary(row):
+    # Everything is precomputed in property_read_model; this only reshapes the row
+    return {
+        "id": row.property_id,
+        "address": row.site_address,
+        "city": row.city,
+        "state": row.state,
+        "zip_code": row.zip_code,
+        "value": row.display_value,
+        "size": row.size,
+        "images": [PROPERTY_IMAGE],
+        "coordinates": {
+            "lat": row.latitude,
+            "lng": row.longitude,
+        },
+        "owners": row.owners,
+    }
+
+def clusters_statement(args) -> Select:
+    zoom = arg(args, "zoom", int)
+    if zoom is None or not args.get("bbox"):
+        raise ValueError("zoom and bbox are required")
+    bbox = parse_bbox(args["bbox"])
+
+    level = min(max(zoom + CLUSTER_ZOOM_OFFSET, 0), TILE_ZOOM)
+    ranges = [quadkey_range(key) for key in covering_quadkeys(bbox, max_zoom=level)]
+    return select(TileAggregate).where(
+        TileAggregate.zoom == level,
+        TileAggregate.property_count > 0,
+        or_(*[and_(TileAggregate.tile_key >= low, TileAggregate.tile_key < high) for low, high in ranges]),
+    )
+
+def serialize_cluster(cell):
+    return {
+        "tile": cell.tile_key,
+        "zoom": cell.zoom,
+        "count": cell.property_count,
+        "centroid": {
+            "lat": cell.latitude_sum / cell.property_count,
+            "lng": cell.longitude_sum / cell.property_count,
+        },
+        "total_value": cell.value_sum,
+        "max_value": cell.value_max,
+    }
+
+def stats_statements(args) -> Tuple[Select, Select]:
+    """(rollup statement, histogram statement) for ?group_by=, optionally one ?key= of it."""
+    dimension = args.get("group_by")
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"group_by must be one of: {', '.join(DIMENSIONS)}")
+    rollups = select(StatsRollup).where(
+        StatsRollup.dimension == dimension,
+        or_(StatsRollup.property_count > 0, StatsRollup.owner_count > 0),
+    ).order_by(StatsRollup.group_key)
+    histograms = select(StatsHistogram).where(StatsHistogram.dimension == dimension, StatsHistogram.count > 0)
+    if args.get("key"):
+        rollups = rollups.where(StatsRollup.group_key == args["key"])
+        histograms = histograms.where(StatsHistogram.group_key == args["key"])
+    return rollups, histograms
+
+def _percentiles(counts: Dict[int, int]) -> Dict[str, Optional[float]]:
+    return {
+        f"p{round(quantile * 100)}": value
+        for quantile, value in histogram_percentiles(counts, STATS_PERCENTILES).items()
+    }
+
+def serialize_stats(rollups, histograms) -> list:
+    counts = {}
+    for row in histograms:
+        counts.setdefault((row.group_key, row.metric), {})[row.bucket] = row.count
+
+    results = []
+    for row in rollups:
+        values = counts.get((row.group_key, "value"), {})
+        net_worths = counts.get((row.group_key, "net_worth"), {})
+        value_percentiles = _percentiles(values)
+        net_worth_percentiles = _percentiles(net_worths)
+        results.append({
+            "group": row.group_key,
+            "property_count": row.property_count,
+            "total_value": row.value_sum,
+            "median_value": value_percentiles["p50"],
+            "value_percentiles": value_percentiles,
+            "owner_count": row.owner_count,
+            "owners_with_estimate": row.net_worth_count,
+            "total_net_worth": row.net_worth_sum,
+            "median_net_worth": net_worth_percentiles["p50"],
+            "net_worth_percentiles": net_worth_percentiles,
+            "net_worth_histogram": [
+                {"min": low, "max": high, "count": net_worths[index]}
+                for index in sorted(net_worths)
+                for low, high in [bucket_bounds(index)]
+            ],
+        })
+    return results
+
+def property_detail_statement(property_id: str) -> Select:
+    return select(Property).options(selectinload(Property.owners)).where(Property.id == property_id)
+
+def serialize_property_detail(property):
+    # Serialize the property details
+    property_data = {
+        "id": property.id,
+        "attom_id": property.attom_id,
+        "site_address": property.site_address,
+        "address_line1": property.address_line1,
+        "address_line2": property.address_line2,
+        "city": property.city,
+        "state": property.state,
+        "zip_code": property.zip_code,
+        "propertytype": property.propertytype,
+        "year_built": property.year_built,
+        "size": property.size,
+        "latitude": property.latitude,
+        "longitude": property.longitude,
+        "sale_amount": property.sale_amount,
+        "sale_date": property.sale_date,
+        "sale_type": property.sale_type,
+        "avm_value": property.avm_value,
+        "avm_low": property.avm_low,
+        "avm_high": property.avm_high,
+        "avm_score": property.avm_score,
+        "avm_last_updated": property.avm_last_updated,
+        "assessed_total_value": estimate_property_value(property),
+        "market_total_value": property.market_total_value,
+        "tax_amount": property.tax_amount,
+        "tax_year": property.tax_year,
+        "created_at": property.created_at,
+    }
+
+    # Serialize the owner details
+    owner_data = [
+        {
+            "id": owner.id,
+            "full_name": owner.full_name,
+            "mailing_address": owner.mailing_address,
+            "type": owner.type,
+            "estimated_net_worth": owner.estimated_net_worth,
+            "confidence_level": owner.confidence_level,
+            "created_at": owner.created_at,
+            "last_updated": owner.last_updated,
+        }
+        for owner in property.owners
+    ]
+
+    # Combine property and owner data
+    return {
+        "property": property_data,
+        "owners": owner_data,
+    }
+
+def owners_page(args) -> Page:
+    statement = select(Owner, OwnerPortfolio).join(OwnerPortfolio, OwnerPortfolio.owner_id == Owner.id)
+
+    if args.get("state"):
+        statement = statement.where(OwnerPortfolio.states.contains([args["state"]]))
+    if args.get("zip"):
+        statement = statement.where(OwnerPortfolio.zip_codes.contains([args["zip"]]))
+    if args.get("confidence"):
+        if args["confidence"] not in CONFIDENCE_LEVELS:
+            raise ValueError(f"confidence must be one of: {', '.join(CONFIDENCE_LEVELS)}")
+        statement = statement.where(Owner.confidence_level == args["confidence"])
+
+    sort = args.get("sort", "net_worth")
+    if sort not in OWNER_SORT_COLUMNS:
+        raise ValueError(f"sort must be one of: {', '.join(OWNER_SORT_COLUMNS)}")
+    order = args.get("order", "desc")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+
+    # Owners that were never estimated are left out of the ranking
+    statement = statement.where(OWNER_SORT_COLUMNS[sort].isnot(None))
+    limit = _positive_limit(arg(args, "limit", int, DEFAULT_OWNER_PAGE_SIZE), MAX_PAGE_SIZE)
+    return Page(statement, [OWNER_SORT_COLUMNS[sort], Owner.id], order, args.get("after"), limit)
+
+def serialize_owner_summary(owner, portfolio):
+    return {
+        "id": owner.id,
+        "full_name": owner.full_name,
+        "estimated_net_worth": owner.estimated_net_worth,
+        "confidence_level": owner.confidence_level,
+        "property_count": portfolio.property_count,
+        "total_value": portfolio.total_value,
+        "states": portfolio.states,
+        "zip_codes": portfolio.zip_codes,
+    }
+
+def empty_portfolio() -> OwnerPortfolio:
+    return OwnerPortfolio(property_count=0, total_value=0, states=[], zip_codes=[])
+
+def owner_properties_statement(owner_id: str) -> Select:
+    return (
+        select(PropertyReadModel)
+        .join(OwnerProperty, OwnerProperty.property_id == PropertyReadModel.property_id)
+        .where(OwnerProperty.owner_id == owner_id)
+        .order_by(PropertyReadModel.display_value.desc(), PropertyReadModel.property_id)
+    )
+
+def serialize_owner_detail(owner, portfolio, properties):
+    return {
+        "owner": {
+            **serialize_owner_summary(owner, portfolio),
+            "mailing_address": owner.mailing_address,
+            "type": owner.type,
+            "household_id": owner.household_id,
+            "household_size": owner.household_size,
+            "rules_triggered": owner.rules_triggered or [],
+            "created_at": owner.created_at,
+            "last_updated": owner.last_updated,
+        },
+        "properties": [
+            {
+                "id": row.property_id,
+                "address": row.site_address,
+                "city": row.city,
+                "state": row.state,
+                "zip_code": row.zip_code,
+                "propertytype": row.propertytype,
+                "value": row.display_value,
+            }
+            for row in properties
+        ],
+    }
+
+def household_statement(household_id: str) -> Select:
+    return (
+        select(Owner, OwnerPortfolio)
+        .outerjoin(OwnerPortfolio, OwnerPortfolio.owner_id == Owner.id)
+        .where(Owner.household_id == household_id)
+        .order_by(Owner.id)
+    )
+
+def serialize_household(household_id: str, rows):
+    estimates = [owner.estimated_net_worth for owner, _ in rows if owner.estimated_net_worth is not None]
+    return {
+        "id": household_id,
+        "size": len(rows),
+        "estimated_net_worth": sum(estimates) if estimates else None,
+        "mailing_addresses": sorted({owner.mailing_address for owner, _ in rows}),
+        "members": [
+            {**serialize_owner_summary(owner, portfolio or empty_portfolio()), "mailing_address": owner.mailing_address}
+            for owner, portfolio in rows
+        ],
+    }
+
+def _text_match(column, q):
+    """(filter, score) for a trigram-indexed column; prefix matches rank above fuzzy ones."""
+    pattern = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    # col %> q is word_similarity(q, col) above pg_trgm's threshold; both operators use the GIN index
+    condition = or_(column.op("%>")(q), column.ilike(pattern))
+    score = func.word_similarity(q, column) + case((column.ilike(pattern), 1.0), else_=0.0)
+    return condition, score
+
+def search_statements(args):
+    """(owner statement, property statement, limit), or None if q is too short to search."""
+    q = args.get("q", "").strip()
+    if len(q) < MIN_SEARCH_LENGTH:
+        return None
+    limit = _positive_limit(arg(args, "limit", int, DEFAULT_SEARCH_LIMIT), MAX_SEARCH_LIMIT)
+
+    name_match, name_score = _text_match(Owner.full_name, q)
+    mailing_match, mailing_score = _text_match(Owner.mailing_address, q)
+    owner_score = func.greatest(name_score, mailing_score).label("score")
+    owners = (
+        select(Owner.id, Owner.full_name, Owner.mailing_address, Owner.estimated_net_worth, owner_score)
+        .where(or_(name_match, mailing_match))
+        .order_by(owner_score.desc(), Owner.id)
+        .limit(limit)
+    )
+
+    address_match, address_score = _text_match(Property.site_address, q)
+    address_score = address_score.label("score")
+    properties = (
+        select(Property.id, Property.site_address, Property.city, Property.state, Property.zip_code, address_score)
+        .where(address_match)
+        .order_by(address_score.desc(), Property.id)
+        .limit(limit)
+    )
+    return owners, properties, limit
+
+def search_results(owners, properties, limit: int):
+    results = [
+        {
+            "type": "owner",
+            "id": row.id,
+            "label": row.full_name,
+            "detail": row.mailing_address,
+            "estimated_net_worth": row.estimated_net_worth,
+            "score": row.score,
+        }
+        for row in owners
+    ] + [
+        {
+            "type": "property",
+            "id": row.id,
+            "label": row.site_address,
+            "detail": ", ".join(part for part in (row.city, row.state, row.zip_code) if part),
+            "score": row.score,
+        }
+        for row in properties
+    ]
+    results.sort(key=lambda result: -result["score"])
+    return results[:limit]
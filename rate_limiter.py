@@ -0,0 +1,87 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+from typing import Optional
+
+# The bucket state lives in a small SQLite file so every thread and ETL worker process
+# on the machine draws from the same quota.
+RATE_LIMIT_DB = os.getenv("ATTOM_RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "attom_rate_limit.sqlite3"))
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# A 429 arriving this long after the previous pause ended starts a fresh backoff sequence
+BACKOFF_RESET = 60.0
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens/sec, shared through a SQLite file."""
+
+    def __init__(self, name: str, rate: float, burst: Optional[float] = None, path: str = RATE_LIMIT_DB):
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "name TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL, strikes INTEGER)"
+        )
+
+    def acquire(self):
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """Pause every client of this bucket after a 429, backing off exponentially."""
+        def update(now, tokens, blocked_until, strikes):
+            if now - blocked_until > BACKOFF_RESET:
+                strikes = 0
+            delay = retry_after if retry_after else min(BACKOFF_MAX, BACKOFF_BASE * 2 ** strikes)
+            return 0.0, max(blocked_until, now + delay), strikes + 1, 0.0
+
+        self._transact(update)
+
+    def _try_acquire(self) -> float:
+        def update(now, tokens, blocked_until, strikes):
+            if now < blocked_until:
+                return tokens, blocked_until, strikes, blocked_until - now
+            if tokens >= 1:
+                return tokens - 1, blocked_until, strikes, 0.0
+            return tokens, blocked_until, strikes, (1 - tokens) / self.rate
+
+        return self._transact(update)
+
+    def _transact(self, update) -> float:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute(
+                "SELECT tokens, updated, blocked_until, strikes FROM buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            tokens, updated, blocked_until, strikes = row or (self.burst, now, 0.0, 0)
+            tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+
+            tokens, blocked_until, strikes, result = update(now, tokens, blocked_until, strikes)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated, blocked_until, strikes) VALUES (?, ?, ?, ?, ?)",
+                (self.name, tokens, now, blocked_until, strikes),
+            )
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections can't cross threads or survive a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
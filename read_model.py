@@ -0,0 +1,122 @@
+from typing import Iterable
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
+from db import Session, Owner, Property, OwnerProperty, OwnerPortfolio, PropertyReadModel, bump_data_version
+from wealth_estimator import PROPERTY_VALUE_SQL
+
+REFRESH_CHUNK_SIZE = 5000
+
+_owner_summaries = func.coalesce(
+    func.jsonb_agg(aggregate_order_by(
+        func.jsonb_build_object(
+            "id", Owner.id,
+            "name", Owner.full_name,
+            "estimatedNetWorth", Owner.estimated_net_worth,
+            "confidenceLevel", Owner.confidence_level,
+        ),
+        Owner.id,
+    )).filter(Owner.id.isnot(None)),
+    literal_column("'[]'::jsonb"),
+)
+
+_source = (
+    select(
+        Property.id,
+        Property.site_address,
+        Property.city,
+        Property.state,
+        Property.zip_code,
+        Property.propertytype,
+        Property.year_built,
+        Property.size,
+        Property.latitude,
+        Property.longitude,
+        Property.tile_key,
+        PROPERTY_VALUE_SQL,
+        _owner_summaries,
+        func.now(),
+    )
+    .select_from(Property)
+    .outerjoin(OwnerProperty, OwnerProperty.property_id == Property.id)
+    .outerjoin(Owner, Owner.id == OwnerProperty.owner_id)
+    .group_by(Property.id)
+)
+
+_columns = [
+    "property_id", "site_address", "city", "state", "zip_code", "propertytype", "year_built", "size",
+    "latitude", "longitude", "tile_key", "display_value", "owners", "updated_at",
+]
+
+
+def distinct_values(column):
+    return func.coalesce(
+        func.array_agg(column.distinct()).filter(column.isnot(None)),
+        literal_column("'{}'::varchar[]"),
+    )
+
+_portfolio_source = (
+    select(
+        OwnerProperty.owner_id,
+        func.count(),
+        func.sum(PROPERTY_VALUE_SQL),
+        distinct_values(Property.state),
+        distinct_values(Property.zip_code),
+        func.now(),
+    )
+    .select_from(OwnerProperty)
+    .join(Property, Property.id == OwnerProperty.property_id)
+    .group_by(OwnerProperty.owner_id)
+)
+
+_portfolio_columns = ["owner_id", "property_count", "total_value", "states", "zip_codes", "updated_at"]
+
+
+def _upsert(session, source, model=PropertyReadModel, columns=_columns):
+    stmt = insert(model).from_select(columns, source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[getattr(model, columns[0])],
+        set_={column: stmt.excluded[column] for column in columns[1:]},
+    )
+    session.execute(stmt)
+
+def refresh_properties(session, property_ids: Iterable[str]):
+    """Rebuild the read-model rows of these properties in the caller's transaction."""
+    property_ids = sorted(set(property_ids))
+    for start in range(0, len(property_ids), REFRESH_CHUNK_SIZE):
+        _upsert(session, _source.where(Property.id.in_(property_ids[start:start + REFRESH_CHUNK_SIZE])))
+
+def refresh_owners(session, owner_ids: Iterable[str]):
+    """Rebuild the rows of every property these owners hold, e.g. after new estimates."""
+    owner_ids = sorted(set(owner_ids))
+    for start in range(0, len(owner_ids), REFRESH_CHUNK_SIZE):
+        property_ids = select(OwnerProperty.property_id).where(
+            OwnerProperty.owner_id.in_(owner_ids[start:start + REFRESH_CHUNK_SIZE])
+        )
+        _upsert(session, _source.where(Property.id.in_(property_ids)))
+
+def refresh_portfolios(session, owner_ids: Iterable[str]):
+    """Recount the property totals of these owners, e.g. after their properties changed."""
+    owner_ids = sorted(set(owner_ids))
+    for start in range(0, len(owner_ids), REFRESH_CHUNK_SIZE):
+        _upsert(
+            session,
+            _portfolio_source.where(OwnerProperty.owner_id.in_(owner_ids[start:start + REFRESH_CHUNK_SIZE])),
+            OwnerPortfolio, _portfolio_columns,
+        )
+
+def refresh_all(session):
+    _upsert(session, _source)
+
+def rebuild_portfolios(session):
+    _upsert(session, _portfolio_source, OwnerPortfolio, _portfolio_columns)
+
+def rebuild_read_model():
+    session = Session()
+    try:
+        refresh_all(session)
+        rebuild_portfolios(session)
+        bump_data_version(session)
+        session.commit()
+        print("Property read model rebuilt.")
+    finally:
+        session.close()
@@ -0,0 +1,176 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Awaitable, Callable, NamedTuple, Optional
+from flask import Response, request
+from db import Session, get_data_version
+from formats import MIN_COMPRESS_BYTES, compress, negotiate_encoding, negotiate_format
+
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# How long a worker trusts its last read of the data version before asking the DB again
+DATA_VERSION_TTL = float(os.getenv("DATA_VERSION_TTL", 5))
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    status: int
+    mimetype: str
+    headers: list
+
+
+class ResponseCache:
+    """Size-bounded LRU of serialized bodies with single-flight misses."""
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._async_inflight = {}
+
+    def get_or_compute(self, key, compute: Callable[[], Response]):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry:
+                return entry
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+
+        if not leader:
+            event.wait()
+            with self._lock:
+                entry = self._lookup(key)
+            # The leader's response was not cacheable (e.g. an error); compute our own
+            return entry or self._to_entry(compute())
+
+        try:
+            entry = self._to_entry(compute())
+            if entry.status == 200:
+                self._store(key, entry)
+            return entry
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    async def get_or_compute_async(self, key, compute: Callable[[], Awaitable[CachedResponse]]) -> CachedResponse:
+        """get_or_compute for an event loop: concurrent misses await one shared computation."""
+        with self._lock:
+            entry = self._lookup(key)
+        if entry:
+            return entry
+
+        task = self._async_inflight.get(key)
+        if task is None:
+            task = self._async_inflight[key] = asyncio.ensure_future(compute())
+            task.add_done_callback(lambda _: self._async_inflight.pop(key, None))
+        # A disconnecting client must not cancel the computation other requests are waiting on
+        entry = await asyncio.shield(task)
+        if entry.status == 200:
+            self._store(key, entry)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _lookup(self, key) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry: CachedResponse):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self._size += len(entry.body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.body)
+
+    @staticmethod
+    def _to_entry(response) -> CachedResponse:
+        if isinstance(response, tuple):
+            response, status = response
+            response.status_code = status
+        headers = [
+            (name, value) for name, value in response.headers
+            if name not in ("Content-Type", "Content-Length")
+        ]
+        return CachedResponse(response.get_data(), response.status_code, response.mimetype, headers)
+
+
+_version = {"value": None, "checked_at": 0.0}
+_version_lock = threading.Lock()
+
+def current_data_version() -> int:
+    now = time.monotonic()
+    with _version_lock:
+        if _version["value"] is not None and now - _version["checked_at"] < DATA_VERSION_TTL:
+            return _version["value"]
+
+    session = Session()
+    try:
+        version = get_data_version(session)
+    finally:
+        session.close()
+
+    with _version_lock:
+        _version["value"], _version["checked_at"] = version, now
+    return version
+
+def make_etag(key) -> str:
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+response_cache = ResponseCache()
+
+def _compressed(entry: CachedResponse, encoding: str) -> Response:
+    response = Response(compress(entry.body, encoding), status=entry.status, mimetype=entry.mimetype, headers=entry.headers)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+def versioned(view):
+    """Serve a GET view from the response cache, keyed on route, params, format and data version.
+
+    The ETag is derived from the same key plus the content encoding, so a matching
+    If-None-Match gets a 304 without running the view or touching the database.
+    Compressed bodies are cached next to the plain one and compressed only once.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson":
+            return view(*args, **kwargs)
+
+        format = negotiate_format(request.args, request.accept_mimetypes)
+        key = (request.path, tuple(sorted(request.args.items(multi=True))), format, current_data_version())
+        encoding = negotiate_encoding(request.accept_encodings)
+        etag = make_etag(key + (encoding,))
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.vary.update(("Accept", "Accept-Encoding"))
+            return response
+
+        entry = response_cache.get_or_compute(key, lambda: view(*args, **kwargs))
+        if encoding and entry.status == 200 and len(entry.body) >= MIN_COMPRESS_BYTES:
+            entry = response_cache.get_or_compute(key + (encoding,), lambda: _compressed(entry, encoding))
+        response = Response(entry.body, status=entry.status, mimetype=entry.mimetype, headers=entry.headers)
+        if entry.status == 200:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+        response.vary.update(("Accept", "Accept-Encoding"))
+        return response
+
+    return wrapper
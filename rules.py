@@ -1,11 +1,18 @@
 from typing import List
 from db import Property
 from datetime import datetime
+import numpy as np
 
 class WealthRule:
-    """Base class for wealth estimation rules."""
+    """Base class for wealth estimation rules.
+
+    applies() judges one owner's properties; applies_batch() judges every owner of a
+    wealth_batch.PortfolioFrame at once and must agree with applies().
+    """
     def applies(self, properties: List[Property]) -> bool:
         raise NotImplementedError
+    def applies_batch(self, frame) -> np.ndarray:
+        raise NotImplementedError
     def get_multiplier(self) -> float:
         raise NotImplementedError
 
@@ -14,6 +21,9 @@ class MinPropertiesRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return len(properties) >= 3
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.count() >= 3
+
     def get_multiplier(self) -> float:
         return 1.15
 
@@ -24,6 +34,12 @@ class HighAverageAVMRule(WealthRule):
         avms = [p.avm_value for p in properties if p.avm_value]
         return len(avms) > 0 and (sum(avms) / len(avms)) > 1_000_000
 
+    def applies_batch(self, frame) -> np.ndarray:
+        avm = frame.numeric("avm_value")
+        has_avm = avm != 0
+        count = frame.count(has_avm)
+        return (count > 0) & (frame.sum(avm, has_avm) / np.maximum(count, 1) > 1_000_000)
+
     def get_multiplier(self) -> float:
         return 1.25
 
@@ -33,6 +49,9 @@ class MultiStateOwnershipRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return len({p.state for p in properties if p.state}) > 1
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.distinct("state") > 1
+
     def get_multiplier(self) -> float:
         return 1.20
 
@@ -42,6 +61,9 @@ class HasCommercialPropertyRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return any("COMMERCIAL" in (p.propertytype or "") for p in properties)
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.any(frame.matches("propertytype", lambda t: "COMMERCIAL" in t))
+
     def get_multiplier(self) -> float:
         return 1.30
 
@@ -50,15 +72,20 @@ class RecentTransactionRule(WealthRule):
     """Property sold in the last year signals activity + liquidity."""
     def applies(self, properties: List[Property]) -> bool:
         today = datetime.utcnow()
-        for p in properties:
-            if p.sale_date:
-                try:
-                    sale_dt = datetime.strptime(p.sale_date, "%Y-%m-%d")
-                    if (today - sale_dt).days < 365:
-                        return True
-                except Exception:
-                    continue
-        return False
+        return any(self.sold_recently(p.sale_date, today) for p in properties)
+
+    def applies_batch(self, frame) -> np.ndarray:
+        today = datetime.utcnow()
+        return frame.any(frame.matches("sale_date", lambda d: self.sold_recently(d, today)))
+
+    @staticmethod
+    def sold_recently(sale_date: str, today: datetime) -> bool:
+        if not sale_date:
+            return False
+        try:
+            return (today - datetime.strptime(sale_date, "%Y-%m-%d")).days < 365
+        except Exception:
+            return False
 
     def get_multiplier(self) -> float:
         return 1.10
@@ -68,6 +95,9 @@ class HighPropertyTaxRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return any((p.tax_amount or 0) > 15000 for p in properties)
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.any(frame.numeric("tax_amount") > 15000)
+
     def get_multiplier(self) -> float:
         return 1.25
 
@@ -79,6 +109,9 @@ class LuxuryZipRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return any((p.zip_code or "") in self.LUXURY_ZIPS for p in properties)
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.any(frame.matches("zip_code", lambda z: z in self.LUXURY_ZIPS))
+
     def get_multiplier(self) -> float:
         return 1.35
 
@@ -88,6 +121,9 @@ class LargeHomeRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return any((p.size or 0) > 4000 for p in properties)
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.any(frame.numeric("size") > 4000)
+
     def get_multiplier(self) -> float:
         return 1.20
 
@@ -97,6 +133,9 @@ class OlderLuxuryHomeRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return any((p.year_built or 9999) < 1950 for p in properties)
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.any(frame.numeric("year_built", default=9999) < 1950)
+
     def get_multiplier(self) -> float:
         return 1.15
 
@@ -106,6 +145,9 @@ class HighConfidenceAVMRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return any((p.avm_score or 0) >= 90 for p in properties)
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.any(frame.numeric("avm_score") >= 90)
+
     def get_multiplier(self) -> float:
         return 1.10
 
@@ -117,6 +159,9 @@ class LuxuryStateRule(WealthRule):
     def applies(self, properties: List[Property]) -> bool:
         return any((p.state or "").upper() in self.LUX_STATES for p in properties)
 
+    def applies_batch(self, frame) -> np.ndarray:
+        return frame.any(frame.matches("state", lambda s: s.upper() in self.LUX_STATES))
+
     def get_multiplier(self) -> float:
         return 1.15
 
@@ -1,25 +1,34 @@
-from attom_client import get_properties
-from etl import process_attom_id, run_batch_wealth_estimation
-import time
+import argparse
+from attom_client import get_request_stats
+from db import migrate_tables
+from etl import run_batch_wealth_estimation, publish_data_version, backfill_tile_keys
+from pipeline import run_pipeline
+from job_queue import enqueue_zip, run_workers, job_counts, requeue_failed
+from stats_rollups import rebuild_stats
+from export import EXPORT_MIMETYPES, export_files
+from households import rebuild_households
+from read_model import rebuild_read_model
+from tile_aggregates import rebuild_tile_aggregates
 
-def process_zip_and_type(zipcode: str, propertytype: str, delay: float = 1.5, limit: int = 100):
-    properties = get_properties(zipcode, propertytype)
+def process_zip_and_type(zipcode: str, propertytype: str, limit: int = 100, batch_size: int = 100):
+    # Listing, ATTOM fetches, DB writes and wealth recomputes run as concurrent pipeline stages.
+    # Properties fetched recently and unchanged in the listing are skipped (delta sync).
+    run_pipeline([(zipcode, propertytype)], limit=limit, batch_size=batch_size)
+    publish_data_version()
 
-    print(f"Fetching {len(properties)} properties in {zipcode} [{propertytype}]...")
+def migrate_database():
+    # Add the columns and indexes newer code expects, then fill in everything derived from
+    # the existing owners and properties: tile keys first, as the read model and map tiles
+    # need them; the batch estimation regroups households and re-estimates every owner,
+    # since none has a portfolio fingerprint yet.
+    migrate_tables()
+    backfill_tile_keys()
+    rebuild_read_model()
+    rebuild_tile_aggregates()
+    rebuild_stats()
+    run_batch_wealth_estimation()
 
-    if not properties:
-        print("No properties found.")
-        return
-
-    for i, prop in enumerate(properties[:limit]):
-        attom_id = prop.get("identifier", {}).get("attomId")
-        if not attom_id:
-            continue
-        print(f"{i+1} Processing Attom ID: {attom_id}")
-        process_attom_id(attom_id, propertytype)
-        time.sleep(delay)
-
-if __name__ == "__main__":
+def run_legacy_jobs():
     # Uncomment on first run
     #create_tables()
 
@@ -28,10 +37,63 @@ if __name__ == "__main__":
         #("90210", "COMMERCIAL (NEC)"),
     ]
 
-    for zipcode, propertytype in jobs:
-        process_zip_and_type(zipcode, propertytype, delay=2.0, limit=50)
+    # One pipeline for every job, so one ZIP's writes overlap the next one's fetches
+    run_pipeline(jobs, limit=50)
+    publish_data_version()
 
     print("All jobs completed.")
 
+    for endpoint, stats in get_request_stats().items():
+        print(
+            f"{endpoint}: {stats['calls']} calls, {stats['cache_hits']} cache hits, "
+            f"{stats['retries']} retries, {stats['failures']} failures, "
+            f"avg {stats['latency_avg']:.3f}s, max {stats['latency_max']:.3f}s"
+        )
+
     # Uncomment to run wealth estimation
     #run_batch_wealth_estimation()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WealthMap ETL")
+    commands = parser.add_subparsers(dest="command")
+
+    enqueue = commands.add_parser("enqueue", help="queue ZIP/property-type pairs in the durable job table")
+    enqueue.add_argument("zipcode")
+    enqueue.add_argument("propertytypes", nargs="+")
+    enqueue.add_argument("--refresh", action="store_true", help="re-run finished ZIPs, fetching only stale or changed properties")
+
+    work = commands.add_parser("work", help="run queued jobs with a pool of worker processes")
+    work.add_argument("--workers", type=int, default=4)
+
+    commands.add_parser("status", help="show job counts by kind and state")
+    commands.add_parser("requeue-failed", help="give failed jobs a fresh set of attempts")
+    commands.add_parser("migrate", help="upgrade a database created by an older version and backfill the new columns")
+    commands.add_parser("rebuild-stats", help="recompute the /stats rollups from scratch")
+    commands.add_parser("rebuild-households", help="regroup every owner into households")
+
+    export = commands.add_parser("export", help="write owners and their properties to files partitioned by state")
+    export.add_argument("out_dir")
+    export.add_argument("--format", choices=list(EXPORT_MIMETYPES), default="csv")
+    export.add_argument("--state", help="export only this state")
+
+    args = parser.parse_args()
+    if args.command == "enqueue":
+        for propertytype in args.propertytypes:
+            enqueue_zip(args.zipcode, propertytype, refresh=args.refresh)
+    elif args.command == "work":
+        run_workers(args.workers)
+    elif args.command == "status":
+        for (kind, state), count in sorted(job_counts().items()):
+            print(f"{kind:<10} {state:<8} {count}")
+    elif args.command == "requeue-failed":
+        requeue_failed()
+    elif args.command == "migrate":
+        migrate_database()
+    elif args.command == "rebuild-stats":
+        rebuild_stats()
+    elif args.command == "rebuild-households":
+        rebuild_households()
+    elif args.command == "export":
+        export_files(args.out_dir, args.format, args.state)
+    else:
+        run_legacy_jobs()
@@ -0,0 +1,481 @@
+import os
+import re
+import json
+import fcntl
+import bisect
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from sqlalchemy import select
+from db import Session, Owner, Property, OwnerProperty, PropertyReadModel
+from queries import COLUMN_FIELDS, SORT_COLUMNS, PropertyQuery
+
+# Optional in-process snapshot of properties and their owners for /properties and
+# /properties/<id>: one numpy array per column instead of ORM objects, owner links in CSR
+# form, and state/zip/propertytype interned. The data only changes when the ETL publishes a
+# new data version, so a worker serves a snapshot until the version moves on, then loads
+# the next one in the background and swaps it in; until then requests go to the database.
+#
+# With PROPERTY_SNAPSHOT_DIR set, snapshots are saved there as .npy files and memory-mapped,
+# so gunicorn workers on one host build each version once and share its pages: a lock file
+# per version lets one worker build while the others wait for it.
+
+PROPERTY_SNAPSHOT = os.getenv("PROPERTY_SNAPSHOT", "").lower() in ("1", "true", "yes")
+PROPERTY_SNAPSHOT_DIR = os.getenv("PROPERTY_SNAPSHOT_DIR")
+LOAD_CHUNK_SIZE = 10000
+
+PROPERTY_COLUMNS = {
+    "id": "str",
+    "attom_id": "int",
+    "site_address": "str",
+    "address_line1": "str",
+    "address_line2": "str",
+    "city": "str",
+    "state": "category",
+    "zip_code": "category",
+    "propertytype": "category",
+    "year_built": "int",
+    "size": "float",
+    "latitude": "float",
+    "longitude": "float",
+    "sale_amount": "float",
+    "sale_date": "str",
+    "sale_type": "str",
+    "avm_value": "float",
+    "avm_low": "float",
+    "avm_high": "float",
+    "avm_score": "int",
+    "avm_last_updated": "time",
+    "assessed_total_value": "float",
+    "market_total_value": "float",
+    "tax_amount": "float",
+    "tax_year": "int",
+    "created_at": "time",
+}
+# From property_read_model: whether /properties lists the property, and at what value
+LISTING_COLUMNS = {"listed": "bool", "display_value": "float", "has_tile": "bool"}
+
+OWNER_COLUMNS = {
+    "id": "str",
+    "full_name": "str",
+    "mailing_address": "str",
+    "type": "category",
+    "estimated_net_worth": "float",
+    "confidence_level": "category",
+    "created_at": "time",
+    "last_updated": "time",
+}
+
+# Snapshot columns behind the ?fields= of the columnar formats
+_FIELD_COLUMNS = {field: column.key if column.key != "property_id" else "id" for field, column in COLUMN_FIELDS.items()}
+_SUMMARY_COLUMNS = ["site_address", "city", "state", "zip_code", "display_value", "size", "latitude", "longitude"]
+SummaryRow = namedtuple("SummaryRow", ["property_id", "owners"] + _SUMMARY_COLUMNS)
+
+
+class StringColumn:
+    """UTF-8 strings back to back in one buffer: value i is data[offsets[i]:offsets[i + 1]]."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray, valid: np.ndarray):
+        self.data, self.offsets, self.valid = data, offsets, valid
+
+    @classmethod
+    def build(cls, values: List[Optional[str]]) -> "StringColumn":
+        encoded = [value.encode() if value is not None else b"" for value in values]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(data, offsets, np.array([value is not None for value in values], dtype=bool))
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"data": self.data, "offsets": self.offsets, "valid": self.valid}
+
+    def __len__(self) -> int:
+        return len(self.valid)
+
+    def __getitem__(self, i: int) -> Optional[str]:
+        if not self.valid[i]:
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+    def take(self, indices) -> list:
+        return [self[i] for i in indices]
+
+    def nulls(self) -> np.ndarray:
+        return ~self.valid
+
+
+class CategoryColumn:
+    """Interned strings: a code per row into a small vocabulary, -1 for None."""
+
+    def __init__(self, codes: np.ndarray, vocabulary: StringColumn):
+        self.codes, self.vocabulary = codes, vocabulary
+        self.values = vocabulary.take(range(len(vocabulary)))
+        self._codes = {value: code for code, value in enumerate(self.values)}
+
+    @classmethod
+    def build(cls, values: List[Optional[str]]) -> "CategoryColumn":
+        vocabulary = sorted({value for value in values if value is not None})
+        codes = {value: code for code, value in enumerate(vocabulary)}
+        return cls(np.array([codes.get(value, -1) for value in values], dtype=np.int32), StringColumn.build(vocabulary))
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"codes": self.codes, **{f"vocabulary_{name}": array for name, array in self.vocabulary.arrays().items()}}
+
+    def __getitem__(self, i: int) -> Optional[str]:
+        code = self.codes[i]
+        return self.values[code] if code >= 0 else None
+
+    def take(self, indices) -> list:
+        return [self.values[code] if code >= 0 else None for code in self.codes[indices].tolist()]
+
+    def equals(self, value: str) -> np.ndarray:
+        code = self._codes.get(value)
+        return self.codes == code if code is not None else np.zeros(len(self.codes), dtype=bool)
+
+    def nulls(self) -> np.ndarray:
+        return self.codes < 0
+
+
+class NumberColumn:
+    """Ints or floats with a validity mask; values is the raw array for comparisons and sorting."""
+
+    def __init__(self, values: np.ndarray, valid: np.ndarray):
+        self.values, self.valid = values, valid
+
+    @classmethod
+    def build(cls, values: list, dtype) -> "NumberColumn":
+        valid = np.array([value is not None for value in values], dtype=bool)
+        filled = np.array([value if value is not None else 0 for value in values], dtype=dtype)
+        return cls(filled, valid)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"values": self.values, "valid": self.valid}
+
+    def __getitem__(self, i: int):
+        return self.values[i].item() if self.valid[i] else None
+
+    def take(self, indices) -> list:
+        return [value if valid else None for value, valid in zip(self.values[indices].tolist(), self.valid[indices].tolist())]
+
+    def nulls(self) -> np.ndarray:
+        return ~self.valid
+
+
+def _build_column(kind: str, values: list):
+    if kind == "str":
+        return StringColumn.build(values)
+    if kind == "category":
+        return CategoryColumn.build(values)
+    if kind == "time":
+        # datetime64 round-trips naive datetimes; item() turns NaT back into None
+        return NumberColumn.build([np.datetime64(value, "us") if value is not None else None for value in values], "datetime64[us]")
+    dtypes = {"int": np.int64, "float": np.float64, "bool": bool}
+    return NumberColumn.build(values, dtypes[kind])
+
+def _column_from_arrays(kind: str, arrays: Dict[str, np.ndarray]):
+    if kind == "str":
+        return StringColumn(arrays["data"], arrays["offsets"], arrays["valid"])
+    if kind == "category":
+        vocabulary = StringColumn(arrays["vocabulary_data"], arrays["vocabulary_offsets"], arrays["vocabulary_valid"])
+        return CategoryColumn(arrays["codes"], vocabulary)
+    return NumberColumn(arrays["values"], arrays["valid"])
+
+
+class _Record:
+    """Attribute access to one row of a snapshot table, standing in for the ORM object."""
+    __slots__ = ("_columns", "_index", "owners")
+
+    def __init__(self, columns: dict, index: int, owners: Optional[list] = None):
+        self._columns, self._index, self.owners = columns, index, owners
+
+    def __getattr__(self, name):
+        return self._columns[name][self._index]
+
+
+class PropertySnapshot:
+    def __init__(self, version: int, properties: dict, owners: dict, arrays: Dict[str, np.ndarray]):
+        self.version = version
+        self.properties = properties  # Column per name; rows sorted by property id
+        self.owners = owners  # Likewise for owners, sorted by owner id
+        # CSR owner links: property i's owners are owner_index[owner_offsets[i]:owner_offsets[i + 1]]
+        self.owner_offsets = arrays["owner_offsets"]
+        self.owner_index = arrays["owner_index"]
+        # Per ?sort= key: row indices in (value, id) order, and each row's position in it
+        self.orders = {sort: arrays[f"order_{sort}"] for sort in SORT_COLUMNS}
+        self.ranks = {sort: arrays[f"rank_{sort}"] for sort in SORT_COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self.properties["id"])
+
+    def find(self, property_id: str) -> Optional[int]:
+        ids = self.properties["id"]
+        i = bisect.bisect_left(ids, property_id)
+        return i if i < len(ids) and ids[i] == property_id else None
+
+    def select(self, query: PropertyQuery) -> Optional[np.ndarray]:
+        """Row indices for a /properties query, in response order; None for an unknown cursor."""
+        columns = self.properties
+        mask = columns["listed"].values.copy()
+        if query.bbox:
+            min_lng, min_lat, max_lng, max_lat = query.bbox
+            lat, lng = columns["latitude"], columns["longitude"]
+            mask &= columns["has_tile"].values & lat.valid & lng.valid
+            mask &= (lat.values >= min_lat) & (lat.values <= max_lat) & (lng.values >= min_lng) & (lng.values <= max_lng)
+        for column, value in query.filters.items():
+            mask &= columns[column].equals(value)
+        value = columns["display_value"]
+        if query.min_value is not None:
+            mask &= value.valid & (value.values >= query.min_value)
+        if query.max_value is not None:
+            mask &= value.valid & (value.values <= query.max_value)
+
+        if query.sort:
+            mask &= ~columns[SORT_COLUMNS[query.sort].key].nulls()
+            order, rank = self.orders[query.sort], self.ranks[query.sort]
+        else:
+            order = rank = None  # Rows are already in id order
+
+        selected = order[mask[order]] if order is not None else np.flatnonzero(mask)
+        if query.after:
+            after = self.find(query.after)
+            if after is None or not mask[after]:
+                return None
+            positions = rank[selected] if rank is not None else selected
+            position = rank[after] if rank is not None else after
+            selected = selected[positions < position] if query.order == "desc" else selected[positions > position]
+        if query.order == "desc":
+            selected = selected[::-1]
+        if query.limit is not None:
+            selected = selected[:query.limit]
+        return selected
+
+    def _owner_summaries(self, indices) -> List[list]:
+        starts, ends = self.owner_offsets[indices].tolist(), self.owner_offsets[np.asarray(indices) + 1].tolist()
+        linked = self.owner_index[np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [[]]).astype(np.int64)]
+        ids, names, net_worths, confidences = (
+            self.owners[column].take(linked)
+            for column in ("id", "full_name", "estimated_net_worth", "confidence_level")
+        )
+        # Keys in the order JSONB stores them (shortest first), which msgpack bodies preserve
+        summaries = [
+            {"id": owner_id, "name": name, "confidenceLevel": confidence, "estimatedNetWorth": net_worth}
+            for owner_id, name, net_worth, confidence in zip(ids, names, net_worths, confidences)
+        ]
+        result, position = [], 0
+        for start, end in zip(starts, ends):
+            result.append(summaries[position:position + end - start])
+            position += end - start
+        return result
+
+    def summaries(self, indices) -> List[SummaryRow]:
+        """Rows with the property_read_model attributes serialize_property_summary reads."""
+        values = [self.properties["id"].take(indices), self._owner_summaries(indices)]
+        values += [self.properties[column].take(indices) for column in _SUMMARY_COLUMNS]
+        return [SummaryRow(*row) for row in zip(*values)]
+
+    def project(self, indices, fields: List[str]) -> list:
+        """Rows of the given ?fields= plus the cursor, like queries.project_columns."""
+        Row = namedtuple("Row", fields + ["cursor"])
+        values = [
+            self._owner_summaries(indices) if field == "owners" else self.properties[_FIELD_COLUMNS[field]].take(indices)
+            for field in fields
+        ]
+        values.append(self.properties["id"].take(indices))
+        return [Row(*row) for row in zip(*values)]
+
+    def detail(self, property_id: str) -> Optional[_Record]:
+        """The property with its owners, for serialize_property_detail."""
+        i = self.find(property_id)
+        if i is None:
+            return None
+        owners = self.owner_index[self.owner_offsets[i]:self.owner_offsets[i + 1]].tolist()
+        return _Record(self.properties, i, [_Record(self.owners, j) for j in owners])
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"owner_offsets": self.owner_offsets, "owner_index": self.owner_index}
+        for sort in SORT_COLUMNS:
+            arrays[f"order_{sort}"], arrays[f"rank_{sort}"] = self.orders[sort], self.ranks[sort]
+        for prefix, table in (("property", self.properties), ("owner", self.owners)):
+            for name, column in table.items():
+                for key, array in column.arrays().items():
+                    arrays[f"{prefix}.{name}.{key}"] = array
+        return arrays
+
+
+def _sort_orders(properties: dict) -> Dict[str, np.ndarray]:
+    arrays = {}
+    ids = np.arange(len(properties["id"]))
+    for sort, column in SORT_COLUMNS.items():
+        # lexsort's last key is the primary one; row indices already follow id order
+        order = np.lexsort((ids, properties[column.key].values))
+        rank = np.empty_like(order)
+        rank[order] = ids
+        arrays[f"order_{sort}"], arrays[f"rank_{sort}"] = order, rank
+    return arrays
+
+def build_snapshot(session, version: int) -> PropertySnapshot:
+    # COLLATE "C" orders ids by code point, as Python compares them for lookups
+    property_rows = session.execute(
+        select(
+            *[getattr(Property, name) for name in PROPERTY_COLUMNS],
+            PropertyReadModel.property_id.isnot(None),
+            PropertyReadModel.display_value,
+            Property.tile_key.isnot(None),
+        )
+        .outerjoin(PropertyReadModel, PropertyReadModel.property_id == Property.id)
+        .order_by(Property.id.collate("C"))
+        .execution_options(yield_per=LOAD_CHUNK_SIZE)
+    ).all()
+    property_kinds = {**PROPERTY_COLUMNS, **LISTING_COLUMNS}
+    properties = {
+        name: _build_column(kind, [row[i] for row in property_rows])
+        for i, (name, kind) in enumerate(property_kinds.items())
+    }
+    property_positions = {row[0]: i for i, row in enumerate(property_rows)}
+    del property_rows
+
+    owner_rows = session.execute(
+        select(*[getattr(Owner, name) for name in OWNER_COLUMNS])
+        .order_by(Owner.id.collate("C"))
+        .execution_options(yield_per=LOAD_CHUNK_SIZE)
+    ).all()
+    owners = {name: _build_column(kind, [row[i] for row in owner_rows]) for i, (name, kind) in enumerate(OWNER_COLUMNS.items())}
+    owner_positions = {row[0]: i for i, row in enumerate(owner_rows)}
+    del owner_rows
+
+    links = sorted(
+        (property_positions[property_id], owner_positions[owner_id])
+        for property_id, owner_id in session.execute(select(OwnerProperty.property_id, OwnerProperty.owner_id))
+        if property_id in property_positions and owner_id in owner_positions
+    )
+    link_array = np.array(links, dtype=np.int64).reshape(-1, 2)
+    owner_offsets = np.zeros(len(property_positions) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(link_array[:, 0], minlength=len(property_positions)), out=owner_offsets[1:])
+
+    arrays = {"owner_offsets": owner_offsets, "owner_index": link_array[:, 1].astype(np.int32), **_sort_orders(properties)}
+    return PropertySnapshot(version, properties, owners, arrays)
+
+
+def _save(snapshot: PropertySnapshot, path: str):
+    staging = tempfile.mkdtemp(prefix=".building-", dir=PROPERTY_SNAPSHOT_DIR)
+    for name, array in snapshot.arrays().items():
+        np.save(os.path.join(staging, f"{name}.npy"), array)
+    with open(os.path.join(staging, "manifest.json"), "w") as f:
+        json.dump({"version": snapshot.version, "properties": len(snapshot), "owners": len(snapshot.owners["id"])}, f)
+    try:
+        # Atomic publish; another worker may have got there first
+        os.rename(staging, path)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def _load(path: str) -> PropertySnapshot:
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    def array(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    def table(prefix, kinds):
+        keys = {"str": ["data", "offsets", "valid"], "category": ["codes", "vocabulary_data", "vocabulary_offsets", "vocabulary_valid"]}
+        return {
+            name: _column_from_arrays(kind, {key: array(f"{prefix}.{name}.{key}") for key in keys.get(kind, ["values", "valid"])})
+            for name, kind in kinds.items()
+        }
+
+    arrays = {"owner_offsets": array("owner_offsets"), "owner_index": array("owner_index")}
+    for sort in SORT_COLUMNS:
+        arrays[f"order_{sort}"], arrays[f"rank_{sort}"] = array(f"order_{sort}"), array(f"rank_{sort}")
+    return PropertySnapshot(
+        manifest["version"], table("property", {**PROPERTY_COLUMNS, **LISTING_COLUMNS}), table("owner", OWNER_COLUMNS), arrays,
+    )
+
+VERSION_NAME = re.compile(r"v(\d+)(\.lock)?$")
+
+def _remove_old(version: int):
+    """Delete saved snapshots (and their lock files) older than this version; newer ones may be in use."""
+    # Workers still mapping an old version keep their pages after the unlink
+    for name in os.listdir(PROPERTY_SNAPSHOT_DIR):
+        match = VERSION_NAME.match(name)
+        if match and int(match.group(1)) < version:
+            path = os.path.join(PROPERTY_SNAPSHOT_DIR, name)
+            if match.group(2):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+
+def _build(version: int) -> PropertySnapshot:
+    session = Session()
+    try:
+        return build_snapshot(session, version)
+    finally:
+        session.close()
+
+def load_snapshot(version: int) -> PropertySnapshot:
+    """The snapshot for a data version: from PROPERTY_SNAPSHOT_DIR if a worker saved it, else built."""
+    if not PROPERTY_SNAPSHOT_DIR:
+        return _build(version)
+    path = os.path.join(PROPERTY_SNAPSHOT_DIR, f"v{version}")
+    if os.path.isdir(path):
+        return _load(path)
+
+    os.makedirs(PROPERTY_SNAPSHOT_DIR, exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        # Held while building; workers that queue behind it find the saved copy
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(path):
+            _save(_build(version), path)
+            _remove_old(version)
+    return _load(path)
+
+
+class SnapshotHolder:
+    """A worker's current copy of something derived from the data, replaced in the background
+    when the data version changes. load(version) builds it; the result needs a .version."""
+
+    def __init__(self, load: Callable, name: str):
+        self.load = load
+        self.name = name
+        self.snapshot = None
+        self._attempted = None
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    def get(self, version: int, wait: bool = False):
+        """The copy for this data version, or None while it loads (or if loading failed).
+
+        With wait, a caller that finds it loading blocks until the load is done.
+        """
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+
+        with self._lock:
+            # One load per version; if it fails, callers fall back until the next version
+            if self._attempted != version:
+                self._attempted = version
+                self._loaded = threading.Event()
+                threading.Thread(target=self._load, args=(version, self._loaded), daemon=True).start()
+            loaded = self._loaded
+        if wait:
+            loaded.wait()
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.version == version:
+                return snapshot
+        return None
+
+    def _load(self, version: int, loaded: threading.Event):
+        try:
+            self.snapshot = self.load(version)
+            print(f"Loaded {self.name} v{version}: {len(self.snapshot)} properties")
+        except Exception as e:
+            print(f"Error loading {self.name} v{version}: {e}")
+        finally:
+            loaded.set()
+
+snapshots = SnapshotHolder(load_snapshot, "property snapshot")
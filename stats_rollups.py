@@ -0,0 +1,224 @@
+import math
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from db import Session, Owner, Property, OwnerProperty, StatsRollup, StatsHistogram, OwnerStats, bump_data_version
+from wealth_estimator import estimate_property_value
+from read_model import distinct_values
+
+# /stats rollups per ZIP, state and propertytype. Like tile_aggregates, the ETL folds
+# every change in as a delta: a property adds its value to its groups, an owner adds
+# itself (and its net worth) to every group it holds property in. Medians and
+# percentiles come from fixed log-scale histograms, which merge by adding counts.
+
+# ?group_by= values and the property column each groups on
+DIMENSIONS = {"zip": "zip_code", "state": "state", "propertytype": "propertytype"}
+
+# Bucket 0 holds values below 1; then BUCKETS_PER_DECADE buckets per power of ten (each
+# ~26% wide) up to 10^MAX_DECADES, where the last bucket also takes anything larger
+BUCKETS_PER_DECADE = 10
+MAX_DECADES = 12
+LAST_BUCKET = BUCKETS_PER_DECADE * MAX_DECADES
+
+OWNER_STATS_CHUNK_SIZE = 5000
+UPSERT_CHUNK_SIZE = 1000
+
+# (dimension, group_key) pairs a property or owner counts under
+Groups = Tuple[Tuple[str, str], ...]
+# (groups, value) a property adds to stats_rollups
+PropertyStats = Tuple[Groups, float]
+
+
+def bucket(value: float) -> int:
+    if value < 1:
+        return 0
+    return min(1 + int(math.log10(value) * BUCKETS_PER_DECADE), LAST_BUCKET)
+
+def bucket_bounds(index: int) -> Tuple[float, float]:
+    if index == 0:
+        return 0.0, 1.0
+    return 10 ** ((index - 1) / BUCKETS_PER_DECADE), 10 ** (index / BUCKETS_PER_DECADE)
+
+def histogram_percentiles(counts: Dict[int, int], quantiles: Iterable[float]) -> Dict[float, Optional[float]]:
+    """Estimated quantiles of a histogram, interpolated log-linearly within the bucket."""
+    total = sum(counts.values())
+    results = {}
+    for quantile in quantiles:
+        if not total:
+            results[quantile] = None
+            continue
+        rank, seen = quantile * total, 0
+        for index in sorted(counts):
+            if counts[index] and seen + counts[index] >= rank:
+                low, high = bucket_bounds(index)
+                fraction = (rank - seen) / counts[index]
+                results[quantile] = low + (high - low) * fraction if index == 0 else low * (high / low) ** fraction
+                break
+            seen += counts[index]
+    return results
+
+
+def property_stats(prop: Property) -> PropertyStats:
+    groups = tuple((dimension, getattr(prop, column)) for dimension, column in DIMENSIONS.items() if getattr(prop, column))
+    return groups, estimate_property_value(prop)
+
+def _owner_groups(zip_codes, states, propertytypes) -> Groups:
+    return (
+        tuple(("zip", key) for key in zip_codes or [])
+        + tuple(("state", key) for key in states or [])
+        + tuple(("propertytype", key) for key in propertytypes or [])
+    )
+
+
+class _Deltas:
+    def __init__(self):
+        # property_count, value_sum, owner_count, net_worth_count, net_worth_sum
+        self.rollups = defaultdict(lambda: [0, 0.0, 0, 0, 0.0])
+        self.histograms = defaultdict(int)
+
+    def add_property(self, stats: PropertyStats, sign: int):
+        groups, value = stats
+        for group in groups:
+            delta = self.rollups[group]
+            delta[0] += sign
+            delta[1] += sign * value
+            self.histograms[group + ("value", bucket(value))] += sign
+
+    def add_owner(self, groups: Groups, net_worth: Optional[float], sign: int):
+        for group in groups:
+            delta = self.rollups[group]
+            delta[2] += sign
+            if net_worth is not None:
+                delta[3] += sign
+                delta[4] += sign * net_worth
+                self.histograms[group + ("net_worth", bucket(net_worth))] += sign
+
+    def apply(self, session):
+        rollups = sorted((group, delta) for group, delta in self.rollups.items() if any(delta))
+        # Sorted so concurrent writers lock rows in the same order; chunked to stay under the bind limit
+        for start in range(0, len(rollups), UPSERT_CHUNK_SIZE):
+            stmt = insert(StatsRollup).values([
+                {
+                    "dimension": dimension,
+                    "group_key": group_key,
+                    "property_count": property_count,
+                    "value_sum": value_sum,
+                    "owner_count": owner_count,
+                    "net_worth_count": net_worth_count,
+                    "net_worth_sum": net_worth_sum,
+                }
+                for (dimension, group_key), (property_count, value_sum, owner_count, net_worth_count, net_worth_sum)
+                in rollups[start:start + UPSERT_CHUNK_SIZE]
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[StatsRollup.dimension, StatsRollup.group_key],
+                set_={
+                    column: getattr(StatsRollup, column) + stmt.excluded[column]
+                    for column in ("property_count", "value_sum", "owner_count", "net_worth_count", "net_worth_sum")
+                },
+            )
+            session.execute(stmt)
+
+        histograms = sorted((key, count) for key, count in self.histograms.items() if count)
+        for start in range(0, len(histograms), UPSERT_CHUNK_SIZE):
+            stmt = insert(StatsHistogram).values([
+                {"dimension": dimension, "group_key": group_key, "metric": metric, "bucket": index, "count": count}
+                for (dimension, group_key, metric, index), count in histograms[start:start + UPSERT_CHUNK_SIZE]
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[StatsHistogram.dimension, StatsHistogram.group_key, StatsHistogram.metric, StatsHistogram.bucket],
+                set_={"count": StatsHistogram.count + stmt.excluded.count},
+            )
+            session.execute(stmt)
+
+
+_owner_source = (
+    select(
+        Owner.id,
+        distinct_values(Property.zip_code),
+        distinct_values(Property.state),
+        distinct_values(Property.propertytype),
+        Owner.estimated_net_worth,
+    )
+    .select_from(Owner)
+    .outerjoin(OwnerProperty, OwnerProperty.owner_id == Owner.id)
+    .outerjoin(Property, Property.id == OwnerProperty.property_id)
+    .group_by(Owner.id)
+)
+
+def _write_owner_stats(session, rows: List[tuple], deltas: _Deltas):
+    for _, zip_codes, states, propertytypes, net_worth in rows:
+        deltas.add_owner(_owner_groups(zip_codes, states, propertytypes), net_worth, 1)
+    if not rows:
+        return
+    stmt = insert(OwnerStats).values([
+        {"owner_id": owner_id, "zip_codes": zip_codes, "states": states, "propertytypes": propertytypes, "net_worth": net_worth}
+        for owner_id, zip_codes, states, propertytypes, net_worth in rows
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[OwnerStats.owner_id],
+        set_={column: stmt.excluded[column] for column in ("zip_codes", "states", "propertytypes", "net_worth")},
+    )
+    session.execute(stmt)
+
+def _lock_owner_stats(session, owner_ids: List[str]) -> List[OwnerStats]:
+    """The owner_stats rows of these (sorted) owners, locked; an empty row stands in for a new owner."""
+    locked = []
+    for start in range(0, len(owner_ids), OWNER_STATS_CHUNK_SIZE):
+        chunk = owner_ids[start:start + OWNER_STATS_CHUNK_SIZE]
+        # An empty row counts under no group, so inserting one changes no totals; it gives
+        # concurrent writers of the same new owner a row to queue on
+        session.execute(
+            insert(OwnerStats).values([{"owner_id": owner_id} for owner_id in chunk]).on_conflict_do_nothing()
+        )
+        locked += session.query(OwnerStats).filter(OwnerStats.owner_id.in_(chunk)).order_by(OwnerStats.owner_id).with_for_update()
+    return locked
+
+def update_stats(session, removed: Iterable[PropertyStats], added: Iterable[PropertyStats], owner_ids: Iterable[str]):
+    """Fold property changes into stats_rollups and recount these owners, in the caller's transaction.
+
+    The owners' previous contributions are subtracted as deltas, so their owner_stats rows are
+    locked first (in owner id order) and every rollup row after them (in group order): two
+    writers never subtract the same old contribution, and never wait on each other in a cycle.
+    """
+    deltas = _Deltas()
+    for stats in removed:
+        deltas.add_property(stats, -1)
+    for stats in added:
+        deltas.add_property(stats, 1)
+
+    owner_ids = sorted(set(owner_ids))
+    for old in _lock_owner_stats(session, owner_ids):
+        deltas.add_owner(_owner_groups(old.zip_codes, old.states, old.propertytypes), old.net_worth, -1)
+    for start in range(0, len(owner_ids), OWNER_STATS_CHUNK_SIZE):
+        chunk = owner_ids[start:start + OWNER_STATS_CHUNK_SIZE]
+        rows = session.execute(_owner_source.where(Owner.id.in_(chunk))).all()
+        _write_owner_stats(session, rows, deltas)
+    deltas.apply(session)
+
+def refresh_owner_stats(session, owner_ids: Iterable[str]):
+    """Recount these owners in stats_rollups, e.g. after new estimates or new properties."""
+    update_stats(session, (), (), owner_ids)
+
+def rebuild_stats():
+    session = Session()
+    try:
+        for model in (StatsRollup, StatsHistogram, OwnerStats):
+            session.query(model).delete()
+
+        # Bucketed in Python, exactly as the incremental updates bucket
+        deltas = _Deltas()
+        for prop in session.query(Property).yield_per(OWNER_STATS_CHUNK_SIZE):
+            deltas.add_property(property_stats(prop), 1)
+        owners = session.execute(_owner_source.order_by(Owner.id)).all()
+        for start in range(0, len(owners), OWNER_STATS_CHUNK_SIZE):
+            _write_owner_stats(session, owners[start:start + OWNER_STATS_CHUNK_SIZE], deltas)
+        deltas.apply(session)
+
+        bump_data_version(session)
+        session.commit()
+        print("Stats rollups rebuilt.")
+
+    finally:
+        session.close()
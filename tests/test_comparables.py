@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+# The ring search must return exactly the brute-force nearest neighbours, including across
+# the antimeridian and next to the poles, where it used to walk thousands of rings.
+
+CENTRES = [(34.07, -118.42), (0.0, 179.99), (71.3, -156.8), (89.99, 10.0), (-89.98, -45.0)]
+
+
+def _index(points):
+    from comparables import ComparablesIndex, GRID_COLS, _cell
+    from snapshot import CategoryColumn, StringColumn
+
+    latitude, longitude = np.array([lat for lat, _ in points]), np.array([lng for _, lng in points])
+    row, col = _cell(latitude, longitude)
+    order = np.argsort(row * GRID_COLS + col, kind="stable")
+    ids = [f"p{i:04d}" for i in order.tolist()]
+    return ComparablesIndex(
+        1, StringColumn.build(ids), latitude[order], longitude[order],
+        np.full(len(points), np.nan), np.full(len(points), np.nan), CategoryColumn.build(["SFR"] * len(points)),
+    )
+
+
+def _points():
+    rng = np.random.default_rng(7)
+    points = []
+    for lat, lng in CENTRES:
+        for _ in range(60):
+            # Reflected at the poles rather than clipped, which would stack points on the pole
+            point_lat = float(lat + rng.normal(0, 0.2))
+            point_lat = float(np.sign(point_lat) * 180 - point_lat) if abs(point_lat) > 90 else point_lat
+            points.append((point_lat, float((lng + rng.normal(0, 3) + 180) % 360 - 180)))
+    return points
+
+
+@pytest.mark.parametrize("centre", range(len(CENTRES)))
+def test_nearest_matches_brute_force(db, monkeypatch, centre):
+    from comparables import ComparablesIndex, ComparablesQuery, haversine_km
+
+    points = _points()
+    index = _index(points)
+    rings = []
+    ring = ComparablesIndex._ring
+    monkeypatch.setattr(ComparablesIndex, "_ring", lambda self, *args: rings.append(args) or ring(self, *args))
+    query = ComparablesQuery(k=5, radius_km=50.0, weighted=False)
+
+    for i in range(centre * 60, centre * 60 + 60, 7):
+        lat, lng = points[i]
+        target = SimpleNamespace(property_id=f"p{i:04d}", latitude=lat, longitude=lng, size=None, year_built=None, propertytype="SFR")
+        distances = haversine_km(lat, lng, np.array([p[0] for p in points]), np.array([p[1] for p in points]))
+        expected = [f"p{j:04d}" for j in np.argsort(distances).tolist() if j != i and distances[j] <= 50.0][:5]
+        assert [match.property_id for match in index.nearest(target, query)] == expected
+
+    # 50 km is at most ~30 rings of cells at these latitudes; around the poles one band scan
+    # replaces the rings, which used to run to thousands per query
+    assert len(rings) <= 9 * 30
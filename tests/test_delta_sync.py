@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+# A property whose listing lastModified moved is refetched from ATTOM, not answered by the
+# payload cache (whose detail entries outlive the listing's), and the new data is written.
+
+ATTOM_ID = 5001
+
+
+def _sync(modified: str):
+    from db import Session
+    from etl import fetch_changed, write_batch
+
+    session = Session()
+    try:
+        with ThreadPoolExecutor(2) as pool:
+            records = fetch_changed(session, {ATTOM_ID: ("SFR", modified)}, pool)
+        write_batch(session, [record for record in records.values() if record])
+        return records
+    finally:
+        session.close()
+
+
+def test_changed_listing_refetches_past_the_cache(attom):
+    from db import Session, Property, PropertySync
+
+    attom.add(ATTOM_ID, avm_value=500000)
+    assert ATTOM_ID in _sync("2026-01-01")
+    assert sorted(attom.calls) == ["allevents/detail", "property/detailowner"]
+
+    # Unchanged listing, fresh sync: nothing is fetched
+    attom.calls.clear()
+    assert _sync("2026-01-01") == {}
+    assert attom.calls == []
+
+    # The cached details are still within their TTL, but the listing says the property changed
+    attom.add(ATTOM_ID, avm_value=900000)
+    assert ATTOM_ID in _sync("2026-02-01")
+    assert sorted(attom.calls) == ["allevents/detail", "property/detailowner"]
+
+    session = Session()
+    try:
+        assert session.query(Property.avm_value).filter_by(attom_id=ATTOM_ID).scalar() == 900000
+        assert session.get(PropertySync, ATTOM_ID).listing_modified == "2026-02-01"
+    finally:
+        session.close()
@@ -0,0 +1,90 @@
+from conftest import property_record, write
+
+# Households merged batch by batch during the ETL must be what one union-find pass over
+# every owner produces.
+
+
+def test_normalize_address(db):
+    from households import normalize_address
+
+    assert normalize_address("12 Oak Avenue, Apt. 4") == normalize_address("12 OAK AVE #4") == "12 OAK AVE # 4"
+    assert normalize_address("P.O. Box 77") == "PO BOX 77"
+    assert normalize_address("  ") is None
+    assert normalize_address(None) is None
+
+
+def test_union_find(db):
+    from households import UnionFind
+
+    sets = UnionFind(6)
+    sets.link([0, 2, 4])
+    sets.union(1, 3)
+    sets.union(4, 4)
+    assert sets.find(0) == sets.find(2) == sets.find(4)
+    assert sets.find(1) == sets.find(3) != sets.find(0)
+    assert sets.find(5) == 5
+    assert sorted(sets.size[root] for root in {sets.find(i) for i in range(6)}) == [1, 2, 3]
+
+
+def _households() -> dict:
+    from db import Session, Owner
+
+    session = Session()
+    try:
+        return {
+            owner.full_name: (owner.household_id, owner.household_size, owner.address_key)
+            for owner in session.query(Owner)
+        }
+    finally:
+        session.close()
+
+
+def test_incremental_households_match_a_full_pass(db):
+    from db import Session
+    from households import assign_households
+
+    # ANN and BOB share an address written two ways; CY and DEE share nothing yet
+    write([
+        property_record(1, owners=["ANN"], mailing_address="12 Oak Avenue, Apt. 4"),
+        property_record(2, owners=["BOB"], mailing_address="12 OAK AVE #4"),
+        property_record(3, owners=["CY"], mailing_address="5 ELM ST"),
+        property_record(4, owners=["DEE"], mailing_address="9 PINE ST"),
+    ])
+    # EVE co-owns property 3 with CY; FAY gains a link to property 1, joining ANN's household,
+    # then to property 4, which merges two existing households into one
+    write([property_record(3, owners=["EVE"], mailing_address="7 BIRCH RD")])
+    write([property_record(1, owners=["FAY"], mailing_address="3 CEDAR LN")])
+    write([property_record(4, owners=["FAY"], mailing_address="3 CEDAR LN")])
+
+    households = _households()
+    assert households["ANN"][:2] == households["BOB"][:2] == households["FAY"][:2] == households["DEE"][:2]
+    assert households["ANN"][1] == 4
+    assert households["CY"][:2] == households["EVE"][:2]
+    assert households["CY"][1] == 2
+
+    session = Session()
+    try:
+        assert assign_households(session) == 0
+    finally:
+        session.close()
+
+
+def test_estimates_are_split_across_a_grown_household(db):
+    from db import Session, Owner
+
+    write([property_record(1, owners=["ANN"], mailing_address="1 MAIN ST")])
+    session = Session()
+    try:
+        alone = session.query(Owner.estimated_net_worth).filter_by(full_name="ANN").scalar()
+    finally:
+        session.close()
+
+    # BOB moves in: ANN's household grows, so her estimate is redone and split two ways
+    write([property_record(2, owners=["BOB"], mailing_address="1 Main Street")])
+    session = Session()
+    try:
+        ann = session.query(Owner).filter_by(full_name="ANN").one()
+        assert ann.household_size == 2
+        assert ann.estimated_net_worth < alone
+    finally:
+        session.close()
@@ -0,0 +1,114 @@
+import time
+
+# Claims, leases and completion: a job is only ever finished by the worker holding its
+# lease, and only once everything it set off (owner estimates included) is written.
+
+
+def _enqueue_properties(attom_ids):
+    from db import Session
+    from job_queue import _enqueue
+
+    session = Session()
+    try:
+        _enqueue(session, [
+            {"kind": "property", "zipcode": "90210", "propertytype": "SFR", "attom_id": attom_id, "listing_modified": "2026-01-01"}
+            for attom_id in attom_ids
+        ])
+        session.commit()
+    finally:
+        session.close()
+
+def _jobs():
+    from db import Session, EtlJob
+
+    session = Session()
+    try:
+        return {job.attom_id: (job.state, job.worker, job.attempts) for job in session.query(EtlJob)}
+    finally:
+        session.close()
+
+
+def test_claims_are_disjoint(db):
+    from db import Session
+    from job_queue import claim
+
+    _enqueue_properties(range(1, 7))
+    a, b = Session(expire_on_commit=False), Session(expire_on_commit=False)
+    try:
+        claimed_a = {job.attom_id for job in claim(a, "a", limit=4)}
+        claimed_b = {job.attom_id for job in claim(b, "b", limit=4)}
+    finally:
+        a.close()
+        b.close()
+    assert len(claimed_a) == 4
+    assert claimed_b == set(range(1, 7)) - claimed_a
+
+
+def test_finish_only_touches_jobs_still_owned(db):
+    from sqlalchemy import text
+    from db import Session
+    from job_queue import claim, _finish
+
+    _enqueue_properties([1, 2])
+    a, b = Session(expire_on_commit=False), Session(expire_on_commit=False)
+    try:
+        jobs_a = claim(a, "a")
+        # a's lease runs out and b takes the jobs over
+        a.execute(text("UPDATE etl_jobs SET lease_expires_at = now() - interval '1 hour'"))
+        a.commit()
+        jobs_b = claim(b, "b")
+        assert [job.id for job in jobs_b] == [job.id for job in jobs_a]
+
+        _finish(a, jobs_a, error="late")
+        assert _jobs() == {1: ("running", "b", 2), 2: ("running", "b", 2)}
+        _finish(b, jobs_b)
+        assert _jobs() == {1: ("done", "b", 2), 2: ("done", "b", 2)}
+    finally:
+        a.close()
+        b.close()
+
+
+def test_leases_are_renewed_while_a_batch_runs(db, monkeypatch):
+    import job_queue
+    from db import Session, EtlJob
+
+    _enqueue_properties([1])
+    monkeypatch.setattr(job_queue, "LEASE_RENEW_SECONDS", 0.1)
+    session = Session(expire_on_commit=False)
+    try:
+        jobs = job_queue.claim(session, "a")
+        leased_until = jobs[0].lease_expires_at
+        with job_queue._LeaseRenewal(jobs):
+            time.sleep(0.5)
+        assert session.get(EtlJob, jobs[0].id, populate_existing=True).lease_expires_at > leased_until
+    finally:
+        session.close()
+
+
+def test_failed_owner_estimates_are_retried(attom, monkeypatch):
+    import job_queue
+    from db import Session, Owner
+
+    for attom_id in (1, 2, 3):
+        attom.add(attom_id, full_name=f"OWNER {attom_id}")
+    _enqueue_properties([1, 2, 3])
+
+    # The first batch writes its properties, then fails before the owners are estimated
+    recompute_wealth, failures = job_queue.recompute_wealth, []
+
+    def fail_once(dirty):
+        if not failures:
+            failures.append(dirty)
+            raise RuntimeError("connection lost")
+        recompute_wealth(dirty)
+
+    monkeypatch.setattr(job_queue, "recompute_wealth", fail_once)
+    job_queue.work("w")
+
+    assert failures
+    assert _jobs() == {attom_id: ("done", "w", 2) for attom_id in (1, 2, 3)}
+    session = Session()
+    try:
+        assert [owner.estimated_net_worth is not None for owner in session.query(Owner)] == [True] * 3
+    finally:
+        session.close()
@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import inspect, text
+
+# A database created by the original create_tables (owners, properties and owner_property
+# only) must end up with the current schema and backfilled data after `run_etl migrate`.
+
+ADDED_TO_OWNERS = ["portfolio_fingerprint", "rules_triggered", "address_key", "household_id", "household_size"]
+ADDED_INDEXES = [
+    "ix_owners_net_worth", "ix_owners_confidence_net_worth",
+    "ix_owners_full_name_trgm", "ix_owners_mailing_address_trgm", "ix_properties_site_address_trgm",
+]
+
+
+def _schema(engine) -> dict:
+    schema = inspect(engine)
+    return {
+        table: (
+            sorted(column["name"] for column in schema.get_columns(table)),
+            sorted(index["name"] for index in schema.get_indexes(table)),
+        )
+        for table in schema.get_table_names()
+    }
+
+
+def _downgrade(conn):
+    """Strip the schema back to what the original create_tables made."""
+    for table in inspect(conn).get_table_names():
+        if table not in ("owners", "properties", "owner_property"):
+            conn.execute(text(f"DROP TABLE {table} CASCADE"))
+    for index in ADDED_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+    conn.execute(text("ALTER TABLE owners " + ", ".join(f"DROP COLUMN {column}" for column in ADDED_TO_OWNERS)))
+    conn.execute(text("ALTER TABLE properties DROP COLUMN tile_key"))
+
+
+def test_migrate_upgrades_an_original_database(db):
+    from db import Session, Owner, Property, PropertyReadModel, TileAggregate
+    from run_etl import migrate_database
+
+    with db.begin() as conn:
+        if not conn.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first():
+            pytest.skip("migrate_tables needs the pg_trgm extension")
+    current = _schema(db)
+    with db.begin() as conn:
+        _downgrade(conn)
+        conn.execute(text(
+            "INSERT INTO owners (id, full_name, mailing_address, estimated_net_worth) "
+            "VALUES ('o1', 'ANN LEE', '1 MAIN ST', 900000)"
+        ))
+        conn.execute(text(
+            "INSERT INTO properties (id, attom_id, state, zip_code, latitude, longitude, avm_value) "
+            "VALUES ('p1', 1, 'CA', '90210', 34.07, -118.42, 500000)"
+        ))
+        conn.execute(text("INSERT INTO owner_property VALUES ('o1', 'p1')"))
+
+    migrate_database()
+    assert _schema(db) == current
+
+    session = Session()
+    try:
+        assert session.get(Property, "p1").tile_key
+        owner = session.get(Owner, "o1")
+        assert (owner.household_id, owner.household_size) == ("o1", 1)
+        assert owner.portfolio_fingerprint
+        assert session.get(PropertyReadModel, "p1").owners[0]["id"] == "o1"
+        assert session.query(TileAggregate).filter_by(zoom=0).one().property_count == 1
+    finally:
+        session.close()
+
+    # Re-running on an up-to-date database changes nothing
+    migrate_database()
+    assert _schema(db) == current
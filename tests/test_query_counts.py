@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+# The property endpoints read denormalized rows (read_model) and eager-load owners, so the
+# number of statements a request runs must not grow with the number of properties or owners.
+
+SMALL = {"properties": 3, "owners_per_property": 1}
+LARGE = {"properties": 60, "owners_per_property": 4}
+
+
+def _seed(properties: int, owners_per_property: int):
+    from db import Session, Owner, OwnerProperty, Property
+    from read_model import refresh_all
+
+    session = Session()
+    try:
+        for i in range(properties):
+            session.add(Property(
+                id=f"p{i:04d}", attom_id=1000 + i, site_address=f"{i} ELM ST", city="BEVERLY HILLS",
+                state="CA", zip_code="90210", propertytype="SFR", latitude=34.07, longitude=-118.42,
+                avm_value=500000.0 + i,
+            ))
+            for j in range(owners_per_property):
+                owner_id = f"o{i:04d}-{j}"
+                session.add(Owner(id=owner_id, full_name=f"OWNER {i} {j}", mailing_address=f"{i} ELM ST",
+                                  estimated_net_worth=1e6 + j, confidence_level="medium"))
+                session.add(OwnerProperty(owner_id=owner_id, property_id=f"p{i:04d}"))
+            session.flush()
+        refresh_all(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+@contextmanager
+def _count_statements(engine):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+def _statement_counts(engine, client, size) -> dict:
+    from db import Base
+
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    _seed(**size)
+
+    counts = {}
+    for path in (
+        "/properties", "/properties?limit=2", "/properties?limit=2&after=p0001",
+        "/properties?sort=value&limit=2", "/properties/p0002",
+    ):
+        with _count_statements(engine) as statements:
+            response = client.get(path)
+        assert response.status_code == 200, (path, response.get_data(as_text=True))
+        counts[path] = len(statements)
+    return counts
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    import response_cache
+    from app import app
+
+    # Every request runs its view: no cached bodies, and no data-version lookups on a TTL
+    monkeypatch.setattr(response_cache, "current_data_version", lambda: 0)
+    monkeypatch.setattr(response_cache.response_cache, "get_or_compute", lambda key, compute: response_cache.ResponseCache._to_entry(compute()))
+    return app.test_client()
+
+
+def test_property_statement_counts_do_not_grow_with_data(db, client):
+    small = _statement_counts(db, client, SMALL)
+    large = _statement_counts(db, client, LARGE)
+    assert small == large
+    # One statement per page (plus the cursor row), two for a property and its owners
+    assert small["/properties"] == 1
+    assert small["/properties?limit=2&after=p0001"] == 2
+    assert small["/properties/p0002"] == 2
@@ -0,0 +1,99 @@
+import random
+import threading
+
+from conftest import property_record, write
+
+# /stats rollups and histograms kept by the ETL's deltas must equal a rebuild, including
+# when several writers update the same owners and groups at once.
+
+
+def _stats() -> tuple:
+    from db import Session, StatsRollup, StatsHistogram, OwnerStats
+
+    session = Session()
+    try:
+        rollups = {
+            (row.dimension, row.group_key): (
+                row.property_count, round(row.value_sum, 2), row.owner_count, row.net_worth_count, round(row.net_worth_sum, 2),
+            )
+            for row in session.query(StatsRollup)
+            if (row.property_count, row.owner_count) != (0, 0)
+        }
+        histograms = {
+            (row.dimension, row.group_key, row.metric, row.bucket): row.count
+            for row in session.query(StatsHistogram).filter(StatsHistogram.count != 0)
+        }
+        owners = {
+            row.owner_id: (sorted(row.zip_codes), sorted(row.states), sorted(row.propertytypes), row.net_worth)
+            for row in session.query(OwnerStats)
+            if row.zip_codes or row.net_worth is not None
+        }
+        return rollups, histograms, owners
+    finally:
+        session.close()
+
+def _assert_matches_rebuild():
+    from stats_rollups import rebuild_stats
+
+    incremental = _stats()
+    rebuild_stats()
+    assert incremental == _stats()
+
+
+def _record(i: int, rng: random.Random) -> dict:
+    return property_record(
+        i,
+        owners=rng.sample(["ANN LEE", "BOB RAY", "CY TWO", "DEE FOUR"], rng.randint(1, 2)),
+        mailing_address=rng.choice(["1 MAIN ST", "2 OAK AVE"]),
+        state=rng.choice(["CA", "NY"]),
+        zip_code=rng.choice(["90210", "10001", "60601"]),
+        propertytype=rng.choice(["SFR", "CONDO"]),
+        avm_value=rng.choice([None, 350000, 2500000]),
+    )
+
+
+def test_incremental_stats_match_a_rebuild(db):
+    rng = random.Random(1)
+    write([_record(i, rng) for i in range(1, 41)])
+    # Properties change group, value and owners
+    write([_record(i, rng) for i in range(1, 41, 3)])
+    write([_record(i, rng) for i in range(30, 51)])
+    _assert_matches_rebuild()
+
+
+def test_concurrent_writers_keep_stats_exact(db):
+    write([_record(i, random.Random(i)) for i in range(1, 31)])
+    errors = []
+
+    def writer(seed: int):
+        rng = random.Random(seed)
+        try:
+            for _ in range(6):
+                write([_record(i, rng) for i in sorted(rng.sample(range(1, 31), 8))])
+        except Exception as e:
+            errors.append(e)
+
+    def refresher():
+        # Recounts owners without touching their rows, so only owner_stats' own locks order it
+        from db import Owner, Session
+        from stats_rollups import refresh_owner_stats
+
+        try:
+            for _ in range(20):
+                session = Session()
+                try:
+                    refresh_owner_stats(session, [owner_id for owner_id, in session.query(Owner.id)])
+                    session.commit()
+                finally:
+                    session.close()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(4)]
+    threads += [threading.Thread(target=refresher) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    _assert_matches_rebuild()
@@ -0,0 +1,60 @@
+import pytest
+
+# Malformed parameters are a JSON 400 on both serving modes, never a 500 or a silently
+# ignored filter.
+
+BAD_REQUESTS = [
+    "/properties?bbox=nan,1,2,3",
+    "/properties?bbox=-118.5,34,-inf,34.1",
+    "/properties?bbox=1,2",
+    "/properties?bbox=2,1,1,2",
+    "/properties?limit=0",
+    "/properties?sort=bogus",
+    "/properties?min_value=abc",
+    "/properties?max_value=nan",
+    "/properties?limit=ten",
+    "/properties/clusters?zoom=x&bbox=-118.5,34,-118.4,34.1",
+    "/properties/clusters?zoom=10&bbox=-118.5,nan,-118.4,34.1",
+    "/owners?limit=abc",
+    "/owners?limit=0",
+    "/owners?sort=bogus",
+    "/owners?order=up",
+    "/owners?confidence=certain",
+]
+
+
+@pytest.fixture(params=["flask", "asgi"])
+def get(db, request):
+    """GET a path from one of the apps; returns (status, JSON body)."""
+    if request.param == "flask":
+        from app import app
+
+        client = app.test_client()
+        json = lambda response: response.get_json()
+    else:
+        from starlette.testclient import TestClient
+        from asgi import app
+
+        client = TestClient(app)
+        request.addfinalizer(client.close)
+        json = lambda response: response.json()
+
+    def get(path):
+        response = client.get(path)
+        return response.status_code, json(response)
+    return get
+
+
+@pytest.mark.parametrize("path", BAD_REQUESTS)
+def test_bad_parameters_are_400(get, path):
+    status, body = get(path)
+    assert status == 400
+    assert "error" in body
+
+
+@pytest.mark.parametrize("path", [
+    "/properties?bbox=-118.5,34,-118.4,34.1&min_value=1e5",
+    "/owners?limit=5&confidence=high&sort=total_value",
+])
+def test_good_parameters_are_200(get, path):
+    assert get(path) == (200, [])
@@ -0,0 +1,61 @@
+import pytest
+
+# An owner's estimate, its portfolio fingerprint and the rows derived from them
+# (read model, owner_stats) commit together: a failed refresh must not leave a
+# fingerprint behind that makes the next run skip the owner.
+
+
+def _seed():
+    from db import Session, Owner, OwnerProperty, Property
+    from read_model import refresh_all
+
+    session = Session()
+    try:
+        session.add(Property(
+            id="p1", attom_id=1001, site_address="1 ELM ST", state="CA", zip_code="90210",
+            propertytype="SFR", latitude=34.07, longitude=-118.42, avm_value=800000.0,
+        ))
+        session.add(Owner(id="o1", full_name="ANN LEE", mailing_address="1 MAIN ST"))
+        session.flush()
+        session.add(OwnerProperty(owner_id="o1", property_id="p1"))
+        session.flush()
+        refresh_all(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def _owner_state():
+    from db import Session, Owner, OwnerStats, PropertyReadModel
+
+    session = Session()
+    try:
+        owner = session.get(Owner, "o1")
+        listed = session.get(PropertyReadModel, "p1").owners[0]["estimatedNetWorth"]
+        stats = session.get(OwnerStats, "o1")
+        return owner.portfolio_fingerprint, owner.estimated_net_worth, listed, stats and stats.net_worth
+    finally:
+        session.close()
+
+
+def test_failed_refresh_leaves_owner_to_be_recomputed(db, monkeypatch):
+    import etl
+
+    _seed()
+
+    def fail(session, owner_ids):
+        raise RuntimeError("connection lost")
+
+    refresh_owner_stats = etl.refresh_owner_stats
+    monkeypatch.setattr(etl, "refresh_owner_stats", fail)
+    with pytest.raises(RuntimeError):
+        etl.recompute_wealth({"o1": 1})
+    assert _owner_state() == (None, None, None, None)
+
+    monkeypatch.setattr(etl, "refresh_owner_stats", refresh_owner_stats)
+    etl.recompute_wealth({"o1": 1})
+    fingerprint, net_worth, listed, stats_net_worth = _owner_state()
+    assert fingerprint is not None
+    assert net_worth > 0
+    assert listed == net_worth
+    assert stats_net_worth == net_worth
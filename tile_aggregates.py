@@ -0,0 +1,164 @@
+import os
+from typing import Iterable, Optional, Tuple
+from sqlalchemy import func, literal, select
+from sqlalchemy.dialects.postgresql import insert
+from db import Session, Property, TileAggregate, bump_data_version
+from tiles import TILE_ZOOM, quadkey_range
+from wealth_estimator import estimate_property_value, PROPERTY_VALUE_SQL
+
+# (tile_key, latitude, longitude, value) a property adds to every tile containing it
+Contribution = Tuple[str, float, float, float]
+
+# Every property sits in the same few coarse tiles, so if each ETL transaction upserted them
+# all concurrent writers would queue on those rows. Writers maintain zooms
+# MIN_INCREMENTAL_ZOOM..TILE_ZOOM; rollup_low_zooms recomputes the coarser ones from the
+# MIN_INCREMENTAL_ZOOM rows in a short transaction of its own, when new data is published.
+MIN_INCREMENTAL_ZOOM = min(int(os.getenv("TILE_MIN_INCREMENTAL_ZOOM", 8)), TILE_ZOOM)
+# pg_advisory_xact_lock key serializing rollups, which replace the same rows
+ROLLUP_LOCK_KEY = 7316
+
+
+def property_contribution(prop: Property) -> Optional[Contribution]:
+    if not prop.tile_key:
+        return None
+    return (prop.tile_key, prop.latitude or 0, prop.longitude or 0, estimate_property_value(prop))
+
+def apply_tile_deltas(session, removed: Iterable[Contribution], added: Iterable[Contribution]):
+    """Fold property changes into tile_aggregates in the caller's transaction."""
+    removed, added = list(removed), list(added)
+    deltas = {}
+
+    for contributions, sign in ((removed, -1), (added, 1)):
+        for tile_key, lat, lng, value in contributions:
+            for zoom in range(MIN_INCREMENTAL_ZOOM, TILE_ZOOM + 1):
+                delta = deltas.setdefault((zoom, tile_key[:zoom]), [0, 0.0, 0.0, 0.0, None])
+                delta[0] += sign
+                delta[1] += sign * lat
+                delta[2] += sign * lng
+                delta[3] += sign * value
+                if sign > 0:
+                    delta[4] = value if delta[4] is None else max(delta[4], value)
+
+    if not deltas:
+        return
+
+    stmt = insert(TileAggregate).values([
+        {
+            "zoom": zoom,
+            "tile_key": tile_key,
+            "property_count": count,
+            "latitude_sum": lat,
+            "longitude_sum": lng,
+            "value_sum": value,
+            "value_max": value_max,
+        }
+        for (zoom, tile_key), (count, lat, lng, value, value_max) in deltas.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TileAggregate.zoom, TileAggregate.tile_key],
+        set_={
+            "property_count": TileAggregate.property_count + stmt.excluded.property_count,
+            "latitude_sum": TileAggregate.latitude_sum + stmt.excluded.latitude_sum,
+            "longitude_sum": TileAggregate.longitude_sum + stmt.excluded.longitude_sum,
+            "value_sum": TileAggregate.value_sum + stmt.excluded.value_sum,
+            "value_max": func.greatest(TileAggregate.value_max, stmt.excluded.value_max),
+        },
+    )
+    session.execute(stmt)
+
+    # A removed value may have been its tile's max, which can't be subtracted out
+    for tile_key in {c[0] for c in removed}:
+        refresh_tile_max(session, tile_key)
+
+def refresh_tile_max(session, tile_key: str):
+    """Recompute value_max along one tile's incrementally kept ancestry: finest from properties, coarser from children."""
+    session.flush()
+    low, high = quadkey_range(tile_key)
+    value_max = (
+        session.query(func.max(PROPERTY_VALUE_SQL))
+        .filter(Property.tile_key >= low, Property.tile_key < high)
+        .scalar()
+    )
+    _set_tile_max(session, TILE_ZOOM, tile_key, value_max)
+
+    for zoom in range(TILE_ZOOM - 1, MIN_INCREMENTAL_ZOOM - 1, -1):
+        parent = tile_key[:zoom]
+        low, high = quadkey_range(parent)
+        value_max = (
+            session.query(func.max(TileAggregate.value_max))
+            .filter(
+                TileAggregate.zoom == zoom + 1,
+                TileAggregate.tile_key >= low,
+                TileAggregate.tile_key < high,
+                TileAggregate.property_count > 0,
+            )
+            .scalar()
+        )
+        _set_tile_max(session, zoom, parent, value_max)
+
+def _set_tile_max(session, zoom: int, tile_key: str, value_max):
+    session.query(TileAggregate).filter_by(zoom=zoom, tile_key=tile_key).update(
+        {"value_max": value_max}, synchronize_session=False
+    )
+
+def rollup_low_zooms(session):
+    """Recompute the tiles coarser than MIN_INCREMENTAL_ZOOM from the MIN_INCREMENTAL_ZOOM rows."""
+    session.execute(select(func.pg_advisory_xact_lock(ROLLUP_LOCK_KEY)))
+    session.query(TileAggregate).filter(TileAggregate.zoom < MIN_INCREMENTAL_ZOOM).delete(synchronize_session=False)
+    for zoom in range(MIN_INCREMENTAL_ZOOM):
+        tile = func.substr(TileAggregate.tile_key, 1, zoom)
+        rows = (
+            select(
+                literal(zoom),
+                tile,
+                func.sum(TileAggregate.property_count),
+                func.sum(TileAggregate.latitude_sum),
+                func.sum(TileAggregate.longitude_sum),
+                func.sum(TileAggregate.value_sum),
+                func.max(TileAggregate.value_max),
+            )
+            .where(TileAggregate.zoom == MIN_INCREMENTAL_ZOOM, TileAggregate.property_count > 0)
+            .group_by(tile)
+        )
+        session.execute(insert(TileAggregate).from_select(
+            ["zoom", "tile_key", "property_count", "latitude_sum", "longitude_sum", "value_sum", "value_max"], rows,
+        ))
+
+def rebuild_tile_aggregates():
+    session = Session()
+    try:
+        session.query(TileAggregate).delete()
+        for zoom in range(MIN_INCREMENTAL_ZOOM, TILE_ZOOM + 1):
+            tile = func.substr(Property.tile_key, 1, zoom)
+            rows = (
+                session.query(
+                    tile,
+                    func.count(),
+                    func.sum(func.coalesce(Property.latitude, 0)),
+                    func.sum(func.coalesce(Property.longitude, 0)),
+                    func.sum(PROPERTY_VALUE_SQL),
+                    func.max(PROPERTY_VALUE_SQL),
+                )
+                .filter(Property.tile_key.isnot(None))
+                .group_by(tile)
+                .all()
+            )
+            session.bulk_insert_mappings(TileAggregate, [
+                {
+                    "zoom": zoom,
+                    "tile_key": tile_key,
+                    "property_count": count,
+                    "latitude_sum": lat,
+                    "longitude_sum": lng,
+                    "value_sum": value,
+                    "value_max": value_max,
+                }
+                for tile_key, count, lat, lng, value, value_max in rows
+            ])
+        rollup_low_zooms(session)
+        bump_data_version(session)
+        session.commit()
+        print("Tile aggregates rebuilt.")
+
+    finally:
+        session.close()
@@ -0,0 +1,81 @@
+import math
+from typing import List, Optional, Tuple
+from sqlalchemy import and_, or_
+
+# Quadkey tiles (Bing/Web Mercator scheme). A property's tile_key is its quadkey at
+# TILE_ZOOM; every coarser tile containing it is a prefix of that key, so "all rows in
+# tile Q" is the index range [Q, Q + "4").
+TILE_ZOOM = 16
+MAX_LATITUDE = 85.05112878
+
+BBox = Tuple[float, float, float, float]  # min_lng, min_lat, max_lng, max_lat
+
+
+def _clip(value: float, low: float, high: float) -> float:
+    return min(max(value, low), high)
+
+def tile_xy(lat: float, lng: float, zoom: int) -> Tuple[int, int]:
+    lat = _clip(lat, -MAX_LATITUDE, MAX_LATITUDE)
+    lng = _clip(lng, -180.0, 180.0)
+    n = 1 << zoom
+    sin_lat = math.sin(math.radians(lat))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_to_quadkey(x: int, y: int, zoom: int) -> str:
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digit = 0
+        if x & mask:
+            digit += 1
+        if y & mask:
+            digit += 2
+        digits.append(str(digit))
+    return "".join(digits)
+
+def quadkey(lat: Optional[float], lng: Optional[float], zoom: int = TILE_ZOOM) -> Optional[str]:
+    if lat is None or lng is None:
+        return None
+    x, y = tile_xy(lat, lng, zoom)
+    return tile_to_quadkey(x, y, zoom)
+
+def quadkey_range(key: str) -> Tuple[str, str]:
+    # Quadkey digits are 0-3, so every key starting with `key` sorts below key + "4"
+    return key, key + "4"
+
+def parse_bbox(value: str) -> BBox:
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(v) for v in value.split(","))
+    except ValueError:
+        raise ValueError("bbox must be minLng,minLat,maxLng,maxLat")
+    if not all(math.isfinite(v) for v in (min_lng, min_lat, max_lng, max_lat)):
+        raise ValueError("bbox values must be finite numbers")
+    if min_lng > max_lng or min_lat > max_lat:
+        raise ValueError("bbox min values must not exceed max values")
+    return min_lng, min_lat, max_lng, max_lat
+
+def covering_quadkeys(bbox: BBox, max_tiles: int = 16, max_zoom: int = TILE_ZOOM) -> List[str]:
+    """Finest set of at most `max_tiles` tiles (zoom <= max_zoom) that covers the bbox."""
+    min_lng, min_lat, max_lng, max_lat = bbox
+    for zoom in range(max_zoom, -1, -1):
+        x0, y0 = tile_xy(max_lat, min_lng, zoom)  # y grows southwards
+        x1, y1 = tile_xy(min_lat, max_lng, zoom)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= max_tiles:
+            return [
+                tile_to_quadkey(x, y, zoom)
+                for y in range(y0, y1 + 1)
+                for x in range(x0, x1 + 1)
+            ]
+    return [""]
+
+def bbox_filter(tile_column, lat_column, lng_column, bbox: BBox):
+    """SQL predicate: indexed tile-range scan, then an exact coordinate check."""
+    min_lng, min_lat, max_lng, max_lat = bbox
+    ranges = [quadkey_range(key) for key in covering_quadkeys(bbox)]
+    return and_(
+        or_(*[and_(tile_column >= low, tile_column < high) for low, high in ranges]),
+        lat_column.between(min_lat, max_lat),
+        lng_column.between(min_lng, max_lng),
+    )
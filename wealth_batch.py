@@ -0,0 +1,204 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+import numpy as np
+from sqlalchemy import Float, String, column, select, update, values
+from sqlalchemy.dialects.postgresql import ARRAY
+from db import Session, Owner, Property, OwnerProperty
+from read_model import refresh_all, refresh_owners
+from stats_rollups import refresh_owner_stats
+from households import assign_households
+from wealth_estimator import RULES, PORTFOLIO_FIELDS, non_real_estate_multiplier, portfolio_fingerprint
+
+WRITE_CHUNK_SIZE = 10000
+# Above this share of owners updated, rebuilding the whole read model beats refreshing by owner
+FULL_REFRESH_RATIO = 0.25
+
+
+class PortfolioFrame:
+    """Every owner's portfolio as flat per-link column arrays.
+
+    owner_index[i] is the owner (0..n_owners-1) of link i; the reductions below
+    collapse per-link values into one value per owner.
+    """
+
+    def __init__(self, owner_index: np.ndarray, n_owners: int, columns: Dict[str, list]):
+        self.owner_index = owner_index
+        self.n_owners = n_owners
+        self.columns = columns
+        self._strings = {}
+
+    def count(self, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        return self.sum(np.ones(len(self.owner_index)), mask)
+
+    def sum(self, values: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        if mask is not None:
+            values = np.where(mask, values, 0.0)
+        return np.bincount(self.owner_index, weights=values, minlength=self.n_owners)
+
+    def any(self, mask: np.ndarray) -> np.ndarray:
+        return self.count(mask) > 0
+
+    def numeric(self, name: str, default: float = 0.0) -> np.ndarray:
+        """Column as floats, with `value or default` semantics for NULL and 0."""
+        values = np.array(self.columns[name], dtype=float)
+        values[np.isnan(values) | (values == 0)] = default
+        return values
+
+    def matches(self, name: str, predicate) -> np.ndarray:
+        """Per-link predicate(value or ""), evaluated once per distinct value."""
+        uniques, inverse = self._encoded(name)
+        return np.array([bool(predicate(value)) for value in uniques], dtype=bool)[inverse]
+
+    def distinct(self, name: str) -> np.ndarray:
+        """Number of distinct non-empty values per owner."""
+        uniques, inverse = self._encoded(name)
+        present = ~np.isin(inverse, np.flatnonzero(uniques == ""))
+        width = max(len(uniques), 1)
+        pairs = self.owner_index[present] * width + inverse[present]
+        if self.n_owners * width <= 64_000_000:
+            # Few distinct values (e.g. states): mark (owner, value) cells, cheaper than sorting
+            seen = np.zeros(self.n_owners * width, dtype=bool)
+            seen[pairs] = True
+            return seen.reshape(self.n_owners, width).sum(axis=1)
+        return np.bincount(np.unique(pairs) // width, minlength=self.n_owners)
+
+    def _encoded(self, name: str):
+        if name not in self._strings:
+            # Dictionary-encode with a hash map; np.unique would sort the strings
+            codes = {}
+            column_values = self.columns[name]
+            inverse = np.fromiter(
+                (codes.setdefault(value or "", len(codes)) for value in column_values),
+                dtype=np.int64, count=len(column_values),
+            )
+            self._strings[name] = np.array(list(codes), dtype=object), inverse
+        return self._strings[name]
+
+
+def load_frame(session):
+    owners = session.execute(
+        select(Owner.id, Owner.household_size, Owner.portfolio_fingerprint).order_by(Owner.id)
+    ).all()
+    owner_ids = [owner.id for owner in owners]
+    position = {owner_id: i for i, owner_id in enumerate(owner_ids)}
+
+    # Same ordering as owners, so owner_index is sorted and each owner's links are contiguous,
+    # in the property order the per-owner fingerprint uses
+    links = session.execute(
+        select(OwnerProperty.owner_id, *[getattr(Property, name) for name in PORTFOLIO_FIELDS])
+        .join(Property, Property.id == OwnerProperty.property_id)
+        .order_by(OwnerProperty.owner_id, OwnerProperty.property_id)
+    ).all()
+    columns = {name: [row[i + 1] for row in links] for i, name in enumerate(PORTFOLIO_FIELDS)}
+    owner_index = np.fromiter((position[row[0]] for row in links), dtype=np.int64, count=len(links))
+
+    # Members of a household split the estimate, as in the per-owner path
+    group_sizes = np.fromiter((owner.household_size or 1 for owner in owners), dtype=np.int64, count=len(owners))
+
+    frame = PortfolioFrame(owner_index, len(owner_ids), columns)
+    stored_fingerprints = [owner.portfolio_fingerprint for owner in owners]
+    return owner_ids, group_sizes, frame, stored_fingerprints
+
+def fingerprints(owner_ids: List[str], frame: PortfolioFrame, group_sizes: np.ndarray) -> List[str]:
+    rows = list(zip(*(frame.columns[name] for name in PORTFOLIO_FIELDS)))
+    bounds = np.searchsorted(frame.owner_index, np.arange(frame.n_owners + 1))
+    today = datetime.utcnow()
+    return [
+        portfolio_fingerprint(rows[bounds[i]:bounds[i + 1]], int(group_sizes[i]), today)
+        for i in range(len(owner_ids))
+    ]
+
+def estimate_all(owner_ids: List[str], frame: PortfolioFrame, group_sizes: np.ndarray) -> Dict[str, np.ndarray]:
+    values = np.maximum.reduce([
+        frame.numeric("avm_value"),
+        frame.numeric("market_total_value"),
+        frame.numeric("sale_amount"),
+        frame.numeric("assessed_total_value"),
+    ])
+    base_value = frame.sum(values)
+
+    multiplier = np.ones(frame.n_owners)
+    rules_triggered = np.zeros(frame.n_owners, dtype=int)
+    rule_mask = np.zeros(frame.n_owners, dtype=np.int64)  # bit i set if RULES[i] applied
+    for i, rule in enumerate(RULES):
+        applies = rule.applies_batch(frame)
+        multiplier[applies] *= rule.get_multiplier()
+        rules_triggered += applies
+        rule_mask[applies] |= 1 << i
+
+    non_real_estate = np.fromiter(map(non_real_estate_multiplier, owner_ids), dtype=float, count=len(owner_ids))
+    estimated_net_worth = base_value * multiplier * non_real_estate / group_sizes
+
+    confidence = np.where(rules_triggered >= 4, "high", np.where(rules_triggered >= 2, "medium", "low"))
+    return {
+        "base_value": base_value,
+        "multiplier": multiplier,
+        "estimated_net_worth": estimated_net_worth,
+        "confidence_level": confidence,
+        "rule_mask": rule_mask,
+        "group_size": group_sizes,
+    }
+
+def rule_names(mask: int) -> List[str]:
+    return [rule.__class__.__name__ for i, rule in enumerate(RULES) if mask >> i & 1]
+
+def write_estimates(session, owner_ids: List[str], results: Dict[str, np.ndarray], selected: np.ndarray):
+    now = datetime.utcnow()
+    # Owners share a handful of rule combinations; name each combination once
+    names = {int(mask): rule_names(int(mask)) for mask in np.unique(results["rule_mask"][selected])}
+    rows = [
+        (
+            owner_ids[i], float(results["estimated_net_worth"][i]), str(results["confidence_level"][i]),
+            results["fingerprint"][i], names[int(results["rule_mask"][i])],
+        )
+        for i in np.flatnonzero(selected)
+    ]
+    for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+        # UPDATE ... FROM (VALUES ...) writes a whole chunk in one statement
+        batch = values(
+            column("id", String), column("estimated_net_worth", Float),
+            column("confidence_level", String), column("portfolio_fingerprint", String),
+            column("rules_triggered", ARRAY(String)),
+            name="estimates",
+        ).data(rows[start:start + WRITE_CHUNK_SIZE])
+        session.execute(
+            update(Owner)
+            .where(Owner.id == batch.c.id)
+            .values(
+                estimated_net_worth=batch.c.estimated_net_worth,
+                confidence_level=batch.c.confidence_level,
+                portfolio_fingerprint=batch.c.portfolio_fingerprint,
+                rules_triggered=batch.c.rules_triggered,
+                last_updated=now,
+            )
+        )
+    return len(rows)
+
+def run_batch_estimation(force: bool = False) -> int:
+    """Re-estimate every owner whose portfolio fingerprint changed (or all, with force)."""
+    session = Session()
+    try:
+        # Regroup households first; a household size change changes the fingerprint
+        regrouped = assign_households(session)
+        print(f"Regrouped {regrouped} owners into households.")
+        owner_ids, group_sizes, frame, stored_fingerprints = load_frame(session)
+        print(f"🧮 Found {len(owner_ids)} owners. Estimating wealth...")
+
+        results = estimate_all(owner_ids, frame, group_sizes)
+        results["fingerprint"] = fingerprints(owner_ids, frame, group_sizes)
+        changed = np.array(
+            [force or new != old for new, old in zip(results["fingerprint"], stored_fingerprints)], dtype=bool
+        )
+        updated = write_estimates(session, owner_ids, results, changed)
+        if updated > FULL_REFRESH_RATIO * len(owner_ids):
+            refresh_all(session)
+        elif updated:
+            refresh_owners(session, [owner_ids[i] for i in np.flatnonzero(changed)])
+        if updated:
+            refresh_owner_stats(session, [owner_ids[i] for i in np.flatnonzero(changed)])
+        session.commit()
+        print(f"Updated {updated} owners; {len(owner_ids) - updated} unchanged.")
+        return updated
+
+    finally:
+        session.close()
@@ -1,8 +1,9 @@
-from typing import List
+from typing import Iterable, List, Optional, Tuple
 from db import Property, Owner, OwnerProperty, Session
 from datetime import datetime
+from sqlalchemy import func
 from rules import *
-import random
+import hashlib
 
 RULES = [
     MinPropertiesRule(),
@@ -18,6 +19,15 @@ RULES = [
     LuxuryStateRule()
 ]
 
+# Every Property column the rules and base value read, in fingerprint order
+PORTFOLIO_FIELDS = [
+    "avm_value", "market_total_value", "sale_amount", "assessed_total_value",
+    "state", "zip_code", "propertytype", "sale_date",
+    "tax_amount", "size", "year_built", "avm_score",
+]
+_SALE_DATE = PORTFOLIO_FIELDS.index("sale_date")
+RULESET_KEY = repr([(rule.__class__.__name__, rule.get_multiplier()) for rule in RULES])
+
 
 def estimate_property_value(p: Property):
     return max(
@@ -27,16 +37,55 @@ def estimate_property_value(p: Property):
         p.assessed_total_value or 0
     )
 
-def compute_owner_wealth(owner_id: str, owner_length: int = 1) -> dict:
-    session = Session()
+# SQL form of estimate_property_value, for aggregates computed in the database
+PROPERTY_VALUE_SQL = func.greatest(
+    func.coalesce(Property.avm_value, 0),
+    func.coalesce(Property.market_total_value, 0),
+    func.coalesce(Property.sale_amount, 0),
+    func.coalesce(Property.assessed_total_value, 0),
+)
+
+def non_real_estate_multiplier(owner_id: str) -> float:
+    """Stand-in for wealth held outside real estate: uniform in [1.5, 2.0], fixed per owner."""
+    digest = hashlib.sha256(owner_id.encode()).digest()
+    return 1.5 + 0.5 * int.from_bytes(digest[:8], "big") / 2 ** 64
+
+def portfolio_fingerprint(rows: Iterable[Tuple], group_size: int, today: datetime) -> str:
+    """Hash of everything an estimate depends on.
+
+    rows are PORTFOLIO_FIELDS tuples ordered by property id. Whether each sale is
+    still within RecentTransactionRule's window is hashed too, since that changes
+    with the date rather than the data.
+    """
+    h = hashlib.sha1(RULESET_KEY.encode())
+    h.update(f"|{group_size}".encode())
+    for row in rows:
+        h.update(repr((row, RecentTransactionRule.sold_recently(row[_SALE_DATE], today))).encode())
+    return h.hexdigest()
+
+def compute_owner_wealth(owner_id: str, household_size: int = 1, force: bool = False, session=None) -> Optional[dict]:
+    """Re-estimate one owner; returns None if the owner is missing or its inputs are unchanged.
+
+    Given a session, the estimate is written in the caller's transaction and left uncommitted.
+    """
+    own_session = session is None
+    session = session or Session()
     try:
-        owner = session.query(Owner).get(owner_id)
+        owner = session.get(Owner, owner_id)
         if not owner:
             return
 
         property_links = session.query(OwnerProperty).filter_by(owner_id=owner_id).all()
         property_ids = [pl.property_id for pl in property_links]
-        properties = session.query(Property).filter(Property.id.in_(property_ids)).all()
+        properties = session.query(Property).filter(Property.id.in_(property_ids)).order_by(Property.id).all()
+
+        fingerprint = portfolio_fingerprint(
+            [tuple(getattr(p, field) for field in PORTFOLIO_FIELDS) for p in properties],
+            household_size,
+            datetime.utcnow(),
+        )
+        if fingerprint == owner.portfolio_fingerprint and not force:
+            return
 
         base_value = sum(estimate_property_value(p) for p in properties)
         multiplier = 1.0
@@ -48,7 +97,7 @@ def compute_owner_wealth(owner_id: str, owner_length: int = 1) -> dict:
                 active_rules.append(rule.__class__.__name__)
 
         inferred_real_estate_wealth = base_value * multiplier
-        non_real_estate_wealth_multiplier = random.uniform(1.5, 2.0)
+        non_real_estate_wealth_multiplier = non_real_estate_multiplier(owner_id)
         estimated_net_worth = inferred_real_estate_wealth * non_real_estate_wealth_multiplier
 
         # Confidence based on rule count
@@ -59,14 +108,19 @@ def compute_owner_wealth(owner_id: str, owner_length: int = 1) -> dict:
         )
 
         # Update DB
-        owner.estimated_net_worth = float(estimated_net_worth)/owner_length
+        owner.estimated_net_worth = float(estimated_net_worth)/household_size
         owner.confidence_level = confidence
+        owner.portfolio_fingerprint = fingerprint
+        owner.rules_triggered = active_rules
         owner.last_updated = datetime.utcnow()
-        session.commit()
+        if own_session:
+            session.commit()
+        else:
+            session.flush()
 
         return {
             "owner_id": owner_id,
-            "estimated_net_worth": float(estimated_net_worth)/owner_length,
+            "estimated_net_worth": float(estimated_net_worth)/household_size,
             "confidence_level": confidence,
             "base_value": base_value,
             "multiplier": multiplier,
@@ -74,4 +128,5 @@ def compute_owner_wealth(owner_id: str, owner_length: int = 1) -> dict:
         }
 
     finally:
-        session.close()
+        if own_session:
+            session.close()